@@ -1,10 +1,8 @@
-import threading
+from contextvars import ContextVar
 
-local = threading.local()
+# A context variable rather than a thread local: coroutines served by one thread must not see each other's IDs.
+request_id = ContextVar('request_id', default='processing')
 
 
 def get_current_request_id():
-    try:
-        return local.request_id
-    except AttributeError:
-        return 'processing'
+    return request_id.get()
@@ -0,0 +1,141 @@
+"""
+Admission control of the requests, see `AdmissionControlMiddleware`.
+
+Every client gets `RATE` requests a second with bursts of up to `BURST` requests from a token bucket kept in
+the worker. With `SHARED`, the requests of the client are also counted in memcached with an atomic `incr` in windows
+of `BURST / RATE` seconds that allow `BURST` requests each, so the limit holds for all workers together.
+"""
+import math
+import threading
+
+from collections import OrderedDict
+from hashlib import sha256
+from typing import Union
+
+from django.core.cache import cache
+
+from backend.cache.aio import get_async_cache
+
+
+class TokenBuckets:
+    """
+    Thread-safe token buckets of the clients, bounded by `max_clients`: the bucket of the least recently seen
+    client is dropped for a new one, and the client starts again with a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: int, max_clients: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, client: str, now: float) -> float:
+        """
+        Takes a token of the client at the `time.monotonic` time `now`. \\
+        Returns 0 if the request is admitted, otherwise the seconds until the next token.
+        """
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                bucket = self.buckets[client] = [float(self.burst), now]
+                if len(self.buckets) > self.max_clients:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(client)
+                bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+
+class SharedCounters:
+    """
+    Request counters of the clients in memcached, shared by the workers.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.limit = burst
+        self.window = max(1.0, burst / rate)
+
+    def key(self, client: str, now: float) -> str:
+        return 'admission:%s:%d' % (sha256(client.encode()).hexdigest()[:32], now // self.window)
+
+    def retry_after(self, count: int, now: float) -> float:
+        if count <= self.limit:
+            return 0.0
+        return self.window - now % self.window
+
+    def timeout(self) -> int:
+        return math.ceil(self.window) + 1
+
+    def take(self, client: str, now: float) -> float:
+        """
+        Counts the request of the client at the `time.time` time `now`, the result is the one of `TokenBuckets.take`.
+        """
+        key = self.key(client, now)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            cache.add(key, 0, self.timeout())
+            count = cache.incr(key)
+        return self.retry_after(count, now)
+
+    async def atake(self, client: str, now: float) -> float:
+        """
+        Async version of `take`.
+        """
+        key = self.key(client, now)
+        async_cache = get_async_cache()
+        try:
+            count = await async_cache.incr(key)
+        except ValueError:
+            await async_cache.add(key, 0, self.timeout())
+            count = await async_cache.incr(key)
+        return self.retry_after(count, now)
+
+
+def get_client(request, header: str, trusted_proxies: int = 1) -> str:
+    """
+    Returns the client of the request: the address added by the first of the `trusted_proxies` proxies to the
+    `header` key of `request.META` if it is set, for example `HTTP_X_FORWARDED_FOR`, otherwise the peer address. \\
+    Each proxy appends the address it got the request from, so the values before that one come from the client
+    and can be anything.
+    """
+    if header:
+        value = request.META.get(header)
+        if value:
+            values = value.split(',')
+            return values[max(0, len(values) - max(1, trusted_proxies))].strip()
+    return request.META.get('REMOTE_ADDR') or 'unknown'
+
+
+class InFlight:
+    """
+    Thread-safe count of the requests in progress in the worker, bounded by `limit`; 0 does not bound it.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def enter(self) -> bool:
+        with self.lock:
+            if self.limit and self.count >= self.limit:
+                return False
+            self.count += 1
+            return True
+
+    def exit(self):
+        with self.lock:
+            self.count -= 1
+
+
+def retry_after(seconds: Union[float, int]) -> str:
+    """
+    Formats the `Retry-After` header, in whole seconds and at least 1.
+    """
+    return str(max(1, math.ceil(seconds)))
@@ -10,7 +10,27 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
+from django.db import connections
+from django.urls import get_resolver, reverse
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+os.environ.setdefault('REGISTRATIONS_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
+
+from django.conf import settings  # noqa: E402
+
+from backend.middleware import BodySizeLimitMiddleware  # noqa: E402
+
+max_body_sizes = settings.REGISTRATIONS_MAX_BODY_SIZE
+application = BodySizeLimitMiddleware(application, {
+    reverse('post_registrations_endpoint'): max_body_sizes['REGISTRATION'],
+    reverse('post_registrations_batch_endpoint'): max_body_sizes['BATCH'],
+    reverse('lookup_registrations_endpoint'): max_body_sizes['LOOKUP'],
+}, max(max_body_sizes.values()))
+
+# The URLconf imports the views, the storage and the cache backend, and every request looks through the database
+# backends, the dummy one here. Loading them with the application rather than on the first request keeps
+# the first request of a new worker almost as fast as the next ones.
+get_resolver().url_patterns
+connections.all()
@@ -0,0 +1,296 @@
+import asyncio
+import time
+import weakref
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from backend.cache.protocol import MemcachedError, decode_value, encode_value, parse_server, server_hash
+
+
+class ServerPool:
+    """
+    A pool of asyncio connections to one memcached server. \\
+    Connections are bound to the event loop they were opened in.
+    """
+
+    def __init__(self, host: str, port: int, max_connections: int, timeout: float):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.idle = []
+        self.slots = asyncio.Semaphore(max_connections)
+
+    async def execute(self, command: bytes, read_response, idempotent: bool = True):
+        """
+        Sends the command on a pooled connection and reads the response with `read_response(reader)`. \\
+        An idle connection closed by the server is replaced by a new one; an idempotent command that fails
+        on a reused connection is sent once more on a new one.
+        """
+        async with self.slots:
+            while self.idle:
+                reader, writer = self.idle.pop()
+                if not reader.at_eof():
+                    break
+                writer.close()
+            else:
+                reader, writer = None, None
+            if reader is not None:
+                try:
+                    return await self.send(reader, writer, command, read_response)
+                except (OSError, EOFError, asyncio.IncompleteReadError):
+                    if not idempotent:
+                        raise
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+            return await self.send(reader, writer, command, read_response)
+
+    async def send(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, command: bytes, read_response):
+        try:
+            writer.write(command)
+            result = await asyncio.wait_for(read_response(reader), self.timeout)
+        except BaseException:
+            writer.close()
+            raise
+        self.idle.append((reader, writer))
+        return result
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+async def read_line(reader: asyncio.StreamReader) -> bytes:
+    line = await reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise EOFError('Connection closed')
+    return line
+
+
+async def read_values(reader: asyncio.StreamReader) -> dict:
+    values = {}
+    while True:
+        line = await read_line(reader)
+        if line == b'END\r\n':
+            return values
+        if not line.startswith(b'VALUE '):
+            raise MemcachedError(line.decode(errors='replace').strip())
+        _, key, flags, length = line.split()[:4]
+        data = await reader.readexactly(int(length) + 2)
+        values[key] = decode_value(int(flags), data[:-2])
+
+
+async def read_status(reader: asyncio.StreamReader) -> bytes:
+    line = await read_line(reader)
+    if line.startswith((b'ERROR', b'CLIENT_ERROR', b'SERVER_ERROR')):
+        raise MemcachedError(line.decode(errors='replace').strip())
+    return line[:-2]
+
+
+class AsyncMemcachedCache:
+    """
+    Non-blocking memcached client for coroutine views. \\
+    It mirrors the key making, timeouts, value flags and server selection of the synchronous
+    cache backend with the same alias, so both of them share the stored data.
+    """
+
+    def __init__(self, alias: str = 'default'):
+        self.cache = caches[alias]
+        options = settings.CACHES[alias].get('ASYNC_OPTIONS', {})
+        self.max_connections = options.get('MAX_CONNECTIONS', 100)
+        self.timeout = options.get('TIMEOUT', 3.0)
+        # The sharded backend chooses the replicas of a key on its hash ring and keeps the health of the nodes.
+        self.ring = getattr(self.cache, 'ring', None)
+        self.servers = []
+        if self.ring is None:
+            for server in self.cache.client_servers:
+                host, port, weight = parse_server(server)
+                self.servers.extend([(host, port)] * weight)
+        self.pools = weakref.WeakKeyDictionary()
+        self.min_compress_len = getattr(self.cache, 'min_compress_len', 0)
+        # The calls are measured together with the ones of the synchronous backend, as `async_<command>`.
+        self.metrics = getattr(self.cache, 'metrics', None)
+
+    def get_nodes(self, key: bytes) -> list:
+        """
+        Returns the `(server, node)` replicas of the key in the order to try them. \\
+        The node is the circuit breaker of the server shared with the synchronous backend, `None` without sharding.
+        """
+        if self.ring is None:
+            return [(self.servers[server_hash(key) % len(self.servers)], None)]
+        return [((node.host, node.port), node) for node in self.cache.get_nodes(key)]
+
+    def get_pool(self, server: tuple[str, int]) -> ServerPool:
+        loop = asyncio.get_running_loop()
+        pools = self.pools.get(loop)
+        if pools is None:
+            pools = self.pools[loop] = {}
+        if server not in pools:
+            pools[server] = ServerPool(*server, self.max_connections, self.timeout)
+        return pools[server]
+
+    async def execute(self, server: tuple, node, command: bytes, read_response):
+        if node is not None and not node.admit():
+            raise MemcachedError('%s:%d is unavailable' % server)
+        started = time.perf_counter()
+        idempotent = not command.startswith((b'add ', b'incr ', b'decr '))
+        try:
+            result = await self.get_pool(server).execute(command, read_response, idempotent)
+        except MemcachedError:
+            # The node answered, but the rest of the response cannot be trusted.
+            if node is not None:
+                node.record_success()
+            self.observe(command, started, error=True)
+            raise
+        except (OSError, EOFError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            if node is not None:
+                node.record_failure()
+            self.observe(command, started, error=True)
+            raise MemcachedError('%s:%d: %s' % (*server, str(e) or type(e).__name__)) from e
+        if node is not None:
+            node.record_success()
+        self.observe(command, started)
+        return result
+
+    def observe(self, command: bytes, started: float, error: bool = False):
+        if self.metrics is not None:
+            operation = 'async_' + command[:command.index(b' ')].decode()
+            self.metrics.observe(operation, time.perf_counter() - started, error)
+
+    def make_key(self, key: str) -> bytes:
+        key = self.cache.make_key(key)
+        self.cache.validate_key(key)
+        return key.encode()
+
+    async def get(self, key: str, default=None):
+        key = self.make_key(key)
+        return (await self.get_keys([key])).get(key, default)
+
+    async def get_many(self, keys: list[str]) -> dict:
+        key_map = {self.make_key(key): key for key in keys}
+        return {key_map[key]: value for key, value in (await self.get_keys(list(key_map))).items()}
+
+    async def get_keys(self, keys: list[bytes]) -> dict:
+        """
+        Gets the keys with a multi-get per server. Keys of a failed server, or missing on it, are asked from their next
+        replica.
+        """
+        pending = {key: self.get_nodes(key) for key in keys}
+        found = {}
+        while pending:
+            by_server = {}
+            for key, nodes in pending.items():
+                by_server.setdefault(nodes[0], []).append(key)
+            results = await asyncio.gather(*(
+                self.execute(*replica, b'get ' + b' '.join(server_keys) + b'\r\n', read_values)
+                for replica, server_keys in by_server.items()
+            ), return_exceptions=True)
+            retry = {}
+            for server_keys, result in zip(by_server.values(), results):
+                if isinstance(result, BaseException):
+                    if not isinstance(result, MemcachedError):
+                        raise result
+                    for key in server_keys:
+                        if len(pending[key]) == 1:
+                            raise result
+                        retry[key] = pending[key][1:]
+                    continue
+                found.update(result)
+                retry.update((key, pending[key][1:]) for key in server_keys
+                             if key not in result and len(pending[key]) > 1)
+            pending = retry
+        return found
+
+    async def store(self, command: bytes, key: str, value, timeout) -> bool:
+        key = self.make_key(key)
+        flags, data = encode_value(value, self.min_compress_len)
+        exptime = self.cache.get_backend_timeout(timeout)
+        nodes = self.get_nodes(key)
+        request = b'%s %s %d %d %d\r\n%s\r\n' % (command, key, flags, exptime, len(data), data)
+        if command == b'add':
+            # The first reachable replica decides whether the key is new,
+            # the others get a copy unless they have the key.
+            for i, replica in enumerate(nodes):
+                try:
+                    if await self.execute(*replica, request, read_status) != b'STORED':
+                        return False
+                except MemcachedError:
+                    if i == len(nodes) - 1:
+                        raise
+                    continue
+                nodes = nodes[i + 1:]
+                break
+            await asyncio.gather(*(self.execute(*replica, request, read_status) for replica in nodes),
+                                 return_exceptions=True)
+            return True
+        results = await asyncio.gather(*(self.execute(*replica, request, read_status) for replica in nodes),
+                                       return_exceptions=True)
+        if all(isinstance(result, BaseException) for result in results):
+            raise results[0]
+        return b'STORED' in results
+
+    async def set(self, key: str, value, timeout=DEFAULT_TIMEOUT) -> bool:
+        return await self.store(b'set', key, value, timeout)
+
+    async def add(self, key: str, value, timeout=DEFAULT_TIMEOUT) -> bool:
+        return await self.store(b'add', key, value, timeout)
+
+    async def incr(self, key: str, delta: int = 1) -> int:
+        """
+        Increments the counter on the first reachable replica and then on the others, like the backend does.
+        Raises `ValueError` if the key is not found, like the cache backends do.
+        """
+        key = self.make_key(key)
+        nodes = self.get_nodes(key)
+        request = b'incr %s %d\r\n' % (key, delta)
+        for i, replica in enumerate(nodes):
+            try:
+                status = await self.execute(*replica, request, read_status)
+                if status == b'NOT_FOUND' and await self.restore_counter(key, replica, nodes[i + 1:]):
+                    status = await self.execute(*replica, request, read_status)
+            except MemcachedError:
+                if i == len(nodes) - 1:
+                    raise
+                continue
+            if status == b'NOT_FOUND':
+                raise ValueError("Key '%s' not found" % key.decode())
+            await asyncio.gather(*(self.execute(*other, request, read_status) for other in nodes[i + 1:]),
+                                 return_exceptions=True)
+            return int(status)
+
+    async def restore_counter(self, key: bytes, replica: tuple, others: list[tuple]) -> bool:
+        """
+        Async version of `ShardedMemcachedCache.restore_counter`.
+        """
+        for other in others:
+            try:
+                status = await self.execute(*other, b'incr %s 0\r\n' % key, read_status)
+            except MemcachedError:
+                continue
+            if status == b'NOT_FOUND':
+                continue
+            flags, data = encode_value(int(status), self.min_compress_len)
+            exptime = self.cache.get_backend_timeout()
+            await self.execute(*replica, b'add %s %d %d %d\r\n%s\r\n' % (key, flags, exptime, len(data), data),
+                               read_status)
+            return True
+        return False
+
+    async def delete(self, key: str) -> bool:
+        key = self.make_key(key)
+        results = await asyncio.gather(*(
+            self.execute(*replica, b'delete ' + key + b'\r\n', read_status) for replica in self.get_nodes(key)
+        ), return_exceptions=True)
+        return b'DELETED' in results
+
+
+async_caches = {}
+
+
+def get_async_cache(alias: str = 'default') -> AsyncMemcachedCache:
+    """
+    Returns the process-wide async client for the cache alias.
+    """
+    if alias not in async_caches:
+        async_caches[alias] = AsyncMemcachedCache(alias)
+    return async_caches[alias]
@@ -0,0 +1,362 @@
+import logging
+import re
+import time
+
+from functools import wraps
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache, InvalidCacheKey, memcache_key_warnings
+
+from backend.cache.client import NodeClient
+from backend.cache.metrics import OperationMetrics
+from backend.cache.protocol import MemcachedError, decode_value, encode_value
+from backend.cache.ring import HashRing
+
+logger = logging.getLogger('django')
+
+
+def measured(method):
+    """
+    Records the latency of the cache operation in the metrics of the backend.
+    """
+    operation = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+        except BaseException:
+            self.metrics.observe(operation, time.perf_counter() - started, error=True)
+            raise
+        self.metrics.observe(operation, time.perf_counter() - started)
+        return result
+    return wrapper
+
+
+class ShardedMemcachedCache(BaseCache):
+    """
+    Memcached cache backend spreading keys over the `LOCATION` nodes by consistent hashing. \\
+    Every key is kept on `REPLICAS` nodes: writes go to all of them, reads go to the first available one
+    and fail over to the next on a timeout, a connection error or a miss. Every node has its own connection pool
+    and circuit breaker, see `NodeClient`. Multi-key operations are sent to a node in one round trip.
+    Values are stored with the flags of `python-memcached`, and the latency of every operation
+    is kept in `metrics`.
+
+    OPTIONS:
+        REPLICAS: number of nodes keeping every key, 1 by default.
+        CONNECT_TIMEOUT: connect timeout in seconds, 1 by default.
+        READ_TIMEOUT: timeout of a response in seconds, 1 by default.
+        MAX_CONNECTIONS: connections to a node per process, 32 by default.
+        POOL_TIMEOUT: seconds to wait for a free connection, 1 by default.
+        RETRIES: retries of a call failed with a connection error or a timeout, 1 by default.
+        RETRY_DELAY: delay of the first retry in seconds, growing with every next one, 0.01 by default.
+        FAILURE_THRESHOLD: consecutive failures opening the circuit breaker of a node, 3 by default.
+        RETRY_TIMEOUT: seconds before a node with the open circuit breaker is tried again, 5 by default.
+        MIN_COMPRESS_LEN: values longer than that are compressed with zlib, 0 (never) by default.
+    """
+
+    def __init__(self, server, params):
+        super().__init__(params)
+        self._servers = re.split('[;,]', server) if isinstance(server, str) else list(server)
+        options = params.get('OPTIONS') or {}
+        self.replicas = options.get('REPLICAS', 1)
+        self.min_compress_len = options.get('MIN_COMPRESS_LEN', 0)
+        self.metrics = OperationMetrics()
+        self.nodes = {}
+        for location in self._servers:
+            self.nodes[location] = NodeClient(
+                location,
+                connect_timeout=options.get('CONNECT_TIMEOUT', 1.0),
+                read_timeout=options.get('READ_TIMEOUT', 1.0),
+                max_connections=options.get('MAX_CONNECTIONS', 32),
+                pool_timeout=options.get('POOL_TIMEOUT', 1.0),
+                retries=options.get('RETRIES', 1),
+                retry_delay=options.get('RETRY_DELAY', 0.01),
+                failure_threshold=options.get('FAILURE_THRESHOLD', 3),
+                retry_timeout=options.get('RETRY_TIMEOUT', 5.0),
+            )
+        self.ring = HashRing({location: node.weight for location, node in self.nodes.items()})
+
+    @property
+    def client_servers(self) -> list[str]:
+        return self._servers
+
+    def get_backend_timeout(self, timeout=DEFAULT_TIMEOUT) -> int:
+        """
+        Memcached takes 0 for no expiration and timeouts over 30 days for Unix timestamps.
+        """
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return 0
+        if int(timeout) == 0:
+            return -1
+        if timeout > 60 * 60 * 24 * 30:
+            timeout += int(time.time())
+        return int(timeout)
+
+    def validate_key(self, key):
+        for warning in memcache_key_warnings(key):
+            raise InvalidCacheKey(warning)
+
+    def get_nodes(self, key: bytes) -> list[NodeClient]:
+        """
+        Returns the replicas of the key, the available ones first.
+        """
+        if len(self.nodes) == 1:
+            return list(self.nodes.values())
+        nodes = [self.nodes[location] for location in self.ring.get_nodes(key, self.replicas)]
+        if len(nodes) == 1 or all(node.available() for node in nodes):
+            return nodes
+        return sorted(nodes, key=lambda node: not node.available())
+
+    def health(self) -> dict:
+        return {location: node.health() for location, node in self.nodes.items()}
+
+    def encode_key(self, key, version=None) -> bytes:
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key.encode()
+
+    def store(self, command: bytes, key: bytes, value, timeout) -> bool:
+        flags, data = encode_value(value, self.min_compress_len)
+        exptime = self.get_backend_timeout(timeout)
+        stored = False
+        for node in self.get_nodes(key):
+            try:
+                stored = node.store(command, key, flags, exptime, data) or stored
+            except MemcachedError as e:
+                logger.warning('Cache %s of %r failed: %s', command.decode(), key, e)
+        return stored
+
+    @measured
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.encode_key(key, version)
+        flags, data = encode_value(value, self.min_compress_len)
+        exptime = self.get_backend_timeout(timeout)
+        nodes = self.get_nodes(key)
+        # The first reachable replica decides whether the key is new, the others get a copy unless they have the key.
+        for i, node in enumerate(nodes):
+            try:
+                if not node.store(b'add', key, flags, exptime, data):
+                    return False
+            except MemcachedError as e:
+                logger.warning('Cache add of %r failed: %s', key, e)
+                continue
+            for replica in nodes[i + 1:]:
+                try:
+                    replica.store(b'add', key, flags, exptime, data)
+                except MemcachedError as e:
+                    logger.warning('Cache add of %r failed: %s', key, e)
+            return True
+        return False
+
+    @measured
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.encode_key(key, version)
+        if not self.store(b'set', key, value, timeout):
+            # Make sure the key does not keep its old value if it could not be set.
+            self.delete_keys([key])
+
+    @measured
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.encode_key(key, version)
+        exptime = self.get_backend_timeout(timeout)
+        touched = False
+        for node in self.get_nodes(key):
+            try:
+                touched = node.touch(key, exptime) or touched
+            except MemcachedError as e:
+                logger.warning('Cache touch of %r failed: %s', key, e)
+        return touched
+
+    @measured
+    def get(self, key, default=None, version=None):
+        key = self.encode_key(key, version)
+        for node in self.get_nodes(key):
+            try:
+                values = node.get_many([key])
+            except MemcachedError as e:
+                logger.warning('Cache get from %s failed: %s', node.server, e)
+                continue
+            if key in values:
+                return decode_value(*values[key])
+        return default
+
+    @measured
+    def get_many(self, keys, version=None):
+        key_map = {self.encode_key(key, version): key for key in keys}
+        return {key_map[key]: value for key, value in self.get_keys(list(key_map)).items()}
+
+    def get_keys(self, keys: list[bytes]) -> dict:
+        """
+        Gets the keys with a multi-get per node. Keys of a failed node, or missing on it, are asked from their next
+        replica.
+        """
+        pending = {key: self.get_nodes(key) for key in keys}
+        found = {}
+        while pending:
+            by_node = {}
+            for key, nodes in pending.items():
+                by_node.setdefault(nodes[0], []).append(key)
+            retry = {}
+            for node, node_keys in by_node.items():
+                try:
+                    values = node.get_many(node_keys)
+                except MemcachedError as e:
+                    logger.warning('Cache get from %s failed: %s', node.server, e)
+                    values = {}
+                for key in node_keys:
+                    if key in values:
+                        found[key] = decode_value(*values[key])
+                    elif len(pending[key]) > 1:
+                        retry[key] = pending[key][1:]
+            pending = retry
+        return found
+
+    @measured
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        exptime = self.get_backend_timeout(timeout)
+        by_node = {}
+        for key, value in data.items():
+            encoded_key = self.encode_key(key, version)
+            flags, encoded_value = encode_value(value, self.min_compress_len)
+            for node in self.get_nodes(encoded_key):
+                by_node.setdefault(node, []).append((key, (encoded_key, flags, exptime, encoded_value)))
+        stored = set()
+        for node, items in by_node.items():
+            try:
+                results = node.store_many(b'set', [item for _, item in items])
+            except MemcachedError as e:
+                logger.warning('Cache set of %d keys on %s failed: %s', len(items), node.server, e)
+                continue
+            stored.update(key for (key, _), result in zip(items, results) if result)
+        return [key for key in data if key not in stored]
+
+    @measured
+    def add_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Adds the keys that do not exist yet with pipelined `add` commands, one round trip to a node. \\
+        As in `add`, the first reachable replica decides whether a key is new and the others get a copy unless they
+        have the key.
+        Returns the keys that were not added.
+        """
+        exptime = self.get_backend_timeout(timeout)
+        pending = {}
+        for key, value in data.items():
+            encoded_key = self.encode_key(key, version)
+            flags, encoded_value = encode_value(value, self.min_compress_len)
+            pending[key] = ((encoded_key, flags, exptime, encoded_value), self.get_nodes(encoded_key))
+        added = {}
+        while pending:
+            by_node = {}
+            for key, (_, nodes) in pending.items():
+                by_node.setdefault(nodes[0], []).append(key)
+            failed_over = {}
+            for node, keys in by_node.items():
+                try:
+                    results = node.store_many(b'add', [pending[key][0] for key in keys])
+                except MemcachedError as e:
+                    logger.warning('Cache add of %d keys on %s failed: %s', len(keys), node.server, e)
+                    failed_over.update((key, (pending[key][0], pending[key][1][1:]))
+                                       for key in keys if len(pending[key][1]) > 1)
+                    continue
+                added.update((key, pending[key]) for key, result in zip(keys, results) if result)
+            pending = failed_over
+        copies = {}
+        for item, nodes in added.values():
+            for replica in nodes[1:]:
+                copies.setdefault(replica, []).append(item)
+        for node, items in copies.items():
+            try:
+                node.store_many(b'add', items)
+            except MemcachedError as e:
+                logger.warning('Cache add of %d keys on %s failed: %s', len(items), node.server, e)
+        return [key for key in data if key not in added]
+
+    @measured
+    def delete(self, key, version=None):
+        return self.delete_keys([self.encode_key(key, version)])
+
+    @measured
+    def delete_many(self, keys, version=None):
+        self.delete_keys([self.encode_key(key, version) for key in keys])
+
+    def delete_keys(self, keys: list[bytes]) -> bool:
+        by_node = {}
+        for key in keys:
+            for node in self.get_nodes(key):
+                by_node.setdefault(node, []).append(key)
+        deleted = False
+        for node, node_keys in by_node.items():
+            try:
+                deleted = any(node.delete_many(node_keys)) or deleted
+            except MemcachedError as e:
+                logger.warning('Cache delete of %d keys on %s failed: %s', len(node_keys), node.server, e)
+        return deleted
+
+    @measured
+    def incr(self, key, delta=1, version=None):
+        return self.change(key, delta, version)
+
+    @measured
+    def decr(self, key, delta=1, version=None):
+        return self.change(key, -delta, version)
+
+    def change(self, key, delta: int, version=None) -> int:
+        encoded_key = self.encode_key(key, version)
+        command = b'incr' if delta >= 0 else b'decr'
+        nodes = self.get_nodes(encoded_key)
+        for i, node in enumerate(nodes):
+            try:
+                value = node.incr(command, encoded_key, abs(delta))
+                if value is None and self.restore_counter(encoded_key, node, nodes[i + 1:]):
+                    value = node.incr(command, encoded_key, abs(delta))
+            except MemcachedError as e:
+                logger.warning('Cache %s of %r failed: %s', command.decode(), encoded_key, e)
+                continue
+            if value is None:
+                raise ValueError("Key '%s' not found" % key)
+            # The other replicas are changed by the same delta, so they keep their expiration time and never go
+            # back. A later replica without the key (it missed the `add` or restarted) is left without it.
+            for replica in nodes[i + 1:]:
+                try:
+                    replica.incr(command, encoded_key, abs(delta))
+                except MemcachedError as e:
+                    logger.warning('Cache %s of %r failed: %s', command.decode(), encoded_key, e)
+            return value
+        raise ValueError("Key '%s' not found" % key)
+
+    def restore_counter(self, key: bytes, node: NodeClient, replicas: list[NodeClient]) -> bool:
+        """
+        Copies the counter that `node` lost, because it restarted or evicted it, from the first of the `replicas`
+        having it, so that the counter is changed on `node` first again. \\
+        The expiration time of the counter is not known: the copy expires after the default timeout and is copied
+        again then. Returns `False` if none of the replicas has the counter.
+        """
+        for replica in replicas:
+            try:
+                # Incrementing by 0 reads the counter atomically.
+                value = replica.incr(b'incr', key, 0)
+            except MemcachedError as e:
+                logger.warning('Cache incr of %r failed: %s', key, e)
+                continue
+            if value is None:
+                continue
+            flags, data = encode_value(value, self.min_compress_len)
+            # The counter is not overwritten if another request restored it first.
+            node.store(b'add', key, flags, self.get_backend_timeout(), data)
+            logger.warning('Cache counter %r was restored on %s from %s', key, node.server, replica.server)
+            return True
+        return False
+
+    def clear(self):
+        for node in self.nodes.values():
+            try:
+                node.flush_all()
+            except MemcachedError as e:
+                logger.warning('Cache flush of %s failed: %s', node.server, e)
+
+    def close(self, **kwargs):
+        # Connections are kept in the pools between requests.
+        pass
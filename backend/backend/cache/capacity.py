@@ -0,0 +1,142 @@
+"""
+Capacity of the memcached nodes, see the `cache_capacity` command and endpoint. \\
+Registrations are stored without expiration, so a node that runs out of memory evicts live ones and they are
+served from the durable store or lost. `CapacityMonitor` polls `stats` and `stats slabs` of every node and compares
+them to the previous poll: how full the node is, how fast it evicts, how many items a second are written to it
+and when it will be full at that rate. It warns while there is still time, before the first eviction.
+"""
+import logging
+import time
+
+from typing import Union
+
+from backend.cache.protocol import MemcachedError
+
+logger = logging.getLogger('django')
+
+OK = 'ok'
+WARNING = 'warning'
+EVICTING = 'evicting'
+UNAVAILABLE = 'unavailable'
+# The worst status of the nodes is the status of the cache.
+STATUS_ORDER = [OK, WARNING, EVICTING, UNAVAILABLE]
+
+
+def node_sample(stats: dict, slabs: dict) -> dict:
+    """
+    Returns the numbers of `stats` and `stats slabs` of a node used by `assess`.
+    """
+    used_chunks = sum(int(value) for name, value in slabs.items() if name.endswith(':used_chunks'))
+    slab_bytes = sum(
+        int(value) * int(slabs.get(name[:-len('chunk_size')] + 'used_chunks', 0))
+        for name, value in slabs.items() if name.endswith(':chunk_size')
+    )
+    return {
+        'polled': time.monotonic(),
+        'uptime': int(stats['uptime']),
+        'bytes': int(stats['bytes']),
+        'limit_maxbytes': int(stats['limit_maxbytes']),
+        'curr_items': int(stats['curr_items']),
+        'total_items': int(stats['total_items']),
+        'evictions': int(stats['evictions']),
+        # Items take whole chunks of their slab class, so the memory of an item is the size of its chunk.
+        'chunk_bytes': slab_bytes if used_chunks else int(stats['bytes']),
+        'chunks': used_chunks or int(stats['curr_items']),
+    }
+
+
+def poll(cache) -> dict:
+    """
+    Returns the samples of all nodes of the cache by their location, `None` for the ones that did not answer.
+    """
+    samples = {}
+    nodes = getattr(cache, 'nodes', None)
+    if nodes is not None:
+        for location, node in nodes.items():
+            try:
+                samples[location] = node_sample(node.stats(), node.stats(b'slabs'))
+            except MemcachedError as e:
+                logger.warning('Cache stats of %s failed: %s', location, e)
+                samples[location] = None
+        return samples
+    # `python-memcached` names a server `host:port (weight)` and leaves out the ones that did not answer.
+    client = cache._cache
+    slabs = {server.split(' ')[0]: stats for server, stats in client.get_stats('slabs')}
+    for server, stats in client.get_stats():
+        location = server.split(' ')[0]
+        samples[location] = node_sample(stats, slabs.get(location, {}))
+    for location in cache.client_servers:
+        samples.setdefault(location, None)
+    return samples
+
+
+def assess(current: Union[dict, None], previous: Union[dict, None], warn_fill_ratio: float,
+           warn_seconds_to_full: float) -> dict:
+    """
+    Returns the capacity report of a node from its current and previous samples. \\
+    Rates are computed since the previous sample, or since the node started without one or after a restart.
+    """
+    if current is None:
+        return {'status': UNAVAILABLE, 'warnings': ['The node did not answer']}
+    if previous is None or current['uptime'] < previous['uptime'] or current['total_items'] < previous['total_items']:
+        previous = {'polled': current['polled'] - current['uptime'], 'total_items': 0, 'evictions': 0}
+    elapsed = max(current['polled'] - previous['polled'], 1e-3)
+    eviction_rate = (current['evictions'] - previous['evictions']) / elapsed
+    write_rate = (current['total_items'] - previous['total_items']) / elapsed
+    average_item_size = current['chunk_bytes'] / current['chunks'] if current['chunks'] else None
+    limit = current['limit_maxbytes']
+    used = max(current['bytes'], current['chunk_bytes'])
+    seconds_to_full = None
+    if write_rate > 0 and average_item_size:
+        seconds_to_full = max(limit - used, 0) / (write_rate * average_item_size)
+    report = {
+        'bytes': current['bytes'],
+        'limit_maxbytes': limit,
+        'items': current['curr_items'],
+        'fill_ratio': used / limit if limit else 1.0,
+        'evictions': current['evictions'],
+        'eviction_rate': eviction_rate,
+        'write_rate': write_rate,
+        'average_item_size': average_item_size,
+        'seconds_to_full': seconds_to_full,
+        'status': OK,
+        'warnings': [],
+    }
+    if eviction_rate > 0:
+        report['status'] = EVICTING
+        report['warnings'].append('Evicting %.2f items a second' % eviction_rate)
+    elif current['evictions']:
+        report['status'] = WARNING
+        report['warnings'].append('Evicted %d items since the start' % current['evictions'])
+    if report['fill_ratio'] >= warn_fill_ratio:
+        report['warnings'].append('%.0f%% full' % (report['fill_ratio'] * 100))
+    if seconds_to_full is not None and seconds_to_full < warn_seconds_to_full:
+        report['warnings'].append('Full in %.0f hours at %.2f items a second' % (seconds_to_full / 3600, write_rate))
+    if report['warnings'] and report['status'] == OK:
+        report['status'] = WARNING
+    return report
+
+
+class CapacityMonitor:
+    """
+    Keeps the previous samples of the nodes, so every check reports the rates since the last one.
+    """
+
+    def __init__(self):
+        self.previous = {}
+
+    def check(self, cache, warn_fill_ratio: float, warn_seconds_to_full: float) -> dict:
+        """
+        Polls the nodes of the cache and returns `{'status': ..., 'nodes': {location: report}}`,
+        logging the warnings of every node.
+        """
+        samples = poll(cache)
+        nodes = {}
+        for location, sample in samples.items():
+            nodes[location] = assess(sample, self.previous.get(location), warn_fill_ratio, warn_seconds_to_full)
+            if sample is not None:
+                self.previous[location] = sample
+            for warning in nodes[location]['warnings']:
+                logger.warning('Cache capacity of %s: %s', location, warning)
+        status = max((report['status'] for report in nodes.values()), key=STATUS_ORDER.index, default=OK)
+        return {'status': status, 'nodes': nodes}
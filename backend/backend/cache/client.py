@@ -0,0 +1,280 @@
+import os
+import socket
+import threading
+import time
+
+from backend.cache.protocol import MemcachedError, parse_server
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class NodeUnavailable(MemcachedError):
+    """
+    The node is not reachable or its circuit breaker is open.
+    """
+
+
+class PoolExhausted(MemcachedError):
+    """
+    No connection to the node got free in time.
+    """
+
+
+class Connection:
+    """
+    A socket to a memcached node with a buffered reader.
+    """
+
+    def __init__(self, host: str, port: int, connect_timeout: float, read_timeout: float):
+        self.sock = socket.create_connection((host, port), connect_timeout)
+        self.sock.settimeout(read_timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile('rb')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class NodeClient:
+    """
+    Blocking client of one memcached node with a thread-safe connection pool and a circuit breaker. \\
+    Up to `max_connections` connections are open at a time; a thread waits `pool_timeout` seconds for a free one.
+    A connection error or a timeout is retried `retries` times with a growing delay of `retry_delay` seconds,
+    commands that change a value depending on the stored one (`add`, `incr`, `decr`) only if they were not sent.
+    After `failure_threshold` consecutive failed calls the breaker opens and calls fail immediately.
+    After `retry_timeout` seconds one call is let through: its success closes the breaker,
+    its failure opens it again.
+    """
+
+    def __init__(self, server: str, connect_timeout: float = 1.0, read_timeout: float = 1.0,
+                 max_connections: int = 32, pool_timeout: float = 1.0, retries: int = 1, retry_delay: float = 0.01,
+                 failure_threshold: int = 3, retry_timeout: float = 5.0):
+        self.server = server
+        self.host, self.port, self.weight = parse_server(server)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_timeout = pool_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.failure_threshold = failure_threshold
+        self.retry_timeout = retry_timeout
+        self.max_connections = max_connections
+        self.idle = []
+        self.open = 0
+        self.waiting = 0
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.pid = os.getpid()
+
+    def available(self) -> bool:
+        """
+        Tells whether a call to the node would be let through now.
+        """
+        state = self.state
+        return state == CLOSED or state == OPEN and self.retry_due()
+
+    def retry_due(self) -> bool:
+        return time.monotonic() - self.opened_at >= self.retry_timeout
+
+    def admit(self) -> bool:
+        """
+        Lets a call through the circuit breaker. A due retry of an open breaker makes it half-open,
+        and other calls are refused until the retry succeeds or fails.
+        """
+        if self.state == CLOSED:
+            return True
+        with self.lock:
+            if self.state == OPEN and self.retry_due():
+                self.state = HALF_OPEN
+                return True
+            return self.state == CLOSED
+
+    def record_success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def health(self) -> dict:
+        with self.lock:
+            return {'state': self.state, 'failures': self.failures, 'idle_connections': len(self.idle)}
+
+    def acquire(self) -> Connection:
+        with self.lock:
+            if self.pid != os.getpid():
+                # Connections inherited from the parent process are shared with it, they must not be used.
+                self.idle = []
+                self.open = 0
+                self.pid = os.getpid()
+            deadline = None
+            while not self.idle and self.open >= self.max_connections:
+                if deadline is None:
+                    deadline = time.monotonic() + self.pool_timeout
+                remaining = deadline - time.monotonic()
+                self.waiting += 1
+                try:
+                    if remaining <= 0 or not self.released.wait(remaining):
+                        raise PoolExhausted('%s: no free connection in %s seconds' % (self.server, self.pool_timeout))
+                finally:
+                    self.waiting -= 1
+            if self.idle:
+                return self.idle.pop()
+            self.open += 1
+        try:
+            return Connection(self.host, self.port, self.connect_timeout, self.read_timeout)
+        except BaseException:
+            self.release(None, reuse=False)
+            raise
+
+    def release(self, connection: Connection, reuse: bool = True):
+        with self.lock:
+            if reuse:
+                self.idle.append(connection)
+            else:
+                self.open -= 1
+            if self.waiting:
+                self.released.notify()
+        if not reuse and connection is not None:
+            connection.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.open -= len(idle)
+        for connection in idle:
+            connection.close()
+
+    def call(self, command: bytes, read_response, idempotent: bool = True):
+        """
+        Sends the command, possibly several pipelined ones, and reads the response with `read_response(file)`. \\
+        Connection errors and timeouts are retried, counted by the circuit breaker and raised as `NodeUnavailable`.
+        """
+        if not self.admit():
+            raise NodeUnavailable('%s is unavailable' % self.server)
+        attempt = 0
+        while True:
+            sent = False
+            connection = None
+            try:
+                connection = self.acquire()
+                connection.sock.sendall(command)
+                sent = True
+                result = read_response(connection.file)
+            except PoolExhausted:
+                raise
+            except MemcachedError:
+                # The node answered, but the rest of the response cannot be trusted.
+                if connection is not None:
+                    self.release(connection, reuse=False)
+                self.record_success()
+                raise
+            except (OSError, EOFError) as e:
+                if connection is not None:
+                    self.release(connection, reuse=False)
+                if attempt < self.retries and (idempotent or not sent):
+                    attempt += 1
+                    time.sleep(self.retry_delay * attempt)
+                    continue
+                self.record_failure()
+                raise NodeUnavailable('%s: %s' % (self.server, e)) from e
+            self.release(connection)
+            self.record_success()
+            return result
+
+    def get_many(self, keys: list[bytes]) -> dict:
+        """
+        Returns `(flags, data)` of the found keys.
+        """
+        return self.call(b'get ' + b' '.join(keys) + b'\r\n', read_values)
+
+    def store(self, command: bytes, key: bytes, flags: int, exptime: int, data: bytes) -> bool:
+        request = b'%s %s %d %d %d\r\n%s\r\n' % (command, key, flags, exptime, len(data), data)
+        return self.call(request, read_status, idempotent=command != b'add') == b'STORED'
+
+    def store_many(self, command: bytes, items: list[tuple[bytes, int, int, bytes]]) -> list[bool]:
+        """
+        Stores `(key, flags, exptime, data)` items with pipelined commands in one round trip.
+        """
+        request = b''.join(b'%s %s %d %d %d\r\n%s\r\n' % (command, key, flags, exptime, len(data), data)
+                           for key, flags, exptime, data in items)
+        statuses = self.call(request, lambda file: [read_status(file) for _ in items], idempotent=command != b'add')
+        return [status == b'STORED' for status in statuses]
+
+    def delete(self, key: bytes) -> bool:
+        return self.delete_many([key])[0]
+
+    def delete_many(self, keys: list[bytes]) -> list[bool]:
+        request = b''.join(b'delete %s\r\n' % key for key in keys)
+        statuses = self.call(request, lambda file: [read_status(file) for _ in keys])
+        return [status == b'DELETED' for status in statuses]
+
+    def touch(self, key: bytes, exptime: int) -> bool:
+        return self.call(b'touch %s %d\r\n' % (key, exptime), read_status) == b'TOUCHED'
+
+    def incr(self, command: bytes, key: bytes, delta: int):
+        """
+        Returns the new value or `None` if the key is not found.
+        """
+        status = self.call(b'%s %s %d\r\n' % (command, key, delta), read_status, idempotent=False)
+        return None if status == b'NOT_FOUND' else int(status)
+
+    def flush_all(self):
+        self.call(b'flush_all\r\n', read_status)
+
+    def stats(self, group: bytes = b'') -> dict:
+        return self.call(b'stats %s\r\n' % group if group else b'stats\r\n', read_stats)
+
+
+def read_line(file) -> bytes:
+    line = file.readline()
+    if not line.endswith(b'\r\n'):
+        raise EOFError('Connection closed')
+    return line[:-2]
+
+
+def read_values(file) -> dict:
+    values = {}
+    while True:
+        line = read_line(file)
+        if line == b'END':
+            return values
+        if not line.startswith(b'VALUE '):
+            raise MemcachedError(line.decode(errors='replace'))
+        _, key, flags, length = line.split()[:4]
+        data = file.read(int(length) + 2)
+        if len(data) != int(length) + 2:
+            raise EOFError('Connection closed')
+        values[key] = (int(flags), data[:-2])
+
+
+def read_status(file) -> bytes:
+    line = read_line(file)
+    if line.startswith((b'ERROR', b'CLIENT_ERROR', b'SERVER_ERROR')):
+        raise MemcachedError(line.decode(errors='replace'))
+    return line
+
+
+def read_stats(file) -> dict:
+    stats = {}
+    while True:
+        line = read_line(file)
+        if line == b'END':
+            return stats
+        if not line.startswith(b'STAT '):
+            raise MemcachedError(line.decode(errors='replace'))
+        _, name, value = line.split(b' ', 2)
+        stats[name.decode()] = value.decode()
@@ -0,0 +1,97 @@
+import bisect
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Upper bounds of the latency buckets in seconds.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'),
+)
+
+
+class OperationMetrics:
+    """
+    Thread-safe counters and latency histograms of cache operations. \\
+    Percentiles are estimated by the upper bounds of the buckets, like Prometheus histograms do.
+    The latency of all operations is also summed in windows of `window` seconds for `recent_latency`.
+    """
+
+    def __init__(self, window: float = 1.0):
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.window = window
+        self.window_started = time.monotonic()
+        # Count and sum of the latency in the current and in the previous window.
+        self.current = [0, 0.0]
+        self.previous = [0, 0.0]
+
+    def roll_window(self, now: float):
+        elapsed = now - self.window_started
+        if elapsed >= self.window:
+            self.previous = self.current if elapsed < 2 * self.window else [0, 0.0]
+            self.current = [0, 0.0]
+            self.window_started = now - elapsed % self.window
+
+    def observe(self, operation: str, seconds: float, error: bool = False):
+        with self.lock:
+            metrics = self.operations.get(operation)
+            if metrics is None:
+                metrics = self.operations[operation] = {
+                    'count': 0, 'errors': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS),
+                }
+            metrics['count'] += 1
+            metrics['errors'] += error
+            metrics['sum'] += seconds
+            metrics['max'] = max(metrics['max'], seconds)
+            metrics['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.roll_window(time.monotonic())
+            self.current[0] += 1
+            self.current[1] += seconds
+
+    def recent_latency(self) -> float:
+        """
+        Returns the mean latency of the operations in the current and the previous window, 0 without operations.
+        """
+        with self.lock:
+            self.roll_window(time.monotonic())
+            count = self.current[0] + self.previous[0]
+            return (self.current[1] + self.previous[1]) / count if count else 0.0
+
+    @contextmanager
+    def measure(self, operation: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(operation, time.perf_counter() - started, error=True)
+            raise
+        self.observe(operation, time.perf_counter() - started)
+
+    def snapshot(self) -> dict:
+        """
+        Returns the counters, the histogram and the p50/p99 estimates of every operation.
+        """
+        with self.lock:
+            snapshot = {operation: dict(metrics, buckets=list(metrics['buckets']))
+                        for operation, metrics in self.operations.items()}
+        for metrics in snapshot.values():
+            metrics['p50'] = percentile(metrics, 0.5)
+            metrics['p99'] = percentile(metrics, 0.99)
+        return snapshot
+
+    def reset(self):
+        with self.lock:
+            self.operations.clear()
+            self.current = [0, 0.0]
+            self.previous = [0, 0.0]
+
+
+def percentile(metrics: dict, q: float) -> float:
+    rank = q * metrics['count']
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, metrics['buckets']):
+        seen += count
+        if count and seen >= rank:
+            return min(bound, metrics['max'])
+    return metrics['max']
@@ -0,0 +1,79 @@
+import binascii
+import pickle
+import zlib
+
+
+class MemcachedError(Exception):
+    """
+    Error of the memcached server or of the connection to it.
+    """
+
+
+# Value flags used by `python-memcached`, so that every client of the project reads what the others have written.
+FLAG_PICKLE = 1 << 0
+FLAG_INTEGER = 1 << 1
+FLAG_LONG = 1 << 2
+FLAG_COMPRESSED = 1 << 3
+FLAG_TEXT = 1 << 4
+
+
+def server_hash(key: bytes) -> int:
+    """
+    Hash function used by `python-memcached` to choose a server for the key.
+    """
+    return ((binascii.crc32(key) & 0xffffffff) >> 16) & 0x7fff
+
+
+def encode_value(value, min_compress_len: int = 0) -> tuple[int, bytes]:
+    """
+    Transforms the value to memcached flags and bytes the same way as `python-memcached` does.
+    """
+    flags = 0
+    value_type = type(value)
+    if value_type == bytes:
+        pass
+    elif value_type == str:
+        flags |= FLAG_TEXT
+        value = value.encode('utf-8')
+    elif value_type == int:
+        flags |= FLAG_INTEGER
+        value = ('%d' % value).encode('ascii')
+        min_compress_len = 0
+    else:
+        flags |= FLAG_PICKLE
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if min_compress_len and len(value) > min_compress_len:
+        compressed = zlib.compress(value)
+        if len(compressed) < len(value):
+            flags |= FLAG_COMPRESSED
+            value = compressed
+    return flags, value
+
+
+def decode_value(flags: int, data: bytes):
+    """
+    Restores the value stored with the given memcached flags.
+    """
+    if flags & FLAG_COMPRESSED:
+        data = zlib.decompress(data)
+        flags &= ~FLAG_COMPRESSED
+    if flags == 0:
+        return data
+    if flags & FLAG_TEXT:
+        return data.decode('utf-8')
+    if flags & (FLAG_INTEGER | FLAG_LONG):
+        return int(data)
+    if flags & FLAG_PICKLE:
+        return pickle.loads(data)
+    raise ValueError('Unknown flags on get: %x' % flags)
+
+
+def parse_server(server: str) -> tuple[str, int, int]:
+    """
+    Parses the `host:port[:weight]` server location.
+    """
+    parts = server.split(':')
+    host = parts[0]
+    port = int(parts[1]) if len(parts) > 1 and parts[1] else 11211
+    weight = int(parts[2]) if len(parts) > 2 else 1
+    return host, port, weight
@@ -0,0 +1,55 @@
+import bisect
+import hashlib
+
+
+class HashRing:
+    """
+    Consistent hash ring of cache nodes in the manner of ketama. \\
+    Every node owns `points_per_node` points of the ring multiplied by its weight, and a key belongs to the node
+    of the first point clockwise from the hash of the key, so adding or removing a node moves only the keys
+    of its own points.
+    """
+
+    def __init__(self, nodes: dict, points_per_node: int = 160):
+        self.nodes = dict(nodes)
+        self.points = []
+        self.owners = []
+        ring = []
+        for node, weight in self.nodes.items():
+            # Every md5 digest gives four points of the ring.
+            for replica in range(points_per_node * weight // 4):
+                digest = hashlib.md5(('%s-%d' % (node, replica)).encode()).digest()
+                for i in range(4):
+                    ring.append((int.from_bytes(digest[i * 4:i * 4 + 4], 'little'), node))
+        ring.sort()
+        for point, node in ring:
+            self.points.append(point)
+            self.owners.append(node)
+
+    @staticmethod
+    def hash(key: bytes) -> int:
+        return int.from_bytes(hashlib.md5(key).digest()[:4], 'little')
+
+    def get_node(self, key: bytes):
+        """
+        Returns the node the key belongs to.
+        """
+        index = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.owners[index]
+
+    def get_nodes(self, key: bytes, count: int) -> list:
+        """
+        Returns up to `count` distinct nodes for the key, the owner of the key first and then the next ones clockwise.
+        """
+        count = min(count, len(self.nodes))
+        if count == 1:
+            return [self.get_node(key)]
+        index = bisect.bisect(self.points, self.hash(key))
+        nodes = []
+        for i in range(len(self.points)):
+            node = self.owners[(index + i) % len(self.points)]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
@@ -0,0 +1,47 @@
+"""
+JSON codec of the API requests and responses. \\
+It uses `orjson` when it is installed and `JSON_LIBRARY` is not `json`, otherwise the standard library.
+Both read the same data, but they write different bytes: `orjson` puts no spaces after separators
+and does not escape non-ASCII characters.
+
+Registration bodies are not encoded here: the digests of their bytes are stored with them, see `rest_api.storage`.
+"""
+from json import dumps as json_dumps, loads as json_loads
+from typing import Union
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+django_encoder = DjangoJSONEncoder()
+
+
+def stdlib_dumps(data) -> bytes:
+    return json_dumps(data, cls=DjangoJSONEncoder).encode()
+
+
+def orjson_dumps(data) -> bytes:
+    # Datetimes are formatted by `DjangoJSONEncoder`, like `JsonResponse` does.
+    return orjson.dumps(data, default=django_encoder.default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+if orjson is not None and settings.JSON_LIBRARY != 'json':
+    JSON_LIBRARY = 'orjson'
+    dumps = orjson_dumps
+    loads = orjson.loads
+else:
+    JSON_LIBRARY = 'json'
+    dumps = stdlib_dumps
+    loads = json_loads
+
+
+def json_response(data: Union[dict, list], status: int = 200) -> HttpResponse:
+    """
+    Returns the response with the data encoded to JSON, the replacement of `JsonResponse`.
+    """
+    return HttpResponse(dumps(data), content_type='application/json', status=status)
@@ -1,6 +1,18 @@
+import atexit
 import logging
+import os
+import queue
+import random
+import threading
+
+from datetime import datetime, timezone
+from json import dumps, loads
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
 
 from backend import get_current_request_id
+from backend.metrics import LOG_RECORDS_DROPPED, registry
 
 
 class RequestFilter(logging.Filter):
@@ -11,3 +23,121 @@ class RequestFilter(logging.Filter):
     def filter(self, record):
         record.x_correlation_id = get_current_request_id()
         return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a JSON object on one line, with the correlation ID of the request if it is set.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        x_correlation_id = getattr(record, 'x_correlation_id', None)
+        if x_correlation_id is not None:
+            entry['x_correlation_id'] = x_correlation_id
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return dumps(entry, ensure_ascii=False, default=str)
+
+
+class BackgroundStreamHandler(QueueHandler):
+    """
+    A stream handler that writes in a background thread. \\
+    The request thread only runs the filters and puts the record to a bounded queue; the message is formatted
+    and written by the thread of a `QueueListener`. When the queue is full, records are dropped and counted
+    rather than blocking the request.
+    """
+
+    def __init__(self, stream=None, queue_size: int = 10000):
+        super().__init__(queue.Queue(queue_size))
+        self.target = logging.StreamHandler(stream)
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        self.dropped = 0
+
+    def setFormatter(self, fmt):
+        # The record is formatted by the target in the background thread.
+        self.target.setFormatter(fmt)
+
+    def start(self):
+        # The listener is started lazily and again in a forked worker, where the thread of the parent does not exist.
+        with self.start_lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(self.queue.maxsize)
+                self.listener = QueueListener(self.queue, self.target)
+                self.listener.start()
+                self.pid = os.getpid()
+                atexit.register(self.stop)
+
+    def stop(self):
+        if self.pid == os.getpid():
+            self.listener.stop()
+            self.pid = None
+
+    def prepare(self, record):
+        # The arguments are kept as they are, so the message is built only when the record is written.
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            registry.inc(LOG_RECORDS_DROPPED)
+
+    def flush(self):
+        """
+        Waits until the queued records are written.
+        """
+        if self.pid == os.getpid():
+            self.queue.join()
+
+
+class Payload:
+    """
+    Registration data in a log record, rendered as JSON with the fields of `LOGGING_PAYLOADS["REDACT"]` hidden.
+    It is rendered only when the record is written.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        fields = frozenset(settings.LOGGING_PAYLOADS['REDACT'])
+        return dumps(redact(self.data, fields), ensure_ascii=False, default=str)
+
+
+def redact(value, fields: frozenset):
+    if isinstance(value, bytes):
+        # A response body.
+        value = loads(value)
+    if isinstance(value, dict):
+        return {name: '[REDACTED]' if name in fields else redact(item, fields) for name, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item, fields) for item in value]
+    if isinstance(value, str) and value.startswith('{'):
+        # `person` of the request body is a JSON string.
+        try:
+            return redact(loads(value), fields)
+        except ValueError:
+            return value
+    return value
+
+
+def log_payload(logger: logging.Logger, message: str, data):
+    """
+    Logs the registration data at INFO level for the `LOGGING_PAYLOADS["SAMPLE_RATE"]` share of the calls.
+    """
+    sample_rate = settings.LOGGING_PAYLOADS['SAMPLE_RATE']
+    if sample_rate > 0 and logger.isEnabledFor(logging.INFO) and (sample_rate >= 1 or random.random() < sample_rate):
+        logger.info(message, Payload(data))
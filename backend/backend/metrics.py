@@ -0,0 +1,317 @@
+"""
+Request metrics in the Prometheus text format. \\
+Counters and latency histograms are kept per process. With `METRICS["DIRECTORY"]` set, every worker process
+writes its metrics to `<directory>/<pid>.json` every `FLUSH_INTERVAL` seconds, and `/metrics` served by any worker
+sums the files of all of them, like the multiprocess mode of the Prometheus client. The files of stopped workers
+are kept, so the counters do not go back when a worker is restarted; the directory is emptied before the server
+starts.
+"""
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Union
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.views.decorators.http import require_http_methods
+
+from backend.cache.client import CLOSED, HALF_OPEN, OPEN
+from backend.cache.metrics import LATENCY_BUCKETS
+
+REQUEST_DURATION = 'registrations_request_duration_seconds'
+PHASE_DURATION = 'registrations_request_phase_duration_seconds'
+CACHE_LOOKUPS = 'registrations_cache_lookups_total'
+ID_ALLOCATION_RETRIES = 'registrations_id_allocation_retries_total'
+ADMISSION_REJECTIONS = 'registrations_admission_rejections_total'
+ID_FILTER_CHECKS = 'registrations_id_filter_checks_total'
+STORE_WRITE_FAILURES = 'registrations_store_write_failures_total'
+SECONDARY_WRITE_FAILURES = 'registrations_secondary_write_failures_total'
+ID_FILTER_ITEMS = 'registrations_id_filter_items'
+ID_FILTER_SIZE = 'registrations_id_filter_size_bytes'
+ID_FILTER_FALSE_POSITIVE_RATE = 'registrations_id_filter_false_positive_rate'
+LOCAL_CACHE_ENTRIES = 'registrations_local_cache_entries'
+LOCAL_CACHE_SIZE = 'registrations_local_cache_size_bytes'
+LOCAL_CACHE_REMOVALS = 'registrations_local_cache_removals_total'
+CACHE_OPERATION_DURATION = 'memcached_operation_duration_seconds'
+CACHE_OPERATION_ERRORS = 'memcached_operation_errors_total'
+CACHE_CIRCUIT_BREAKERS = 'memcached_circuit_breakers'
+LOG_RECORDS_DROPPED = 'log_records_dropped_total'
+
+HELP = {
+    REQUEST_DURATION: 'Duration of the requests by endpoint, method and status.',
+    PHASE_DURATION: 'Duration of the phases of the requests: parse, validate, cache_get, cache_set, serialize.',
+    CACHE_LOOKUPS: 'Registration lookups by cache level (local, memcached, store) and result (hit, miss).',
+    ID_ALLOCATION_RETRIES: 'Registration IDs generated again because the generated one was taken.',
+    ADMISSION_REJECTIONS: 'Requests rejected by admission control by reason (rate_limit, in_flight, cache_latency).',
+    STORE_WRITE_FAILURES: 'Registrations that failed to be written to the durable store by reason (error: the commit '
+                          'failed and is retried, rejected: the write queue was full and the request failed).',
+    SECONDARY_WRITE_FAILURES: 'Stored registrations whose later writes failed without failing the request, by step '
+                              '(persist, id_filter, id_index, email_index).',
+    ID_FILTER_CHECKS: 'Registration IDs checked in the ID filter by result (absent, present, false_positive).',
+    ID_FILTER_ITEMS: 'Registration IDs added to the ID filter.',
+    ID_FILTER_SIZE: 'Size of the ID filter file.',
+    ID_FILTER_FALSE_POSITIVE_RATE: 'False positive rate of the ID filter expected for the number of its IDs.',
+    LOCAL_CACHE_ENTRIES: 'Registrations in the L1 caches of the workers.',
+    LOCAL_CACHE_SIZE: 'Size of the registrations in the L1 caches of the workers.',
+    LOCAL_CACHE_REMOVALS: 'Registrations removed from the L1 caches by reason (eviction, expiration).',
+    CACHE_OPERATION_DURATION: 'Duration of the calls of the memcached backend by operation.',
+    CACHE_OPERATION_ERRORS: 'Failed calls of the memcached backend by operation.',
+    CACHE_CIRCUIT_BREAKERS: 'Circuit breakers of the memcached nodes in the workers by node and state '
+                            '(closed, open, half-open).',
+    LOG_RECORDS_DROPPED: 'Log records dropped because the queue of the log writer was full.',
+}
+
+# Durations of the phases of the current request, `None` outside of requests.
+request_timings = ContextVar('request_timings', default=None)
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and histograms of the process, keyed by the metric name and a tuple of label pairs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = []
+        self.collectors = []
+        self.pid = None
+
+    def inc(self, name: str, labels: tuple = (), amount: float = 1):
+        if self.pid != os.getpid():
+            self.start_flusher()
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, labels: tuple, seconds: float):
+        if self.pid != os.getpid():
+            self.start_flusher()
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0, 0.0, [0] * len(LATENCY_BUCKETS)]
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def add_gauges(self, callback):
+        """
+        Adds a function returning gauges as a dict of their `(name, labels)` keys to values. \\
+        Gauges are read when the metrics are collected, they show the state shared by all workers.
+        """
+        self.gauges.append(callback)
+
+    def add_collector(self, callback):
+        """
+        Adds a function returning metrics of the process as `{'counters': {key: value}, 'gauges': {key: value}}`. \\
+        They are read with the other metrics of the process and summed over the workers.
+        """
+        self.collectors.append(callback)
+
+    def start_flusher(self):
+        # The flusher is started lazily and again in a forked worker, where the thread of the parent does not exist
+        # and the metrics of the parent must not be counted twice.
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                self.counters.clear()
+                self.histograms.clear()
+            self.pid = os.getpid()
+        if settings.METRICS['DIRECTORY']:
+            threading.Thread(target=self.flush_loop, name='metrics-flusher', daemon=True).start()
+            atexit.register(self.flush)
+
+    def state(self) -> dict:
+        """
+        Returns the metrics of the process as JSON-serializable lists, together with the metrics
+        of the memcached backend and of the collectors.
+        """
+        with self.lock:
+            counters = [[name, labels, value] for (name, labels), value in self.counters.items()]
+            histograms = [[name, labels, count, total, list(buckets)]
+                          for (name, labels), (count, total, buckets) in self.histograms.items()]
+        gauges = []
+        cache = caches['default']
+        cache_metrics = getattr(cache, 'metrics', None)
+        if cache_metrics is not None:
+            for operation, metrics in cache_metrics.snapshot().items():
+                labels = (('operation', operation),)
+                histograms.append([CACHE_OPERATION_DURATION, labels, metrics['count'], metrics['sum'],
+                                   metrics['buckets']])
+                counters.append([CACHE_OPERATION_ERRORS, labels, metrics['errors']])
+        if hasattr(cache, 'health'):
+            for node, health in cache.health().items():
+                for state in (CLOSED, OPEN, HALF_OPEN):
+                    gauges.append([CACHE_CIRCUIT_BREAKERS, (('node', node), ('state', state)),
+                                   int(health['state'] == state)])
+        for callback in self.collectors:
+            collected = callback()
+            counters.extend([name, labels, value] for (name, labels), value in collected.get('counters', {}).items())
+            gauges.extend([name, labels, value] for (name, labels), value in collected.get('gauges', {}).items())
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def flush(self):
+        """
+        Writes the metrics of the process to its file in `METRICS["DIRECTORY"]`.
+        """
+        directory = settings.METRICS['DIRECTORY']
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, '%d.json' % os.getpid())
+        with open(path + '.tmp', 'w') as file:
+            json.dump(self.state(), file)
+        os.replace(path + '.tmp', path)
+
+    def flush_loop(self):
+        pid = os.getpid()
+        while pid == os.getpid():
+            time.sleep(settings.METRICS['FLUSH_INTERVAL'])
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def collect(self) -> dict:
+        """
+        Returns the metrics of all processes summed up and the gauges:
+        `{'counters': {key: value}, 'histograms': {key: ...}, 'gauges': {key: value}}`.
+        """
+        directory = settings.METRICS['DIRECTORY']
+        if directory:
+            self.flush()
+            states = []
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.json'):
+                    try:
+                        with open(os.path.join(directory, name)) as file:
+                            states.append(json.load(file))
+                    except (OSError, ValueError):
+                        continue
+        else:
+            states = [self.state()]
+        counters = {}
+        histograms = {}
+        gauges = {}
+        for state in states:
+            for name, labels, value in state['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, count, total, buckets in state['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                summed = histograms.setdefault(key, [0, 0.0, [0] * len(LATENCY_BUCKETS)])
+                summed[0] += count
+                summed[1] += total
+                summed[2] = [a + b for a, b in zip(summed[2], buckets)]
+            for name, labels, value in state.get('gauges', []):
+                key = (name, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + value
+        for callback in self.gauges:
+            gauges.update(callback())
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+registry = MetricsRegistry()
+
+
+def format_labels(labels: tuple, extra: Union[tuple, None] = None) -> str:
+    pairs = labels + (extra or ())
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in pairs)
+
+
+def render(collected: dict) -> str:
+    """
+    Renders the collected metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    gauges = collected.get('gauges', {})
+    names = sorted({name for name, _ in collected['counters']} | {name for name, _ in collected['histograms']}
+                   | {name for name, _ in gauges})
+    for name in names:
+        lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+        values = sorted((labels, value) for (gauge, labels), value in gauges.items() if gauge == name)
+        if values:
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in values:
+                lines.append('%s%s %s' % (name, format_labels(labels), repr(float(value))))
+            continue
+        counters = sorted((labels, value) for (counter, labels), value in collected['counters'].items()
+                          if counter == name)
+        if counters:
+            lines.append('# TYPE %s counter' % name)
+            for labels, value in counters:
+                lines.append('%s%s %s' % (name, format_labels(labels), repr(float(value))))
+            continue
+        lines.append('# TYPE %s histogram' % name)
+        histograms = sorted((labels, histogram) for (histogram_name, labels), histogram
+                            in collected['histograms'].items() if histogram_name == name)
+        for labels, (count, total, buckets) in histograms:
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, (('le', le),)), cumulative))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), repr(total)))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def timed(phase: str):
+    """
+    Adds the duration of the block to the phase of the current request.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = request_timings.get()
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - started
+
+
+def count_lookup(level: str, hit: bool):
+    registry.inc(CACHE_LOOKUPS, (('level', level), ('result', 'hit' if hit else 'miss')))
+
+
+def count_id_allocation_retries(count: int = 1):
+    registry.inc(ID_ALLOCATION_RETRIES, amount=count)
+
+
+def count_store_write_failures(reason: str, count: int):
+    registry.inc(STORE_WRITE_FAILURES, (('reason', reason),), count)
+
+
+def count_secondary_write_failures(step: str, count: int):
+    registry.inc(SECONDARY_WRITE_FAILURES, (('step', step),), count)
+
+
+def count_id_filter_check(result: str, count: int = 1):
+    registry.inc(ID_FILTER_CHECKS, (('result', result),), count)
+
+
+@require_http_methods(['GET'])
+def metrics(request):
+    """
+    Handler of the metrics of all worker processes in the Prometheus text format.
+    """
+    return HttpResponse(render(registry.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,18 +1,232 @@
+import asyncio
+import logging
+import time
 import uuid
 
+from typing import Union
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
 try:
     from django.utils.deprecation import MiddlewareMixin
 except ImportError:
     MiddlewareMixin = object
-from backend import local
+from backend import request_id
+from backend.admission import InFlight, SharedCounters, TokenBuckets, get_client, retry_after
+from backend.metrics import ADMISSION_REJECTIONS, PHASE_DURATION, REQUEST_DURATION, registry, request_timings
+from rest_api.errors import ApiException, encode_error, parse_content_length
+
+logger = logging.getLogger('django')
 
 
 class XCorrelationIDMiddleware(MiddlewareMixin):
     """
     A middleware made to track a request and the processes that occur during its processing.
     """
+    sync_capable = True
+    async_capable = True
 
     def process_request(self, request):
         if 'x-correlationid' not in request.META:
-            local.request_id = uuid.uuid4().hex
-            request.META['x-correlationid'] = local.request_id
+            request.META['x-correlationid'] = uuid.uuid4().hex
+            request_id.set(request.META['x-correlationid'])
+
+    async def __acall__(self, request):
+        # The request ID is set in the context of the request's task itself, without a hop to a thread.
+        self.process_request(request)
+        return await self.get_response(request)
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    A middleware recording the duration of a request and of its phases by endpoint, method and status. \\
+    With `METRICS["SERVER_TIMING"]`, the phases are also sent to the client in the `Server-Timing` header.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def process_request(self, request):
+        request.metrics_started = time.perf_counter()
+        request.metrics_timings = {}
+        request_timings.set(request.metrics_timings)
+
+    def process_response(self, request, response):
+        started = getattr(request, 'metrics_started', None)
+        if started is None:
+            return response
+        duration = time.perf_counter() - started
+        endpoint = request.resolver_match.url_name if request.resolver_match else 'unmatched'
+        registry.observe(REQUEST_DURATION, (
+            ('endpoint', endpoint), ('method', request.method), ('status', response.status_code),
+        ), duration)
+        for phase, seconds in request.metrics_timings.items():
+            registry.observe(PHASE_DURATION, (('endpoint', endpoint), ('phase', phase)), seconds)
+        if settings.METRICS['SERVER_TIMING']:
+            response['Server-Timing'] = ', '.join(
+                ['%s;dur=%.3f' % (phase, seconds * 1e3) for phase, seconds in request.metrics_timings.items()]
+                + ['total;dur=%.3f' % (duration * 1e3)]
+            )
+        return response
+
+    async def __acall__(self, request):
+        # The timings are set in the context of the request's task itself, so the views see them.
+        self.process_request(request)
+        return self.process_response(request, await self.get_response(request))
+
+
+class AdmissionControlMiddleware(MiddlewareMixin):
+    """
+    A middleware admitting a request only when its client is under the rate limit and the worker is not overloaded,
+    see `backend.admission`. \\
+    A request over the limit of its client gets 429. When the worker has `MAX_IN_FLIGHT` requests in progress
+    or the mean latency of the memcached calls of the last seconds exceeds `MAX_CACHE_LATENCY`, a request gets 503
+    at once rather than waiting in a queue until it times out. Both responses come with `Retry-After`.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        self.options = settings.ADMISSION_CONTROL
+        rate, burst = self.options['RATE'], self.options['BURST']
+        self.buckets = TokenBuckets(rate, burst, self.options['MAX_CLIENTS']) if rate > 0 else None
+        self.shared = SharedCounters(rate, burst) if rate > 0 and self.options['SHARED'] else None
+        self.in_flight = InFlight(self.options['MAX_IN_FLIGHT'])
+        self.cache_metrics = getattr(caches['default'], 'metrics', None)
+
+    def reject(self, request, reason: str, seconds: float) -> HttpResponse:
+        registry.inc(ADMISSION_REJECTIONS, (('reason', reason),))
+        if reason == 'rate_limit':
+            exception = ApiException(429, request.META.get('x-correlationid'), ApiException.ERROR_TOO_MANY_REQUESTS,
+                                     ApiException.ERROR_MESSAGE_TOO_MANY_REQUESTS)
+        else:
+            exception = ApiException(503, request.META.get('x-correlationid'), ApiException.ERROR_SERVICE_OVERLOADED,
+                                     ApiException.ERROR_MESSAGE_SERVICE_OVERLOADED)
+        response = exception.response
+        response['Retry-After'] = retry_after(seconds)
+        return response
+
+    def check(self, request) -> Union[HttpResponse, str, None]:
+        """
+        Makes the checks kept in the worker. Returns the response of a rejected request, otherwise the client
+        if the request is yet to be counted in memcached, `None` if it is admitted.
+        """
+        max_cache_latency = self.options['MAX_CACHE_LATENCY']
+        if max_cache_latency and self.cache_metrics is not None \
+           and self.cache_metrics.recent_latency() > max_cache_latency:
+            return self.reject(request, 'cache_latency', self.options['RETRY_AFTER'])
+        if self.buckets is None:
+            return None
+        client = get_client(request, self.options['CLIENT_HEADER'], self.options.get('TRUSTED_PROXIES', 1))
+        seconds = self.buckets.take(client, time.monotonic())
+        if seconds:
+            return self.reject(request, 'rate_limit', seconds)
+        return client if self.shared is not None else None
+
+    def shared_failed(self, e: Exception) -> float:
+        # The limit of the worker still holds when memcached fails.
+        logger.warning('The shared admission counters are unavailable: %s', e)
+        return 0.0
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if request.path in self.options['EXEMPT_PATHS']:
+            return self.get_response(request)
+        checked = self.check(request)
+        if isinstance(checked, str):
+            try:
+                seconds = self.shared.take(checked, time.time())
+            except Exception as e:
+                seconds = self.shared_failed(e)
+            checked = self.reject(request, 'rate_limit', seconds) if seconds else None
+        if checked is not None:
+            return checked
+        if not self.in_flight.enter():
+            return self.reject(request, 'in_flight', self.options['RETRY_AFTER'])
+        try:
+            return self.get_response(request)
+        finally:
+            self.in_flight.exit()
+
+    async def __acall__(self, request):
+        if request.path in self.options['EXEMPT_PATHS']:
+            return await self.get_response(request)
+        checked = self.check(request)
+        if isinstance(checked, str):
+            try:
+                seconds = await self.shared.atake(checked, time.time())
+            except Exception as e:
+                seconds = self.shared_failed(e)
+            checked = self.reject(request, 'rate_limit', seconds) if seconds else None
+        if checked is not None:
+            return checked
+        if not self.in_flight.enter():
+            return self.reject(request, 'in_flight', self.options['RETRY_AFTER'])
+        try:
+            return await self.get_response(request)
+        finally:
+            self.in_flight.exit()
+
+
+class BodySizeLimitMiddleware:
+    """
+    An ASGI middleware answering a request with a body over its limit with 413 before the body is received. \\
+    The ASGI handler of Django receives the whole body before the views can check its size. The limit of a path is
+    taken from `max_sizes`, other paths get `default_max_size`. A `Content-Length` over the limit is rejected at once,
+    a body without it (chunked) as soon as the received part is over the limit.
+    """
+
+    def __init__(self, application, max_sizes: dict, default_max_size: int):
+        self.application = application
+        self.max_sizes = max_sizes
+        self.default_max_size = default_max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.application(scope, receive, send)
+            return
+        max_size = self.max_sizes.get(scope['path'], self.default_max_size)
+        for name, value in scope['headers']:
+            if name == b'content-length':
+                # A malformed one is left to the views, which answer 400.
+                if (parse_content_length(value) or 0) > max_size:
+                    await self.reject(send, max_size)
+                    return
+                break
+        received = 0
+        rejected = False
+
+        async def receive_limited():
+            nonlocal received, rejected
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > max_size and not rejected:
+                    rejected = True
+                    await self.reject(send, max_size)
+                    # Django stops reading the request and sends no response.
+                    return {'type': 'http.disconnect'}
+            return message
+
+        async def send_unless_rejected(message):
+            if not rejected:
+                await send(message)
+
+        await self.application(scope, receive_limited, send_unless_rejected)
+
+    async def reject(self, send, max_size: int):
+        body = encode_error(ApiException.ERROR_PAYLOAD_TOO_LARGE,
+                            'The request body must not be longer than %d bytes' % max_size, None)
+        await send({
+            'type': 'http.response.start',
+            'status': 413,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+                (b'x-correlationid', uuid.uuid4().hex.encode()),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
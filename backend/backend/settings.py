@@ -5,6 +5,7 @@ from pathlib import Path
 config = ConfigParser()
 config['django'] = {
     'debug': getenv('DEBUG', '0'),
+    'async_views': getenv('REGISTRATIONS_ASYNC_VIEWS', '0'),
 }
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -36,6 +37,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Custom middleware measuring the whole request
+    'backend.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -45,6 +48,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     # Custom middleware
     'backend.middleware.XCorrelationIDMiddleware',
+    'backend.middleware.AdmissionControlMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -69,13 +73,123 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 
 DATABASES = {}
 
+# Comma separated `host:port[:weight]` memcached nodes. Several nodes are sharded by consistent hashing
+# and every key is kept on `CACHE_REPLICAS` of them.
+CACHE_LOCATIONS = getenv('CACHE_LOCATIONS', 'memcached:11211').split(',')
+
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
-        'LOCATION': 'memcached:11211',
+        'BACKEND': 'backend.cache.backends.ShardedMemcachedCache',
+        'LOCATION': CACHE_LOCATIONS,
+        'OPTIONS': {
+            'REPLICAS': int(getenv('CACHE_REPLICAS', '2')),
+            'CONNECT_TIMEOUT': float(getenv('CACHE_CONNECT_TIMEOUT', '0.5')),
+            'READ_TIMEOUT': float(getenv('CACHE_READ_TIMEOUT', '0.5')),
+            'MAX_CONNECTIONS': int(getenv('CACHE_MAX_CONNECTIONS', '32')),
+            'POOL_TIMEOUT': float(getenv('CACHE_POOL_TIMEOUT', '1')),
+            'RETRIES': int(getenv('CACHE_RETRIES', '1')),
+            'FAILURE_THRESHOLD': int(getenv('CACHE_FAILURE_THRESHOLD', '3')),
+            'RETRY_TIMEOUT': float(getenv('CACHE_RETRY_TIMEOUT', '5')),
+        },
+        'ASYNC_OPTIONS': {
+            'MAX_CONNECTIONS': int(getenv('CACHE_ASYNC_MAX_CONNECTIONS', '100')),
+            'TIMEOUT': float(getenv('CACHE_ASYNC_TIMEOUT', '3')),
+        },
     }
 }
 
+# Capacity checks of the memcached nodes, see `backend.cache.capacity`: a node warns when it has evicted items,
+# when it is `WARN_FILL_RATIO` full or when it will be full in less than `WARN_SECONDS_TO_FULL` seconds at its
+# current write rate. The size of registrations is averaged over the last `SAMPLE_SIZE` indexed ones.
+# `/internal/cache-capacity` is served only to requests with `Authorization: Bearer <ENDPOINT_TOKEN>`, and to none
+# while the token is empty.
+CACHE_CAPACITY = {
+    'WARN_FILL_RATIO': float(getenv('CACHE_CAPACITY_WARN_FILL_RATIO', '0.8')),
+    'WARN_SECONDS_TO_FULL': float(getenv('CACHE_CAPACITY_WARN_SECONDS_TO_FULL', str(7 * 24 * 60 * 60))),
+    'SAMPLE_SIZE': int(getenv('CACHE_CAPACITY_SAMPLE_SIZE', '100')),
+    'ENDPOINT_TOKEN': getenv('CACHE_CAPACITY_ENDPOINT_TOKEN', ''),
+}
+
+# `python-memcached` is the previous client, a connection per thread without timeouts of its own.
+if getenv('CACHE_CLIENT') == 'python-memcached':
+    CACHES['default']['BACKEND'] = 'django.core.cache.backends.memcached.MemcachedCache'
+    del CACHES['default']['OPTIONS']
+
+# Registrations API
+
+# Coroutine views with a non-blocking memcached client, enabled by default when served through `backend.asgi`.
+REGISTRATIONS_ASYNC_VIEWS = config['django'].getboolean('async_views')
+
+# `compact` stores the binary record of `rest_api.codec`, `json` stores the encoded response body of a registration,
+# `python` stores the dict pickled by the cache. Values of every format are read whatever the current one is.
+REGISTRATIONS_STORAGE_FORMAT = getenv('REGISTRATIONS_STORAGE_FORMAT', 'compact')
+
+# Compact records with a longer payload are compressed with zlib, 0 disables compression.
+REGISTRATIONS_COMPRESS_MIN_BYTES = int(getenv('REGISTRATIONS_COMPRESS_MIN_BYTES', '256'))
+
+# `Cache-Control` of the registrations returned by GET, so the clients serve repeat reads from their cache.
+# Registrations never change, but they hold personal data: `private` keeps them out of shared caches. A value that lets
+# shared caches keep them also sends `Vary: Authorization`, an empty value sends no header.
+REGISTRATIONS_CACHE_CONTROL = getenv('REGISTRATIONS_CACHE_CONTROL', 'private, max-age=86400, immutable')
+
+# Per-worker in-process cache in front of memcached, disabled when any of the limits is 0.
+REGISTRATIONS_L1_CACHE = {
+    'MAX_ENTRIES': int(getenv('REGISTRATIONS_L1_MAX_ENTRIES', '10000')),
+    'MAX_BYTES': int(getenv('REGISTRATIONS_L1_MAX_BYTES', str(16 * 1024 * 1024))),
+    'TTL': float(getenv('REGISTRATIONS_L1_TTL', '60')),
+}
+
+# Durable SQLite store that registrations are written through to, disabled when `PATH` is empty.
+# Up to `MAX_QUEUE_SIZE` registrations wait to be committed; a request waits `QUEUE_TIMEOUT` seconds for room
+# and gets 503 without it.
+REGISTRATIONS_STORE = {
+    'PATH': getenv('REGISTRATIONS_STORE_PATH', str(BASE_DIR / 'data' / 'registrations.sqlite3')),
+    'BATCH_SIZE': int(getenv('REGISTRATIONS_STORE_BATCH_SIZE', '500')),
+    'FLUSH_INTERVAL': float(getenv('REGISTRATIONS_STORE_FLUSH_INTERVAL', '0.05')),
+    'SYNCHRONOUS': getenv('REGISTRATIONS_STORE_SYNCHRONOUS', 'NORMAL'),
+    'MAX_QUEUE_SIZE': int(getenv('REGISTRATIONS_STORE_MAX_QUEUE_SIZE', '100000')),
+    'QUEUE_TIMEOUT': float(getenv('REGISTRATIONS_STORE_QUEUE_TIMEOUT', '5')),
+}
+
+# How long the `Idempotency-Key` of a POST is remembered, in seconds.
+REGISTRATIONS_IDEMPOTENCY_TTL = int(getenv('REGISTRATIONS_IDEMPOTENCY_TTL', str(24 * 60 * 60)))
+REGISTRATIONS_ID_ALLOCATION_ATTEMPTS = 5
+
+# Index of the written registration IDs in memcached, which `export_registrations` enumerates.
+REGISTRATIONS_ID_INDEX = getenv('REGISTRATIONS_ID_INDEX', '1') == '1'
+
+# Bloom filter of the issued registration IDs in a file shared by the workers of the host, see `rest_api.id_filter`:
+# a GET of an ID that was never issued answers 404 without asking memcached. Disabled when `PATH` is empty.
+# `rebuild_id_filter` builds it at startup for `CAPACITY` IDs (at least twice the stored or indexed ones) with
+# `FALSE_POSITIVE_RATE`. Registrations are added only to the filter of the host that wrote them,
+# so enable it only when one host serves all writes.
+REGISTRATIONS_ID_FILTER = {
+    'PATH': getenv('REGISTRATIONS_ID_FILTER_PATH', ''),
+    'CAPACITY': int(getenv('REGISTRATIONS_ID_FILTER_CAPACITY', '1000000')),
+    'FALSE_POSITIVE_RATE': float(getenv('REGISTRATIONS_ID_FILTER_FALSE_POSITIVE_RATE', '0.01')),
+}
+
+# What POST does with an email that is already registered: `allow` stores another registration,
+# `reject` answers 409 and `merge` answers 200 with the ID of the registration that has the email.
+# Emails are compared trimmed and lowercased.
+REGISTRATIONS_DUPLICATE_EMAILS = getenv('REGISTRATIONS_DUPLICATE_EMAILS', 'allow')
+# Maximum number of the latest registrations returned by the lookup by email.
+REGISTRATIONS_EMAIL_MATCHES_MAX = int(getenv('REGISTRATIONS_EMAIL_MATCHES_MAX', '100'))
+
+# Maximum sizes of the request bodies in bytes, checked by `Content-Length` before a body is read; larger ones get 413.
+# They must not exceed `DATA_UPLOAD_MAX_MEMORY_SIZE` of Django, 2.5 MB.
+REGISTRATIONS_MAX_BODY_SIZE = {
+    'REGISTRATION': int(getenv('REGISTRATIONS_MAX_BODY_SIZE', str(16 * 1024))),
+    'BATCH': int(getenv('REGISTRATIONS_BATCH_MAX_BODY_SIZE', str(2 * 1024 * 1024))),
+    'LOOKUP': int(getenv('REGISTRATIONS_LOOKUP_MAX_BODY_SIZE', str(1024 * 1024))),
+}
+
+REGISTRATIONS_BATCH_MAX_SIZE = int(getenv('REGISTRATIONS_BATCH_MAX_SIZE', '1000'))
+REGISTRATIONS_BATCH_WRITE_CHUNK_SIZE = int(getenv('REGISTRATIONS_BATCH_WRITE_CHUNK_SIZE', '250'))
+REGISTRATIONS_LOOKUP_MAX_SIZE = int(getenv('REGISTRATIONS_LOOKUP_MAX_SIZE', '10000'))
+REGISTRATIONS_LOOKUP_CHUNK_SIZE = int(getenv('REGISTRATIONS_LOOKUP_CHUNK_SIZE', '500'))
+REGISTRATIONS_LOOKUP_STREAM_THRESHOLD = int(getenv('REGISTRATIONS_LOOKUP_STREAM_THRESHOLD', '1000'))
+
 AUTH_PASSWORD_VALIDATORS = []
 
 LANGUAGE_CODE = 'en-us'
@@ -91,6 +205,45 @@ USE_TZ = True
 STATIC_ROOT = path.join(BASE_DIR, 'static')
 STATIC_URL = '/api/static/'
 
+# Admission control of the requests, see `backend.middleware.AdmissionControlMiddleware`: `RATE` requests a second
+# with bursts of `BURST` for every client, counted by all workers together in memcached with `SHARED`.
+# A client is told apart by its address, or behind `TRUSTED_PROXIES` proxies by the address the first of them added to
+# the `CLIENT_HEADER` key of `request.META` (`HTTP_X_FORWARDED_FOR`), counted from the right since the values before
+# it come from the client. `MAX_CACHE_LATENCY` is in seconds. 0 disables a limit.
+ADMISSION_CONTROL = {
+    'RATE': float(getenv('ADMISSION_RATE', '0')),
+    'BURST': int(getenv('ADMISSION_BURST', '20')),
+    'SHARED': getenv('ADMISSION_SHARED', '0') == '1',
+    'CLIENT_HEADER': getenv('ADMISSION_CLIENT_HEADER', ''),
+    'TRUSTED_PROXIES': int(getenv('ADMISSION_TRUSTED_PROXIES', '1')),
+    'MAX_CLIENTS': int(getenv('ADMISSION_MAX_CLIENTS', '100000')),
+    'MAX_IN_FLIGHT': int(getenv('ADMISSION_MAX_IN_FLIGHT', '0')),
+    'MAX_CACHE_LATENCY': float(getenv('ADMISSION_MAX_CACHE_LATENCY', '0')),
+    'RETRY_AFTER': float(getenv('ADMISSION_RETRY_AFTER', '1')),
+    'EXEMPT_PATHS': ['/metrics'],
+}
+
+# Request metrics served on /metrics. Every worker process writes its metrics to `DIRECTORY`, if it is set,
+# so the endpoint of any worker serves the sum of all of them; the directory must be emptied before the server starts.
+METRICS = {
+    'DIRECTORY': getenv('METRICS_DIRECTORY', ''),
+    'FLUSH_INTERVAL': float(getenv('METRICS_FLUSH_INTERVAL', '1')),
+    'SERVER_TIMING': getenv('METRICS_SERVER_TIMING', '0') == '1',
+}
+
+# `orjson` encodes and parses the JSON of the API when it is installed, `json` is the standard library.
+JSON_LIBRARY = getenv('JSON_LIBRARY', 'orjson')
+
+# `text` or `json` lines of the logs. The logs are written by a background thread, see `BackgroundStreamHandler`.
+LOG_FORMAT = getenv('LOG_FORMAT', 'text')
+
+# Share of the requests whose registration data is logged at INFO level, from 0 (none) to 1 (all),
+# with the values of the `REDACT` fields hidden.
+LOGGING_PAYLOADS = {
+    'SAMPLE_RATE': float(getenv('LOG_PAYLOAD_SAMPLE_RATE', '0')),
+    'REDACT': getenv('LOG_PAYLOAD_REDACT', 'firstName,lastName,email').split(','),
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -106,16 +259,19 @@ LOGGING = {
         'requests': {
             'format': '%(levelname)-8s [%(asctime)s: %(name)s] [%(x_correlation_id)s] %(message)s',
         },
+        'json': {
+            '()': 'backend.logging.JsonFormatter',
+        },
     },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
-            'formatter': 'standard',
+            'class': 'backend.logging.BackgroundStreamHandler',
+            'formatter': 'json' if LOG_FORMAT == 'json' else 'standard',
         },
         'requests': {
-            'class': 'logging.StreamHandler',
+            'class': 'backend.logging.BackgroundStreamHandler',
             'filters': ['requests'],
-            'formatter': 'requests',
+            'formatter': 'json' if LOG_FORMAT == 'json' else 'requests',
         },
     },
     'loggers': {
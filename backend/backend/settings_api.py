@@ -0,0 +1,28 @@
+"""
+API-only settings profile. \\
+It keeps only what the registration endpoints need: no sessions, auth, messages, CSRF, clickjacking protection,
+static files or templates, so a worker imports less at startup and a request passes fewer middleware.
+The views are `csrf_exempt` and there is no database, so the behavior of the API does not change.
+
+Use it with `DJANGO_SETTINGS_MODULE=backend.settings_api`.
+"""
+from backend.settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'rest_api.apps.RestApiConfig',
+]
+
+MIDDLEWARE = [
+    # Custom middleware measuring the whole request
+    'backend.middleware.MetricsMiddleware',
+    # Security headers: `X-Content-Type-Options`, `Referrer-Policy` and the HSTS and SSL redirect settings
+    'django.middleware.security.SecurityMiddleware',
+    # Custom middleware
+    'backend.middleware.XCorrelationIDMiddleware',
+    'backend.middleware.AdmissionControlMiddleware',
+]
+
+TEMPLATES = []
+
+# The URLs of the API have no trailing slashes, and CommonMiddleware that appends them is not installed.
+APPEND_SLASH = False
@@ -0,0 +1,976 @@
+import asyncio
+import importlib.util
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.request
+
+from datetime import datetime, timezone
+from decimal import Decimal
+from io import StringIO
+from json import dump, dumps, loads
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.cache import cache as default_cache, caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.wsgi import get_wsgi_application
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, Client, RequestFactory, override_settings
+
+from backend import get_current_request_id, json_codec, request_id
+from backend.admission import get_client
+from backend.cache.aio import AsyncMemcachedCache
+from backend.cache.backends import ShardedMemcachedCache
+from backend.cache.capacity import EVICTING, OK, UNAVAILABLE, WARNING, CapacityMonitor, assess
+from backend.cache.client import CLOSED, OPEN, PoolExhausted
+from backend.cache.local import LocalCache
+from backend.cache.metrics import OperationMetrics
+from backend.cache.protocol import MemcachedError
+from backend.cache.ring import HashRing
+from backend.logging import BackgroundStreamHandler, JsonFormatter, RequestFilter, log_payload
+from backend.metrics import MetricsRegistry, registry
+from backend.middleware import AdmissionControlMiddleware, BodySizeLimitMiddleware, XCorrelationIDMiddleware
+from benchmarks import api as api_benchmark, startup as startup_benchmark
+from testing.memcached import MemcachedServer
+
+
+class XCorrelationIDMiddlewareTest(unittest.TestCase):
+    """Correlation ID middleware unit tests."""
+
+    def test_concurrent_requests_keep_own_ids(self):
+        async def view(request):
+            await asyncio.sleep(0.01)
+            return HttpResponse(get_current_request_id())
+
+        async def serve_concurrently():
+            middleware = XCorrelationIDMiddleware(view)
+            requests = [AsyncRequestFactory().get('/') for _ in range(10)]
+            responses = await asyncio.gather(*(middleware(request) for request in requests))
+            return [(request.META['x-correlationid'], response.content.decode())
+                    for request, response in zip(requests, responses)]
+
+        for request_id, seen_request_id in async_to_sync(serve_concurrently)():
+            self.assertEqual(seen_request_id, request_id)
+
+
+class LocalCacheTest(unittest.TestCase):
+    """In-process LRU cache unit tests."""
+
+    def test_lru_eviction_by_entries_and_bytes(self):
+        local_cache = LocalCache(max_entries=2, max_bytes=10, ttl=60)
+        local_cache.set('a', b'aaaa', 4)
+        local_cache.set('b', b'bbbb', 4)
+        self.assertEqual(local_cache.get('a'), b'aaaa')
+        local_cache.set('c', b'cccc', 4)
+        self.assertIsNone(local_cache.get('b'))
+        local_cache.set('d', b'dddddd', 6)
+        self.assertIsNone(local_cache.get('a'))
+        self.assertEqual(local_cache.get('d'), b'dddddd')
+        local_cache.set('e', b'e' * 11, 11)
+        self.assertIsNone(local_cache.get('e'))
+        stats = local_cache.stats()
+        self.assertEqual((stats['entries'], stats['bytes'], stats['evictions']), (2, 10, 2))
+        self.assertEqual((stats['hits'], stats['misses']), (2, 3))
+
+    def test_ttl_expiration(self):
+        local_cache = LocalCache(max_entries=2, max_bytes=10, ttl=0.01)
+        local_cache.set('a', b'aaaa', 4)
+        time.sleep(0.02)
+        self.assertIsNone(local_cache.get('a'))
+        self.assertEqual(local_cache.stats()['expirations'], 1)
+        self.assertEqual(local_cache.stats()['bytes'], 0)
+
+    def test_disabled(self):
+        local_cache = LocalCache(max_entries=0, max_bytes=10, ttl=60)
+        local_cache.set('a', b'aaaa', 4)
+        self.assertIsNone(local_cache.get('a'))
+
+
+class HashRingTest(unittest.TestCase):
+    """Consistent hash ring unit tests."""
+
+    def test_adding_node_moves_fraction_of_keys(self):
+        keys = [b'key-%d' % i for i in range(10000)]
+        ring = HashRing({'a:1': 1, 'b:1': 1, 'c:1': 1, 'd:1': 1})
+        grown_ring = HashRing({'a:1': 1, 'b:1': 1, 'c:1': 1, 'd:1': 1, 'e:1': 1})
+        moved = [key for key in keys if ring.get_node(key) != grown_ring.get_node(key)]
+        self.assertLess(len(moved) / len(keys), 0.3)
+        self.assertTrue(all(grown_ring.get_node(key) == 'e:1' for key in moved))
+
+    def test_replicas_are_distinct(self):
+        ring = HashRing({'a:1': 1, 'b:1': 1, 'c:1': 1})
+        for i in range(100):
+            nodes = ring.get_nodes(b'key-%d' % i, 2)
+            self.assertEqual(len(set(nodes)), 2)
+            self.assertEqual(nodes[0], ring.get_node(b'key-%d' % i))
+        self.assertEqual(len(ring.get_nodes(b'key', 5)), 3)
+
+
+class ShardedMemcachedCacheTest(unittest.TestCase):
+    """Sharded memcached backend tests against in-process memcached servers."""
+
+    def setUp(self):
+        self.servers = [MemcachedServer().start() for _ in range(3)]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def get_cache(self, **options) -> ShardedMemcachedCache:
+        options = {
+            'REPLICAS': 2, 'READ_TIMEOUT': 0.2, 'RETRIES': 0, 'FAILURE_THRESHOLD': 2, 'RETRY_TIMEOUT': 60, **options,
+        }
+        return ShardedMemcachedCache([server.address for server in self.servers], {'OPTIONS': options})
+
+    def test_sharding(self):
+        cache = self.get_cache(REPLICAS=1)
+        cache.set_many({'key-%d' % i: i for i in range(300)}, None)
+        self.assertEqual(cache.get_many(['key-%d' % i for i in range(300)]), {'key-%d' % i: i for i in range(300)})
+        self.assertEqual(sum(len(server.items) for server in self.servers), 300)
+        self.assertTrue(all(server.items for server in self.servers))
+        self.assertTrue(cache.add('new', b'value', None))
+        self.assertFalse(cache.add('new', b'other', None))
+        self.assertEqual(cache.get('new'), b'value')
+        self.assertTrue(cache.delete('new'))
+        self.assertIsNone(cache.get('new'))
+        cache.set('counter', 1, None)
+        self.assertEqual(cache.incr('counter', 2), 3)
+        self.assertEqual(cache.decr('counter'), 2)
+
+    def test_replication_and_failover(self):
+        cache = self.get_cache()
+        cache.set_many({'key-%d' % i: i for i in range(100)}, None)
+        self.assertEqual(sum(len(server.items) for server in self.servers), 200)
+        self.assertTrue(cache.add('new', 'value', None))
+        self.assertEqual(sum(b':1:new' in server.items for server in self.servers), 2)
+
+        primary = cache.ring.get_node(b':1:new')
+        slow_server = next(server for server in self.servers if server.address == primary)
+        slow_server.delay = 0.5
+        self.assertEqual(cache.get('new'), 'value')
+        self.assertEqual(cache.get_many(['key-%d' % i for i in range(100)]), {'key-%d' % i: i for i in range(100)})
+        self.assertEqual(cache.health()[primary]['state'], OPEN)
+        # The node with the open circuit breaker is not asked at all.
+        started = time.monotonic()
+        self.assertEqual(cache.get('new'), 'value')
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertFalse(cache.add('new', 'other', None))
+
+    def test_circuit_breaker_recovers(self):
+        cache = self.get_cache(REPLICAS=1, RETRY_TIMEOUT=0.05)
+        cache.set('key', 'value', None)
+        server = next(server for server in self.servers if server.address == cache.ring.get_node(b':1:key'))
+        server.delay = 0.5
+        self.assertIsNone(cache.get('key'))
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.health()[server.address]['state'], OPEN)
+        server.delay = 0
+        time.sleep(0.1)
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertEqual(cache.health()[server.address]['state'], CLOSED)
+
+    def test_pipelining_and_metrics(self):
+        cache = self.get_cache(REPLICAS=1)
+        self.assertEqual(cache.set_many({'key-%d' % i: i for i in range(100)}, None), [])
+        cache.delete_many(['key-%d' % i for i in range(50)])
+        self.assertEqual(len(cache.get_many(['key-%d' % i for i in range(100)])), 50)
+        # Every node got its keys through one pooled connection.
+        for node in cache.nodes.values():
+            self.assertEqual(node.health()['idle_connections'], 1)
+        metrics = cache.metrics.snapshot()
+        self.assertEqual({operation: metrics[operation]['count'] for operation in metrics},
+                         {'set_many': 1, 'delete_many': 1, 'get_many': 1})
+        self.assertEqual(sum(metrics['get_many']['buckets']), 1)
+        self.assertLessEqual(metrics['get_many']['p99'], metrics['get_many']['max'])
+
+    def test_add_many(self):
+        cache = self.get_cache()
+        cache.set('key-0', 'taken', None)
+        self.assertEqual(cache.add_many({'key-%d' % i: i for i in range(100)}, None), ['key-0'])
+        self.assertEqual(cache.get('key-0'), 'taken')
+        self.assertEqual(cache.get_many(['key-%d' % i for i in range(1, 100)]),
+                         {'key-%d' % i: i for i in range(1, 100)})
+        self.assertEqual(sum(len(server.items) for server in self.servers), 200)
+        # Keys of a node that does not answer are added on their next replica.
+        primary = cache.ring.get_node(b':1:new-0')
+        next(server for server in self.servers if server.address == primary).delay = 0.5
+        self.assertEqual(cache.add_many({'new-%d' % i: i for i in range(30)}, None), [])
+        self.assertEqual(cache.get_many(['new-%d' % i for i in range(30)]), {'new-%d' % i: i for i in range(30)})
+        self.assertEqual(cache.add_many({'new-%d' % i: -i for i in range(30)}, None), ['new-%d' % i for i in range(30)])
+
+    def test_counters_keep_expiration_on_replicas(self):
+        cache = self.get_cache()
+        cache.add('counter', 0, 60)
+        self.assertEqual(cache.incr('counter'), 1)
+        self.assertEqual(cache.incr('counter', 2), 3)
+        self.assertEqual(cache.decr('counter'), 2)
+        caches_setting = {
+            'sharded': {
+                'BACKEND': 'backend.cache.backends.ShardedMemcachedCache',
+                'LOCATION': [server.address for server in self.servers],
+                'OPTIONS': {'REPLICAS': 2, 'READ_TIMEOUT': 0.2},
+            },
+        }
+        with override_settings(CACHES={**settings.CACHES, **caches_setting}):
+            self.assertEqual(async_to_sync(AsyncMemcachedCache('sharded').incr)('counter', 3), 5)
+        replicas = [server.items[b':1:counter'] for server in self.servers if b':1:counter' in server.items]
+        self.assertEqual(len(replicas), 2)
+        for data, _, exptime, _ in replicas:
+            self.assertEqual(data, b'5')
+            self.assertGreater(exptime, time.time())
+
+    def test_restarted_primary_is_restored_from_replicas(self):
+        cache = self.get_cache()
+        cache.add('counter', 0, None)
+        self.assertEqual(cache.incr('counter', 5), 5)
+        cache.set('key', 'value', None)
+        primary = next(server for server in self.servers if server.address == cache.ring.get_node(b':1:counter'))
+        replica = next(server for server in self.servers
+                       if server is not primary and b':1:counter' in server.items)
+        # The primary lost the keys, the reads fall through to the replica.
+        del primary.items[b':1:counter']
+        primary.items.pop(b':1:key', None)
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertEqual(cache.get_many(['key']), {'key': 'value'})
+        # The counter is copied back to the primary with the default timeout and changed on both nodes.
+        self.assertEqual(cache.incr('counter'), 6)
+        self.assertEqual(primary.items[b':1:counter'][0], b'6')
+        self.assertGreater(primary.items[b':1:counter'][2], time.time())
+        self.assertEqual(replica.items[b':1:counter'][0], b'6')
+        del primary.items[b':1:counter']
+        caches_setting = {
+            'sharded': {
+                'BACKEND': 'backend.cache.backends.ShardedMemcachedCache',
+                'LOCATION': [server.address for server in self.servers],
+                'OPTIONS': {'REPLICAS': 2, 'READ_TIMEOUT': 0.2},
+            },
+        }
+        with override_settings(CACHES={**settings.CACHES, **caches_setting}):
+            async_cache = AsyncMemcachedCache('sharded')
+            self.assertEqual(async_to_sync(async_cache.incr)('counter'), 7)
+            self.assertEqual(async_to_sync(async_cache.get)('key'), 'value')
+        self.assertEqual(primary.items[b':1:counter'][0], b'7')
+        self.assertEqual(replica.items[b':1:counter'][0], b'7')
+        # A new key is decided by the primary, but a replica keeps the value it has.
+        del primary.items[b':1:counter']
+        del replica.items[b':1:counter']
+        self.assertRaises(ValueError, cache.incr, 'counter')
+        replica.items[b':1:counter'] = (b'3', 0, 0, 1)
+        self.assertTrue(cache.add('counter', 0, None))
+        self.assertEqual(replica.items[b':1:counter'][0], b'3')
+
+    def test_retry_of_broken_connection(self):
+        cache = self.get_cache(REPLICAS=1, RETRIES=1)
+        cache.set('key', 'value', None)
+        node = cache.nodes[cache.ring.get_node(b':1:key')]
+        node.idle[0].sock.shutdown(socket.SHUT_RDWR)
+        self.assertTrue(cache.add('new', 'value', None))
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertEqual(node.health()['failures'], 0)
+
+    def test_pool_timeout(self):
+        cache = self.get_cache(REPLICAS=1, MAX_CONNECTIONS=1, POOL_TIMEOUT=0.01)
+        node = cache.nodes[cache.ring.get_node(b':1:key')]
+        connection = node.acquire()
+        with self.assertRaises(PoolExhausted):
+            node.get_many([b':1:key'])
+        node.release(connection)
+        self.assertEqual(node.health()['state'], CLOSED)
+        self.assertTrue(cache.add('key', 'value', None))
+
+
+        caches_setting = {
+            'sharded': {
+                'BACKEND': 'backend.cache.backends.ShardedMemcachedCache',
+                'LOCATION': [server.address for server in self.servers],
+                'OPTIONS': {'REPLICAS': 2, 'READ_TIMEOUT': 0.2},
+                'ASYNC_OPTIONS': {'TIMEOUT': 0.2},
+            },
+        }
+        with override_settings(CACHES={**settings.CACHES, **caches_setting}):
+            cache = caches['sharded']
+            async_cache = AsyncMemcachedCache('sharded')
+
+            async def use_async_cache():
+                self.assertTrue(await async_cache.add('new', b'value', None))
+                self.assertFalse(await async_cache.add('new', b'other', None))
+                primary = cache.ring.get_node(b':1:new')
+                next(server for server in self.servers if server.address == primary).delay = 0.5
+                return await async_cache.get('new'), await async_cache.get_many(['new', 'missing'])
+
+            value, values = async_to_sync(use_async_cache)()
+            self.assertEqual((value, values), (b'value', {'new': b'value'}))
+            self.assertEqual(cache.get('new'), b'value')
+
+
+    def test_async_reconnects_closed_connections(self):
+        for server in self.servers:
+            server.close_connections = True
+        caches_setting = {
+            'sharded': {
+                'BACKEND': 'backend.cache.backends.ShardedMemcachedCache',
+                'LOCATION': [server.address for server in self.servers],
+                'OPTIONS': {'REPLICAS': 1, 'READ_TIMEOUT': 0.2, 'MIN_COMPRESS_LEN': 100},
+                'ASYNC_OPTIONS': {'TIMEOUT': 0.2},
+            },
+        }
+        with override_settings(CACHES={**settings.CACHES, **caches_setting}):
+            cache = caches['sharded']
+            async_cache = AsyncMemcachedCache('sharded')
+
+            async def use_async_cache():
+                self.assertTrue(await async_cache.set('key', b'x' * 1000, None))
+                values = [await async_cache.get('key') for _ in range(3)]
+                # An idle connection the server has closed is not used for an `add`, which is not retried.
+                await asyncio.sleep(0.05)
+                self.assertTrue(await async_cache.add('new', b'value', None))
+                return values
+
+            self.assertEqual(async_to_sync(use_async_cache)(), [b'x' * 1000] * 3)
+            self.assertEqual(cache.get('key'), b'x' * 1000)
+            self.assertEqual({node['failures'] for node in cache.health().values()}, {0})
+            # Values are compressed by both clients alike.
+            data = next(server.items[b':1:key'][0] for server in self.servers if b':1:key' in server.items)
+            self.assertLess(len(data), 100)
+
+
+class CacheCapacityTest(unittest.TestCase):
+    """Memcached capacity check tests against in-process memcached servers."""
+
+    registration = {
+        'registrationDate': '2010-01-01T00:00:00.000000+01:00',
+        'locale': 'en',
+        'person': dumps({'firstName': 'First', 'lastName': 'Last', 'email': 'test@test.com'}),
+    }
+
+    def setUp(self):
+        self.servers = [MemcachedServer(limit_maxbytes=64 * 1024).start() for _ in range(2)]
+        self.cache = ShardedMemcachedCache([server.address for server in self.servers], {'OPTIONS': {
+            'READ_TIMEOUT': 0.2, 'RETRIES': 0, 'FAILURE_THRESHOLD': 1, 'RETRY_TIMEOUT': 60,
+        }})
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def test_fill_and_evictions(self):
+        monitor = CapacityMonitor()
+        report = monitor.check(self.cache, 0.5, 0)
+        self.assertEqual(report['status'], OK)
+        self.assertEqual(set(report['nodes']), {server.address for server in self.servers})
+        self.assertEqual([node['fill_ratio'] for node in report['nodes'].values()], [0, 0])
+
+        self.cache.set_many({'key-%d' % i: b'x' * 200 for i in range(100)}, None)
+        report = monitor.check(self.cache, 0.5, 0)
+        self.assertEqual(report['status'], OK)
+        for server in self.servers:
+            node = report['nodes'][server.address]
+            self.assertEqual(node['fill_ratio'], server.bytes / (64 * 1024))
+            self.assertEqual(node['items'], len(server.items))
+            self.assertAlmostEqual(node['average_item_size'], server.bytes / len(server.items), delta=1)
+            self.assertGreater(node['write_rate'], 0)
+            self.assertGreater(node['seconds_to_full'], 0)
+            self.assertEqual(node['eviction_rate'], 0)
+        self.assertEqual(monitor.check(self.cache, 0.1, 0)['status'], WARNING)
+
+        self.cache.set_many({'key-%d' % i: b'x' * 200 for i in range(100, 1000)}, None)
+        with self.assertLogs('django', 'WARNING') as logs:
+            report = monitor.check(self.cache, 0.5, 0)
+        self.assertEqual(report['status'], EVICTING)
+        self.assertTrue(all(node['eviction_rate'] > 0 for node in report['nodes'].values()))
+        self.assertIn('items a second', logs.output[0])
+        report = monitor.check(self.cache, 1.1, 0)
+        self.assertEqual(report['status'], WARNING)
+        self.assertIn('since the start', report['nodes'][self.servers[0].address]['warnings'][0])
+
+        self.servers[1].delay = 0.5
+        with self.assertLogs('django', 'WARNING'):
+            report = monitor.check(self.cache, 1.1, 0)
+        self.assertEqual(report['status'], UNAVAILABLE)
+        self.assertEqual(report['nodes'][self.servers[1].address]['status'], UNAVAILABLE)
+
+    def test_time_to_full(self):
+        previous = {'polled': 0, 'uptime': 10, 'total_items': 0, 'evictions': 0}
+        current = {'polled': 10, 'uptime': 20, 'bytes': 50000, 'limit_maxbytes': 100000, 'curr_items': 100,
+                   'total_items': 100, 'evictions': 0, 'chunk_bytes': 50000, 'chunks': 100}
+        report = assess(current, previous, 0.8, 5)
+        self.assertEqual((report['write_rate'], report['average_item_size'], report['seconds_to_full']),
+                         (10, 500, 10))
+        self.assertEqual(report['status'], OK)
+        self.assertEqual(assess(current, previous, 0.8, 60)['status'], WARNING)
+        # After a restart of the node, the rates are computed since its start.
+        self.assertEqual(assess(current, {**previous, 'uptime': 30}, 0.8, 5)['seconds_to_full'], 20)
+
+    def test_endpoint_and_command(self):
+        capacity = {'WARN_FILL_RATIO': 1.1, 'WARN_SECONDS_TO_FULL': 0, 'SAMPLE_SIZE': 10}
+        client = Client()
+        # The report is not served without the token, nor while the token is not set.
+        for token, authorization in [('', ''), ('', 'Bearer '), ('secret', ''), ('secret', 'Bearer other')]:
+            with override_settings(CACHE_CAPACITY={**capacity, 'ENDPOINT_TOKEN': token}), \
+                    self.assertLogs('django.request', 'WARNING'):
+                response = client.get('/internal/cache-capacity', HTTP_AUTHORIZATION=authorization)
+                self.assertEqual(response.status_code, 403)
+                self.assertEqual(response.json()['error']['code'], 'Forbidden')
+                self.assertIn('x-correlationid', response)
+        with override_settings(CACHE_CAPACITY={**capacity, 'ENDPOINT_TOKEN': 'secret'}):
+            with mock.patch('rest_api.views.check_cache_capacity', side_effect=MemcachedError('down')), \
+                    self.assertLogs('django.request', 'ERROR'):
+                response = client.get('/internal/cache-capacity', HTTP_AUTHORIZATION='Bearer secret')
+                self.assertEqual(response.status_code, 500)
+                self.assertIn('x-correlationid', response)
+        with override_settings(CACHE_CAPACITY={**capacity, 'ENDPOINT_TOKEN': 'secret'},
+                               REGISTRATIONS_STORE={**settings.REGISTRATIONS_STORE, 'PATH': ''}):
+            client.post('/api/v1/registrations', dumps(self.registration), content_type='application/json')
+            response = client.get('/internal/cache-capacity', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('x-correlationid', response)
+            report = response.json()
+            self.assertEqual(set(report['nodes']), set(settings.CACHE_LOCATIONS))
+            self.assertGreater(report['registration_item_size'], 100)
+            self.assertEqual(report['status'], OK)
+
+            stdout = StringIO()
+            call_command('cache_capacity', interval=0, stdout=stdout)
+            self.assertIn(settings.CACHE_LOCATIONS[0] + ': ok', stdout.getvalue())
+            self.assertIn('Registrations take', stdout.getvalue())
+        with override_settings(CACHE_CAPACITY={'WARN_FILL_RATIO': 0, 'WARN_SECONDS_TO_FULL': 0, 'SAMPLE_SIZE': 10}):
+            with self.assertRaises(CommandError), self.assertLogs('django', 'WARNING'):
+                call_command('cache_capacity', interval=0, json=True, stdout=StringIO())
+
+
+class ApiBenchmarkTest(unittest.TestCase):
+    """API load test unit tests."""
+
+    def setUp(self):
+        self.store_directory = tempfile.TemporaryDirectory()
+        self.store_settings = override_settings(REGISTRATIONS_STORE={
+            'PATH': os.path.join(self.store_directory.name, 'registrations.sqlite3'),
+        })
+        self.store_settings.enable()
+
+    def tearDown(self):
+        self.store_settings.disable()
+        self.store_directory.cleanup()
+        default_cache.clear()
+
+    def test_runs_mix_on_both_interfaces(self):
+        mix = api_benchmark.parse_mix(api_benchmark.DEFAULT_MIX)
+        registration_ids = api_benchmark.store_hits(5)
+        schedule = api_benchmark.make_schedule(mix, 40, registration_ids)
+        self.assertEqual(schedule, api_benchmark.make_schedule(mix, 40, registration_ids))
+        for interface, application in [('wsgi', get_wsgi_application()), ('asgi', get_asgi_application())]:
+            result = api_benchmark.run(interface, application, schedule, 4)
+            self.assertEqual(result['unexpected'], [])
+            allocations = api_benchmark.measure_allocations(interface, application, schedule[:10])
+            report = api_benchmark.summarize(result, allocations)
+            self.assertEqual(report['all']['requests'], 40)
+            self.assertTrue(report['all']['p50'] <= report['all']['p95'] <= report['all']['p99'])
+            self.assertGreater(report['all']['alloc_kib'], 0)
+        with self.assertRaises(ValueError):
+            api_benchmark.parse_mix('get_hit=1,unknown=2')
+
+    def test_compare_to_baseline(self):
+        baseline = {'all': {'requests': 10, 'throughput': 1000, 'p50': 1, 'p95': 2, 'p99': 3, 'alloc_kib': 10}}
+        self.assertEqual(api_benchmark.compare(baseline, baseline, 0.1), [])
+        slower = {'all': {**baseline['all'], 'throughput': 850, 'p99': 3.2}}
+        self.assertEqual(len(api_benchmark.compare(slower, baseline, 0.1)), 1)
+        self.assertEqual(len(api_benchmark.compare(slower, baseline, 0.2)), 0)
+
+
+class MetricsTest(unittest.TestCase):
+    """Request metrics unit tests."""
+
+    registration = {
+        'registrationDate': '2010-01-01T00:00:00.000000+01:00',
+        'locale': 'en',
+        'person': dumps({'firstName': 'First', 'lastName': 'Last', 'email': 'test@test.com'}),
+    }
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = override_settings(REGISTRATIONS_STORE={
+            'PATH': os.path.join(self.directory.name, 'registrations.sqlite3'),
+        })
+        self.settings.enable()
+        registry.reset()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.directory.cleanup()
+        default_cache.clear()
+        registry.reset()
+
+    def test_request_metrics_and_server_timing(self):
+        client = Client()
+        taken = '8b3c4c0c-2b4a-4ba4-9d6a-3c1b5f3a1c2d'
+        default_cache.set(taken, b'{}', None)
+        with override_settings(METRICS={**settings.METRICS, 'SERVER_TIMING': True}):
+            with mock.patch('rest_api.storage.uuid4', side_effect=[taken, '0f5d6c57-5b0b-4f1f-8a55-0d2b6c2c4e0a']):
+                response = client.post('/api/v1/registrations', dumps(self.registration),
+                                       content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+            phases = [item.split(';')[0] for item in response['Server-Timing'].split(', ')]
+            self.assertEqual(phases, ['parse', 'validate', 'cache_set', 'serialize', 'total'])
+            registration_id = response.json()['registrationId']
+            self.assertIn('cache_get;dur=', client.get('/api/v1/registrations/' + registration_id)['Server-Timing'])
+        self.assertFalse(client.get('/api/v1/registrations/' + registration_id).has_header('Server-Timing'))
+        client.get('/api/v1/registrations/5a2b6d1e-0c3f-4e7a-9b8c-1d2e3f4a5b6c')
+
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('registrations_request_duration_seconds_count{endpoint="get_registrations_endpoint",'
+                      'method="GET",status="200"} 2', text)
+        self.assertIn('registrations_request_duration_seconds_count{endpoint="get_registrations_endpoint",'
+                      'method="GET",status="404"} 1', text)
+        self.assertIn('registrations_request_phase_duration_seconds_bucket{endpoint="post_registrations_endpoint",'
+                      'phase="validate",le="+Inf"} 1', text)
+        self.assertIn('registrations_cache_lookups_total{level="local",result="hit"} 1.0', text)
+        self.assertIn('registrations_cache_lookups_total{level="memcached",result="hit"} 1.0', text)
+        self.assertIn('registrations_cache_lookups_total{level="store",result="miss"} 1.0', text)
+        self.assertIn('registrations_id_allocation_retries_total 1.0', text)
+        self.assertIn('memcached_operation_duration_seconds_count{operation="add"}', text)
+
+    def test_worker_processes_are_summed(self):
+        directory = os.path.join(self.directory.name, 'metrics')
+        other = MetricsRegistry()
+        other.pid = os.getpid()
+        other.inc('registrations_id_allocation_retries_total', amount=2)
+        other.observe('registrations_request_duration_seconds', (('endpoint', 'e'),), 0.003)
+        other.add_collector(lambda: {
+            'counters': {('registrations_local_cache_removals_total', (('reason', 'eviction'),)): 4},
+            'gauges': {('registrations_local_cache_size_bytes', ()): 1000},
+        })
+        os.makedirs(directory)
+        with open(os.path.join(directory, '1.json'), 'w') as file:
+            dump(other.state(), file)
+        with override_settings(METRICS={**settings.METRICS, 'DIRECTORY': directory}):
+            registry.inc('registrations_id_allocation_retries_total')
+            registry.observe('registrations_request_duration_seconds', (('endpoint', 'e'),), 0.2)
+            text = Client().get('/metrics').content.decode()
+            self.assertTrue(os.path.exists(os.path.join(directory, '%d.json' % os.getpid())))
+        self.assertIn('registrations_id_allocation_retries_total 3.0', text)
+        self.assertIn('registrations_request_duration_seconds_bucket{endpoint="e",le="0.005"} 1', text)
+        self.assertIn('registrations_request_duration_seconds_bucket{endpoint="e",le="0.25"} 2', text)
+        self.assertIn('registrations_request_duration_seconds_count{endpoint="e"} 2', text)
+        # The collected metrics of the processes are summed as well.
+        self.assertIn('# TYPE registrations_local_cache_size_bytes gauge', text)
+        self.assertIn('# TYPE registrations_local_cache_removals_total counter', text)
+        for node in settings.CACHE_LOCATIONS:
+            self.assertIn('memcached_circuit_breakers{node="%s",state="closed"} 2.0' % node, text)
+            self.assertIn('memcached_circuit_breakers{node="%s",state="open"} 0.0' % node, text)
+
+
+class AdmissionControlTest(unittest.TestCase):
+    """Admission control middleware unit tests."""
+
+    options = {
+        'RATE': 1.0,
+        'BURST': 2,
+        'SHARED': False,
+        'CLIENT_HEADER': '',
+        'TRUSTED_PROXIES': 1,
+        'MAX_CLIENTS': 100,
+        'MAX_IN_FLIGHT': 0,
+        'MAX_CACHE_LATENCY': 0.0,
+        'RETRY_AFTER': 2.0,
+        'EXEMPT_PATHS': ['/metrics'],
+    }
+    missing = '/api/v1/registrations/00000000-0000-4000-8000-000000000000'
+
+    def setUp(self):
+        registry.reset()
+
+    def tearDown(self):
+        default_cache.clear()
+        registry.reset()
+
+    def middleware(self, get_response=lambda request: HttpResponse(), **options):
+        with override_settings(ADMISSION_CONTROL={**self.options, **options}):
+            return AdmissionControlMiddleware(get_response)
+
+    def request(self, client: str = '10.0.0.1', path: str = missing, **extra):
+        request = RequestFactory().get(path, REMOTE_ADDR=client, **extra)
+        request.META['x-correlationid'] = 'test'
+        return request
+
+    def assert_rejected(self, response, status_code: int, error_code: str, retry_after: str):
+        self.assertEqual(response.status_code, status_code)
+        self.assertEqual(loads(response.content)['error']['code'], error_code)
+        self.assertEqual(response['Retry-After'], retry_after)
+        self.assertEqual(response['x-correlationid'], 'test')
+
+    def test_rate_limit_per_client(self):
+        with override_settings(ADMISSION_CONTROL={**self.options, 'CLIENT_HEADER': 'HTTP_X_FORWARDED_FOR'}):
+            client = Client()
+            responses = [client.get(self.missing, HTTP_X_FORWARDED_FOR='10.0.0.1, 10.0.0.2') for _ in range(3)]
+            self.assertEqual([response.status_code for response in responses], [404, 404, 429])
+            self.assertEqual(responses[2]['Retry-After'], '1')
+            self.assertEqual(responses[2].json()['error']['code'], 'TooManyRequests')
+            # The values before the one added by the proxy are sent by the client.
+            self.assertEqual(client.get(self.missing, HTTP_X_FORWARDED_FOR='10.0.0.3, 10.0.0.2').status_code, 429)
+            self.assertEqual(client.get(self.missing, HTTP_X_FORWARDED_FOR='10.0.0.1').status_code, 404)
+            self.assertEqual(client.get('/metrics').status_code, 200)
+        self.assertEqual(registry.collect()['counters'][
+            ('registrations_admission_rejections_total', (('reason', 'rate_limit'),))], 2)
+        # A token is added every second.
+        middleware = self.middleware()
+        with mock.patch('time.monotonic', return_value=1000.0):
+            self.assertEqual([middleware(self.request()).status_code for _ in range(3)], [200, 200, 429])
+        with mock.patch('time.monotonic', return_value=1001.0):
+            self.assertEqual([middleware(self.request()).status_code for _ in range(2)], [200, 429])
+
+    def test_client_behind_proxies(self):
+        request = self.request(HTTP_X_FORWARDED_FOR='1.2.3.4, 10.0.0.5,10.0.0.6')
+        self.assertEqual(get_client(request, ''), '10.0.0.1')
+        self.assertEqual(get_client(request, 'HTTP_X_FORWARDED_FOR'), '10.0.0.6')
+        self.assertEqual(get_client(request, 'HTTP_X_FORWARDED_FOR', 2), '10.0.0.5')
+        self.assertEqual(get_client(request, 'HTTP_X_FORWARDED_FOR', 5), '1.2.3.4')
+        self.assertEqual(get_client(self.request(), 'HTTP_X_FORWARDED_FOR'), '10.0.0.1')
+
+    def test_shared_counters(self):
+        workers = [self.middleware(SHARED=True) for _ in range(2)]
+        with mock.patch('time.time', return_value=1001.0):
+            self.assertEqual([workers[i % 2](self.request()).status_code for i in range(3)], [200, 200, 429])
+            # Both workers count in the same window of BURST / RATE seconds.
+            self.assert_rejected(workers[0](self.request()), 429, 'TooManyRequests', '1')
+            self.assertEqual(workers[1](self.request('10.0.0.2')).status_code, 200)
+
+            async def get_response(request):
+                return HttpResponse()
+
+            async_worker = self.middleware(get_response, SHARED=True)
+            self.assertEqual(async_to_sync(async_worker)(self.request('10.0.0.3')).status_code, 200)
+            self.assertEqual(default_cache.get(async_worker.shared.key('10.0.0.3', 1001.0)), 1)
+        # The limit of the worker still holds when memcached fails.
+        with mock.patch.object(workers[0].shared, 'take', side_effect=MemcachedError('down')):
+            self.assertEqual(workers[0](self.request('10.0.0.4')).status_code, 200)
+
+    def test_load_shedding(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def get_response(request):
+            started.set()
+            release.wait(5)
+            return HttpResponse()
+
+        middleware = self.middleware(get_response, RATE=0.0, MAX_IN_FLIGHT=1)
+        thread = threading.Thread(target=middleware, args=(self.request(),))
+        thread.start()
+        started.wait(5)
+        self.assert_rejected(middleware(self.request('10.0.0.2')), 503, 'ServiceOverloaded', '2')
+        release.set()
+        thread.join()
+        self.assertEqual(middleware(self.request('10.0.0.2')).status_code, 200)
+
+        middleware = self.middleware(RATE=0.0, MAX_CACHE_LATENCY=0.05)
+        self.assertEqual(middleware(self.request()).status_code, 200)
+        with mock.patch.object(caches['default'].metrics, 'recent_latency', return_value=0.1):
+            self.assert_rejected(middleware(self.request()), 503, 'ServiceOverloaded', '2')
+            self.assertEqual(middleware(self.request(path='/metrics')).status_code, 200)
+        counters = registry.collect()['counters']
+        self.assertEqual(counters[('registrations_admission_rejections_total', (('reason', 'in_flight'),))], 1)
+        self.assertEqual(counters[('registrations_admission_rejections_total', (('reason', 'cache_latency'),))], 1)
+
+    def test_recent_cache_latency(self):
+        metrics = OperationMetrics(window=0.05)
+        self.assertEqual(metrics.recent_latency(), 0.0)
+        metrics.observe('get', 0.2)
+        metrics.observe('set', 0.4)
+        self.assertAlmostEqual(metrics.recent_latency(), 0.3)
+        time.sleep(0.11)
+        self.assertEqual(metrics.recent_latency(), 0.0)
+
+
+class JsonCodecTest(unittest.TestCase):
+    """JSON codec unit tests."""
+
+    data = {
+        'registrationDate': datetime(2010, 1, 1, 0, 0, 0, 123456, timezone.utc),
+        'amount': Decimal('1.10'),
+        'person': {'firstName': 'Fírst', 'lastName': None, 'tags': ['a', 1, 2.5, True]},
+    }
+
+    def test_libraries_give_same_data(self):
+        self.assertEqual(json_codec.JSON_LIBRARY, 'orjson' if json_codec.orjson is not None else 'json')
+        self.assertEqual(json_codec.dumps, json_codec.orjson_dumps if json_codec.orjson is not None
+                         else json_codec.stdlib_dumps)
+        encoded = json_codec.stdlib_dumps(self.data)
+        self.assertEqual(loads(encoded)['registrationDate'], '2010-01-01T00:00:00.123Z')
+        self.assertEqual(json_codec.loads(encoded), loads(encoded))
+        if json_codec.orjson is not None:
+            self.assertEqual(loads(json_codec.orjson_dumps(self.data)), loads(encoded))
+            self.assertEqual(json_codec.orjson.loads(encoded), loads(encoded))
+        with self.assertRaises(ValueError):
+            json_codec.loads(b'{"registrationDate": ')
+
+    def test_response(self):
+        response = json_codec.json_response({'registrationId': 'id'}, status=201)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(loads(response.content), {'registrationId': 'id'})
+
+    def test_asgi_body_size_limit(self):
+        calls = []
+        sent = []
+
+        async def application(scope, receive, send):
+            calls.append(scope)
+            if scope['type'] != 'http':
+                return
+            body = b''
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body += message['body']
+                if not message.get('more_body'):
+                    break
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': body})
+
+        async def send(message):
+            sent.append(message)
+
+        def receive_chunks(*chunks):
+            messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                        for i, chunk in enumerate(chunks)]
+
+            async def receive():
+                return messages.pop(0)
+            return receive
+
+        middleware = BodySizeLimitMiddleware(application, {'/small': 5}, 10)
+        for path, length in [('/', b'10'), ('/', b'11'), ('/small', b'6'), ('/', b'abc')]:
+            scope = {'type': 'http', 'path': path, 'headers': [(b'host', b'localhost'), (b'content-length', length)]}
+            async_to_sync(middleware)(scope, receive_chunks(b''), send)
+        async_to_sync(middleware)({'type': 'lifespan'}, None, send)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual([message['status'] for message in sent if 'status' in message], [200, 413, 413, 200])
+        self.assertEqual(loads(sent[3]['body'])['error']['code'], 'PayloadTooLarge')
+        self.assertIn('5 bytes', loads(sent[5]['body'])['error']['message'])
+
+        # A chunked body is counted while it is received.
+        sent.clear()
+        scope = {'type': 'http', 'path': '/small', 'headers': [(b'transfer-encoding', b'chunked')]}
+        async_to_sync(middleware)(scope, receive_chunks(b'abc', b'abc'), send)
+        async_to_sync(middleware)(scope, receive_chunks(b'ab', b'abc'), send)
+        self.assertEqual([message['status'] for message in sent if 'status' in message], [413, 200])
+        self.assertEqual(sent[-1]['body'], b'ababc')
+        # Django stops reading the request and does not respond after the rejection.
+        sent.clear()
+        scope = {'type': 'http', 'method': 'POST', 'path': '/api/v1/registrations', 'query_string': b'',
+                 'headers': [(b'content-type', b'application/json')]}
+        async_to_sync(BodySizeLimitMiddleware(get_asgi_application(), {}, 4))(
+            scope, receive_chunks(b'{"a"', b': 1}'), send)
+        self.assertEqual([message['type'] for message in sent], ['http.response.start', 'http.response.body'])
+        self.assertEqual(sent[0]['status'], 413)
+
+
+class StartupTest(unittest.TestCase):
+    """Worker startup unit tests."""
+
+    def test_api_settings_start_fast_and_keep_headers(self):
+        result = startup_benchmark.measure('backend.settings_api', ','.join(settings.CACHE_LOCATIONS), requests=10)
+        self.assertEqual(result['status'], 404)
+        self.assertEqual(result['headers']['X-Content-Type-Options'], 'nosniff')
+        self.assertIn('x-correlationid', result['headers'])
+        # Generous limits, the benchmark checks the tight ones.
+        self.assertLess(result['import'], 5)
+        self.assertLess(result['first_request'], 1)
+
+
+class LoggingTest(unittest.TestCase):
+    """Background JSON logging unit tests."""
+
+    def setUp(self):
+        self.stream = StringIO()
+        self.handler = BackgroundStreamHandler(self.stream)
+        self.handler.addFilter(RequestFilter())
+        self.handler.setFormatter(JsonFormatter())
+        self.logger = logging.getLogger('backend.tests.logging')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.stop()
+
+    def records(self) -> list:
+        self.handler.flush()
+        return [loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_records_are_written_in_background_as_json(self):
+        threads = []
+        formatter = self.handler.target.formatter
+        self.handler.target.setFormatter(mock.Mock(format=lambda record: (
+            threads.append(threading.current_thread()), formatter.format(record))[1]))
+        token = request_id.set('request-1')
+        try:
+            self.logger.info('Registered %s', 'id-1')
+        finally:
+            request_id.reset(token)
+        self.assertEqual(self.records(), [{
+            'time': mock.ANY, 'level': 'INFO', 'logger': 'backend.tests.logging', 'message': 'Registered id-1',
+            'x_correlation_id': 'request-1',
+        }])
+        self.assertNotEqual(threads, [threading.current_thread()])
+
+    def test_payloads_are_sampled_redacted_and_rendered_lazily(self):
+        data = {'locale': 'en', 'person': dumps({'firstName': 'First', 'lastName': 'Last', 'email': 'test@test.com'})}
+        with mock.patch('backend.logging.redact') as redact:
+            log_payload(self.logger, 'Requested data: %s', data)
+            self.logger.setLevel(logging.WARNING)
+            with override_settings(LOGGING_PAYLOADS={**settings.LOGGING_PAYLOADS, 'SAMPLE_RATE': 1}):
+                log_payload(self.logger, 'Requested data: %s', data)
+        redact.assert_not_called()
+        self.logger.setLevel(logging.INFO)
+        with override_settings(LOGGING_PAYLOADS={'SAMPLE_RATE': 1, 'REDACT': ['email', 'lastName']}):
+            log_payload(self.logger, 'Requested data: %s', data)
+            log_payload(self.logger, 'Requested user data: %s', b'{"locale": "en", "person": {"email": "a@b.c"}}')
+            messages = [record['message'] for record in self.records()]
+        self.assertEqual(messages, [
+            'Requested data: {"locale": "en", "person": {"firstName": "First", "lastName": "[REDACTED]", '
+            '"email": "[REDACTED]"}}',
+            'Requested user data: {"locale": "en", "person": {"email": "[REDACTED]"}}',
+        ])
+        self.assertNotIn('test@test.com', self.stream.getvalue())
+
+    def test_full_queue_drops_records(self):
+        handler = BackgroundStreamHandler(self.stream, queue_size=1)
+        registry.reset()
+        # The listener is not started, so nothing takes the records from the queue.
+        handler.pid = os.getpid()
+        handler.emit(logging.makeLogRecord({'msg': 'first'}))
+        handler.emit(logging.makeLogRecord({'msg': 'second'}))
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(registry.collect()['counters'][('log_records_dropped_total', ())], 1)
+        self.assertEqual(handler.queue.get_nowait().msg, 'first')
+        handler.queue.task_done()
+        handler.pid = None
+
+
+@unittest.skipUnless(importlib.util.find_spec('gunicorn'), 'gunicorn is not installed')
+class ServerTest(unittest.TestCase):
+    """Production server unit tests."""
+
+    # A batch of invalid registrations is validated and rejected without cache calls, so it loads the CPU only.
+    invalid_batch = dumps([{'locale': 'english'}] * 1000).encode()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.terminate()
+            server.wait(30)
+        self.directory.cleanup()
+
+    def start_server(self, workers: int, **environment) -> tuple[str, str]:
+        """
+        Starts the server and returns its URL and the metrics directory of its workers.
+        """
+        metrics_directory = os.path.join(self.directory.name, 'metrics-%d' % len(self.servers))
+        with socket.socket() as free:
+            free.bind(('127.0.0.1', 0))
+            address = '127.0.0.1:%d' % free.getsockname()[1]
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'],
+            cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL,
+            env={
+                **os.environ,
+                'DJANGO_SETTINGS_MODULE': 'backend.settings_api',
+                'SERVER_BIND': address,
+                'SERVER_WORKERS': str(workers),
+                'CACHE_LOCATIONS': ','.join(settings.CACHE_LOCATIONS),
+                'REGISTRATIONS_STORE_PATH': os.path.join(self.directory.name, 'registrations.sqlite3'),
+                'METRICS_DIRECTORY': metrics_directory,
+                'METRICS_FLUSH_INTERVAL': '0.1',
+                'ALLOWED_HOSTS': '127.0.0.1',
+                **environment,
+            },
+        )
+        self.servers.append(server)
+        url = 'http://' + address
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                urllib.request.urlopen(url + '/metrics', timeout=5)
+                return url, metrics_directory
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise
+                time.sleep(0.1)
+
+    def post_batches(self, url: str, clients: int, requests: int) -> float:
+        def client():
+            for _ in range(requests):
+                request = urllib.request.Request(url + '/api/v1/registrations:batch', self.invalid_batch,
+                                                 {'Content-Type': 'application/json'})
+                self.assertEqual(urllib.request.urlopen(request, timeout=30).status, 200)
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    def worker_pids(self, metrics_directory: str) -> set:
+        # Every worker writes the file of its metrics.
+        time.sleep(0.5)
+        return {name for name in os.listdir(metrics_directory) if name.endswith('.json')}
+
+    def test_workers_serve_wsgi_and_asgi(self):
+        for interface in ['wsgi', 'asgi']:
+            url, metrics_directory = self.start_server(2, SERVER_INTERFACE=interface)
+            registration = dumps({
+                'registrationDate': '2010-01-01T00:00:00.000000+01:00',
+                'locale': 'en',
+                'person': dumps({'firstName': 'First', 'lastName': 'Last', 'email': 'test@test.com'}),
+            }).encode()
+            response = urllib.request.urlopen(urllib.request.Request(
+                url + '/api/v1/registrations', registration, {'Content-Type': 'application/json'}), timeout=10)
+            self.assertEqual(response.status, 201)
+            registration_id = loads(response.read())['registrationId']
+            self.assertEqual(urllib.request.urlopen(url + '/api/v1/registrations/' + registration_id).status, 200)
+            self.post_batches(url, 4, 5)
+            self.assertEqual(len(self.worker_pids(metrics_directory)), 2)
+
+    def test_metrics_are_summed_without_directory(self):
+        url, _ = self.start_server(2, METRICS_DIRECTORY='')
+        self.post_batches(url, 4, 5)
+        time.sleep(0.5)
+        line = 'registrations_request_duration_seconds_count{endpoint="post_registrations_batch_endpoint",' \
+               'method="POST",status="200"} 20'
+        for _ in range(4):
+            self.assertIn(line, urllib.request.urlopen(url + '/metrics', timeout=10).read().decode())
+
+    def test_workers_are_recycled(self):
+        url, metrics_directory = self.start_server(1, SERVER_MAX_REQUESTS='20')
+        self.post_batches(url, 1, 60)
+        self.assertGreaterEqual(len(self.worker_pids(metrics_directory)), 3)
+
+    @unittest.skipUnless((os.cpu_count() or 1) >= 2, 'one CPU core')
+    def test_workers_scale_across_cores(self):
+        workers = min(os.cpu_count(), 4)
+        elapsed = {}
+        for count in [1, workers]:
+            url, _ = self.start_server(count)
+            self.post_batches(url, workers, 2)
+            elapsed[count] = self.post_batches(url, workers * 2, 10)
+        self.assertGreater(elapsed[1] / elapsed[workers], 1 + 0.25 * (workers - 1))
@@ -1,8 +1,26 @@
 """backend URL Configuration"""
+from django.conf import settings
 from django.urls import path
-from rest_api.views import get_registrations, post_registrations
+from backend.metrics import metrics
+from rest_api.views import (
+    aget_registrations,
+    aregistrations,
+    cache_capacity,
+    get_registrations,
+    lookup_registrations,
+    post_registrations_batch,
+    registrations,
+)
+
+if settings.REGISTRATIONS_ASYNC_VIEWS:
+    get_registrations = aget_registrations
+    registrations = aregistrations
 
 urlpatterns = [
-    path('api/v1/registrations', post_registrations, name='post_registrations_endpoint'),
+    path('metrics', metrics, name='metrics_endpoint'),
+    path('internal/cache-capacity', cache_capacity, name='cache_capacity_endpoint'),
+    path('api/v1/registrations', registrations, name='post_registrations_endpoint'),
+    path('api/v1/registrations:batch', post_registrations_batch, name='post_registrations_batch_endpoint'),
+    path('api/v1/registrations:lookup', lookup_registrations, name='lookup_registrations_endpoint'),
     path('api/v1/registrations/<str:registrationId>', get_registrations, name='get_registrations_endpoint'),
 ]
@@ -10,7 +10,15 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/wsgi/
 import os
 
 from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from django.urls import get_resolver
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# The URLconf imports the views, the storage and the cache backend, and every request looks through the database
+# backends, the dummy one here. Loading them with the application rather than on the first request keeps
+# the first request of a new worker almost as fast as the next ones.
+get_resolver().url_patterns
+connections.all()
@@ -0,0 +1,436 @@
+"""
+Load test of the registrations API running in-process.
+
+It drives the real WSGI or ASGI application of the project, with its middleware, URL routing and views,
+against the memcached stand-in started in a separate process (or a given memcached) and a temporary durable
+store. Requests are drawn from a mix of scenarios and sent at a fixed concurrency: threads for WSGI,
+tasks of one event loop for ASGI. The report gives the throughput, the p50/p95/p99 latency of every scenario
+and the memory allocated per request, measured with `tracemalloc` in a separate sequential pass.
+
+The results can be saved as a baseline and later runs compared to it: a throughput lower or a latency
+or allocation higher than the baseline by more than the threshold is a regression, and the exit code is 1.
+
+Run it from the `backend` folder:
+
+    python -m benchmarks.api --interface wsgi --concurrency 16 --requests 5000 --save-baseline baseline.json
+    python -m benchmarks.api --interface wsgi --concurrency 16 --requests 5000 --baseline baseline.json
+"""
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from io import BytesIO
+from json import dump, dumps, load
+from uuid import UUID
+
+DEFAULT_MIX = 'post_valid=30,post_invalid=10,get_hit=50,get_miss=10'
+
+VALID_POST = {
+    'registrationDate': '2021-01-01T00:00:00.000000+01:00',
+    'locale': 'en',
+    'person': dumps({'firstName': 'First', 'lastName': 'Last', 'email': 'test@test.com'}),
+}
+INVALID_POST = {
+    'registrationDate': '2021-13-01T00:00:00.000000+01:00',
+    'locale': 'english',
+    'person': dumps({'firstName': '', 'lastName': 'Last'}),
+}
+
+# Method, path (or `None` for a registration path), body and the expected status of every scenario.
+SCENARIOS = {
+    'post_valid': ('POST', '/api/v1/registrations', dumps(VALID_POST).encode(), 201),
+    'post_invalid': ('POST', '/api/v1/registrations', dumps(INVALID_POST).encode(), 400),
+    'get_hit': ('GET', None, b'', 200),
+    'get_miss': ('GET', None, b'', 404),
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+def parse_mix(mix: str) -> dict:
+    """
+    Parses the mix `scenario=weight,...` to a dict of the scenarios to their weights.
+    """
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError('Unknown scenario %r, the scenarios are %s' % (name, ', '.join(SCENARIOS)))
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def make_schedule(mix: dict, count: int, registration_ids: list[str], seed: int = 0) -> list[tuple]:
+    """
+    Draws `count` requests `(scenario, method, path, body)` from the mix. The schedule is the same for the same
+    seed, so runs to be compared send the same requests.
+    """
+    generator = random.Random(seed)
+    names = generator.choices(list(mix), weights=list(mix.values()), k=count)
+    schedule = []
+    for name in names:
+        method, path, body, _ = SCENARIOS[name]
+        if path is None:
+            if name == 'get_hit':
+                registration_id = generator.choice(registration_ids)
+            else:
+                registration_id = str(UUID(int=generator.getrandbits(128), version=4))
+            path = '/api/v1/registrations/' + registration_id
+        schedule.append((name, method, path, body))
+    return schedule
+
+
+def store_hits(count: int) -> list[str]:
+    """
+    Stores `count` registrations for the `get_hit` scenario and returns their IDs.
+    """
+    from rest_api.schema import check_registration
+    from rest_api.storage import create_registrations
+
+    data = check_registration(dict(VALID_POST), [])
+    registration_ids = create_registrations([data] * count)
+    return [registration_id for registration_id in registration_ids if isinstance(registration_id, str)]
+
+
+def get_host() -> str:
+    from django.conf import settings
+
+    return next((host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')), 'localhost')
+
+
+def wsgi_sender(application, host: str):
+    """
+    Returns `send(method, path, body, headers=None) -> status` calling the WSGI application,
+    which puts the response headers to `headers` if it is given.
+    """
+    def send(method: str, path: str, body: bytes, headers: dict = None) -> int:
+        status = []
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': '',
+            'SERVER_NAME': host,
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': host,
+            'REMOTE_ADDR': '127.0.0.1',
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+
+        def start_response(response_status, response_headers, exc_info=None):
+            status.append(response_status)
+            if headers is not None:
+                headers.update(response_headers)
+
+        response = application(environ, start_response)
+        try:
+            for _ in response:
+                pass
+        finally:
+            close = getattr(response, 'close', None)
+            if close is not None:
+                close()
+        return int(status[0].split(' ', 1)[0])
+
+    return send
+
+
+def asgi_sender(application, host: str):
+    """
+    Returns the coroutine function `send(method, path, body) -> status` calling the ASGI application.
+    """
+    async def send(method: str, path: str, body: bytes) -> int:
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': b'',
+            'root_path': '',
+            'headers': [
+                (b'host', host.encode()),
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+            ],
+            'client': ('127.0.0.1', 0),
+            'server': (host, 80),
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        status = []
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            # The client never disconnects.
+            await asyncio.Event().wait()
+
+        async def send_message(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        await application(scope, receive, send_message)
+        return status[0]
+
+    return send
+
+
+def run(interface: str, application, schedule: list[tuple], concurrency: int) -> dict:
+    """
+    Sends the scheduled requests with `concurrency` requests in flight. Returns the elapsed seconds,
+    the latencies of every scenario and the scenarios and statuses of the responses with an unexpected status.
+    """
+    latencies = {name: [] for name, *_ in schedule}
+    unexpected = []
+    host = get_host()
+    if interface == 'wsgi':
+        send = wsgi_sender(application, host)
+        positions = itertools.count()
+        barrier = threading.Barrier(concurrency + 1)
+
+        def worker():
+            barrier.wait()
+            for position in positions:
+                if position >= len(schedule):
+                    return
+                name, method, path, body = schedule[position]
+                started = time.perf_counter()
+                status = send(method, path, body)
+                latencies[name].append(time.perf_counter() - started)
+                if status != SCENARIOS[name][3]:
+                    unexpected.append((name, status))
+
+        workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in workers:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    else:
+        send = asgi_sender(application, host)
+
+        async def main():
+            positions = iter(schedule)
+
+            async def worker():
+                for name, method, path, body in positions:
+                    started = time.perf_counter()
+                    status = await send(method, path, body)
+                    latencies[name].append(time.perf_counter() - started)
+                    if status != SCENARIOS[name][3]:
+                        unexpected.append((name, status))
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return time.perf_counter() - started
+
+        elapsed = asyncio.run(main())
+    return {'elapsed': elapsed, 'latencies': latencies, 'unexpected': unexpected}
+
+
+def measure_allocations(interface: str, application, schedule: list[tuple]) -> dict:
+    """
+    Sends the scheduled requests one by one under `tracemalloc` and returns the mean peak of the memory
+    allocated while handling a request of every scenario, in KiB.
+    """
+    host = get_host()
+    if interface == 'wsgi':
+        send = wsgi_sender(application, host)
+    else:
+        loop = asyncio.new_event_loop()
+        asgi_send = asgi_sender(application, host)
+
+        def send(method, path, body):
+            return loop.run_until_complete(asgi_send(method, path, body))
+
+    allocated = {}
+    tracemalloc.start()
+    try:
+        for name, method, path, body in schedule:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            send(method, path, body)
+            allocated.setdefault(name, []).append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+        if interface != 'wsgi':
+            loop.close()
+    return {name: sum(sizes) / len(sizes) / 1024 for name, sizes in allocated.items()}
+
+
+def percentile(latencies: list[float], q: int) -> float:
+    return latencies[min(len(latencies) * q // 100, len(latencies) - 1)]
+
+
+def summarize(result: dict, allocations: dict) -> dict:
+    """
+    Builds the report of a run: the throughput and the latency percentiles in milliseconds of every scenario
+    and of all requests together, and the allocations per request.
+    """
+    elapsed = result['elapsed']
+    groups = dict(result['latencies'])
+    groups['all'] = [latency for latencies in result['latencies'].values() for latency in latencies]
+    report = {}
+    for name, latencies in groups.items():
+        latencies = sorted(latencies)
+        if not latencies:
+            continue
+        report[name] = {
+            'requests': len(latencies),
+            'throughput': len(latencies) / elapsed,
+            **{'p%d' % q: percentile(latencies, q) * 1e3 for q in PERCENTILES},
+        }
+        if name in allocations:
+            report[name]['alloc_kib'] = allocations[name]
+    if allocations:
+        report['all']['alloc_kib'] = sum(
+            allocations[name] * report[name]['requests'] for name in allocations if name in report
+        ) / report['all']['requests']
+    return report
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Returns the regressions of the report against the baseline report: a throughput lower or a latency
+    or allocation higher by more than `threshold`, a fraction of the baseline.
+    """
+    regressions = []
+    for name, current in report.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if current['throughput'] < previous['throughput'] * (1 - threshold):
+            regressions.append('%s: throughput %.0f/s is below the baseline %.0f/s' % (
+                name, current['throughput'], previous['throughput']))
+        for metric in ['p%d' % q for q in PERCENTILES] + ['alloc_kib']:
+            if metric in current and metric in previous and current[metric] > previous[metric] * (1 + threshold):
+                regressions.append('%s: %s %.3f is above the baseline %.3f' % (
+                    name, metric, current[metric], previous[metric]))
+    return regressions
+
+
+def print_report(report: dict, out=sys.stdout):
+    out.write('%-13s %9s %11s %10s %10s %10s %11s\n' % (
+        'scenario', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'alloc KiB'))
+    for name, row in report.items():
+        out.write('%-13s %9d %11.0f %10.3f %10.3f %10.3f %11s\n' % (
+            name, row['requests'], row['throughput'], row['p50'], row['p95'], row['p99'],
+            '%.1f' % row['alloc_kib'] if 'alloc_kib' in row else '-'))
+
+
+def serve_memcached(connection):
+    from testing.memcached import MemcachedServer
+
+    server = MemcachedServer().start()
+    connection.send(server.address)
+    connection.recv()
+    server.stop()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Load test of the registrations API running in-process.')
+    parser.add_argument('--interface', choices=['wsgi', 'asgi'], default='wsgi')
+    parser.add_argument('--concurrency', type=int, default=16, help='Requests in flight.')
+    parser.add_argument('--requests', type=int, default=5000, help='Number of the measured requests.')
+    parser.add_argument('--warmup', type=int, default=500, help='Number of the requests sent before measuring.')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Weights of the scenarios, %s by default.' % DEFAULT_MIX)
+    parser.add_argument('--hits', type=int, default=1000, help='Number of the registrations stored for get_hit.')
+    parser.add_argument('--allocations', type=int, default=200,
+                        help='Number of the requests sent under tracemalloc, 0 disables the measurement.')
+    parser.add_argument('--memcached', default='',
+                        help='host:port of memcached, the stand-in is started in a separate process by default.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--logging', action='store_true', help='Keep the request logs, they are disabled by default.')
+    parser.add_argument('--baseline', help='JSON file of the baseline to compare the results to.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed regression as a fraction of the baseline, 0.2 by default.')
+    parser.add_argument('--save-baseline', help='JSON file to save the results to as a baseline.')
+    options = parser.parse_args(argv)
+    mix = parse_mix(options.mix)
+
+    server = connection = None
+    if not options.memcached:
+        connection, child = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=serve_memcached, args=(child,), daemon=True)
+        server.start()
+        options.memcached = connection.recv()
+    store_directory = tempfile.TemporaryDirectory()
+    try:
+        # The settings are read once, so the environment is set up before Django.
+        os.environ['CACHE_LOCATIONS'] = options.memcached
+        os.environ['REGISTRATIONS_STORE_PATH'] = os.path.join(store_directory.name, 'registrations.sqlite3')
+        os.environ['REGISTRATIONS_ASYNC_VIEWS'] = '1' if options.interface == 'asgi' else '0'
+        os.environ.setdefault('ALLOWED_HOSTS', 'localhost')
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+        if options.interface == 'asgi':
+            from django.core.asgi import get_asgi_application
+            application = get_asgi_application()
+        else:
+            from django.core.wsgi import get_wsgi_application
+            application = get_wsgi_application()
+        if not options.logging:
+            import logging
+            logging.disable(logging.CRITICAL)
+
+        registration_ids = store_hits(options.hits)
+        schedule = make_schedule(mix, options.warmup + options.requests, registration_ids, options.seed)
+        run(options.interface, application, schedule[:options.warmup], options.concurrency)
+        result = run(options.interface, application, schedule[options.warmup:], options.concurrency)
+        allocations = {}
+        if options.allocations:
+            allocations = measure_allocations(options.interface, application, schedule[:options.allocations])
+    finally:
+        store_directory.cleanup()
+        if server is not None:
+            connection.send(None)
+            server.join()
+
+    report = summarize(result, allocations)
+    print('%s, concurrency %d, mix %s' % (options.interface.upper(), options.concurrency, options.mix))
+    print_report(report)
+    if result['unexpected']:
+        print('%d responses had an unexpected status, e.g. %s %d' % (len(result['unexpected']),
+                                                                     *result['unexpected'][0]))
+    configuration = {'interface': options.interface, 'concurrency': options.concurrency, 'mix': options.mix}
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as file:
+            dump({**configuration, 'report': report}, file, indent=2)
+    if options.baseline:
+        with open(options.baseline) as file:
+            baseline = load(file)
+        different = [name for name, value in configuration.items() if baseline.get(name) != value]
+        if different:
+            print('The baseline was measured with another %s' % ', '.join(different))
+        regressions = compare(report, baseline['report'], options.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+        print('No regressions against the baseline with the threshold %.0f%%.' % (options.threshold * 100))
+    return 1 if result['unexpected'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
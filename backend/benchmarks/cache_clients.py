@@ -0,0 +1,96 @@
+"""
+Benchmark of the pooled memcached backend against `python-memcached` under concurrency.
+
+It repeats the cache calls of `get_registrations` (`get` of a stored registration)
+and `post_registrations` (`add` of a new one) from several threads and reports the throughput
+and the p50/p99 latency of a call.
+
+Run it from the `backend` folder: `python -m benchmarks.cache_clients [host:port] [threads]`.
+Without the location, it starts the in-process memcached stand-in, which is slower than memcached itself,
+so point it at a real memcached to compare the clients.
+"""
+import os
+import sys
+import threading
+import time
+
+from uuid import uuid4
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+django.setup()
+
+from django.core.cache.backends.memcached import MemcachedCache  # noqa: E402
+
+from backend.cache.backends import ShardedMemcachedCache  # noqa: E402
+from testing.memcached import MemcachedServer  # noqa: E402
+
+BODY = (b'{"registrationDate": "2010-01-01T00:00:00.000000+01:00", "locale": "en", '
+        b'"person": {"firstName": "First", "lastName": "Last", "email": "test@test.com"}}')
+
+
+def get_registration(cache, registration_ids: list[str], i: int):
+    cache.get(registration_ids[i % len(registration_ids)])
+
+
+def post_registration(cache, registration_ids: list[str], i: int):
+    cache.add(str(uuid4()), BODY, None)
+
+
+def run(cache, pattern, registration_ids: list[str], threads: int, calls: int) -> dict:
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads + 1)
+
+    def worker():
+        own = []
+        barrier.wait()
+        for i in range(calls):
+            started = time.perf_counter()
+            pattern(cache, registration_ids, i)
+            own.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(own)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'throughput': len(latencies) / elapsed,
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[int(len(latencies) * 0.99)],
+    }
+
+
+def main(location: str = '', threads: int = 16, calls: int = 2000):
+    server = None
+    if not location:
+        server = MemcachedServer().start()
+        location = server.address
+    backends = [
+        ('python-memcached', MemcachedCache(location, {})),
+        ('pooled', ShardedMemcachedCache(location, {'OPTIONS': {'MAX_CONNECTIONS': threads}})),
+    ]
+    registration_ids = [str(uuid4()) for _ in range(1000)]
+    backends[1][1].set_many({registration_id: BODY for registration_id in registration_ids}, None)
+    try:
+        for pattern in (get_registration, post_registration):
+            for name, cache in backends:
+                result = run(cache, pattern, registration_ids, threads, calls)
+                print('%-18s %-16s %9.0f calls/s   p50 %7.3f ms   p99 %7.3f ms' % (
+                    pattern.__name__, name, result['throughput'], result['p50'] * 1e3, result['p99'] * 1e3
+                ))
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else '', *map(int, sys.argv[2:3]))
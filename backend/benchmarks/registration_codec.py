@@ -0,0 +1,98 @@
+"""
+Memory and time per registration of the storage formats.
+
+Memcached keeps an item in the chunk of the smallest slab class it fits in: 48 bytes of the item header, 8 bytes
+of CAS, 4 bytes of client flags when they are set, the key with a terminating zero and the value with `\\r\\n`.
+The chunk sizes grow from 96 bytes by the factor 1.25, as with the default `-n 48 -f 1.25`.
+
+Run it from the `backend` folder: `python -m benchmarks.registration_codec`.
+"""
+import os
+import pickle
+import random
+import string
+
+from json import dumps
+from timeit import repeat
+from uuid import uuid4
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+django.setup()
+
+from rest_api.codec import encode_record  # noqa: E402
+from rest_api.storage import body_digest, registration_body  # noqa: E402
+
+ITEM_HEADER = 48 + 8
+SLAB_PAGE = 1024 * 1024
+
+
+def slab_chunk_sizes(smallest: int = 96, factor: float = 1.25) -> list[int]:
+    sizes = []
+    size = smallest
+    while size < SLAB_PAGE / factor:
+        sizes.append(size)
+        size = int(size * factor + 7) // 8 * 8
+    return sizes + [SLAB_PAGE]
+
+
+CHUNK_SIZES = slab_chunk_sizes()
+
+
+def item_size(key: str, value: bytes, flags: int) -> int:
+    return ITEM_HEADER + (4 if flags else 0) + len(key) + 1 + len(value) + 2
+
+
+def chunk_size(size: int) -> int:
+    return next(chunk for chunk in CHUNK_SIZES if chunk >= size)
+
+
+def random_registration() -> dict:
+    def word(low, high):
+        return ''.join(random.choices(string.ascii_letters, k=random.randint(low, high)))
+
+    return {
+        'registrationDate': '2021-%02d-%02dT%02d:%02d:%02d.%06d+01:00' % (
+            random.randint(1, 12), random.randint(1, 28), random.randint(0, 23), random.randint(0, 59),
+            random.randint(0, 59), random.randint(0, 999999)),
+        'locale': random.choice(['en', 'de', 'fr', 'ru']),
+        'person': {
+            'firstName': word(3, 12),
+            'lastName': word(3, 16),
+            'email': '%s@%s.com' % (word(5, 15), word(4, 10)),
+        },
+    }
+
+
+def main(count: int = 10000):
+    random.seed(0)
+    registrations = [random_registration() for _ in range(count)]
+    key = ':1:' + str(uuid4())
+    formats = [
+        ('python', lambda data: (1, pickle.dumps(data, pickle.HIGHEST_PROTOCOL))),
+        ('json', lambda data: (0, dumps(data).encode())),
+        ('compact', lambda data: (0, encode_record(data, body_digest(dumps(data).encode())))),
+    ]
+    print('%-8s %12s %12s %15s %12s %12s' % (
+        'format', 'value bytes', 'item bytes', 'slab chunk', 'items/MB', 'encode+read'))
+    for name, encode in formats:
+        values = [encode(data) for data in registrations]
+        value_bytes = sum(len(value) for _, value in values) / count
+        items = [item_size(key, value, flags) for flags, value in values]
+        chunks = [chunk_size(size) for size in items]
+        per_mb = count * SLAB_PAGE / sum(chunks)
+        sample = registrations[:100]
+
+        def encode_and_read():
+            for data in sample:
+                flags, value = encode(data)
+                registration_body(pickle.loads(value) if flags else value)
+
+        seconds = min(repeat(encode_and_read, number=20, repeat=5)) / 20 / len(sample)
+        print('%-8s %12.1f %12.1f %15.1f %12.0f %9.2f us' % (
+            name, value_bytes, sum(items) / count, sum(chunks) / count, per_mb, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+Micro-benchmark of the `registrationDate` parser against `datetime.strptime`.
+
+Run it from the `backend` folder: `python -m benchmarks.registration_date`.
+"""
+from datetime import datetime
+from timeit import repeat
+
+from rest_api.errors import parse_registration_date
+
+VALUES = [
+    '2010-01-01T00:00:00.000000+01:00',
+    '2015-02-02T00:00:00.000000+02:00',
+    '2020-03-03T00:00:00.000000+03:00',
+    '2020-03-03T00:00:00.000000Z',
+    '2020-13-03T00:00:00.000000+03:00',
+]
+
+
+def run_strptime():
+    for value in VALUES:
+        try:
+            datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f%z')
+        except ValueError:
+            pass
+
+
+def run_parse_registration_date():
+    for value in VALUES:
+        parse_registration_date(value)
+
+
+def main(number: int = 20000):
+    results = {}
+    for name, function in [('strptime', run_strptime), ('parse_registration_date', run_parse_registration_date)]:
+        results[name] = min(repeat(function, number=number, repeat=5)) / number / len(VALUES)
+        print('%-24s %8.3f us per value' % (name, results[name] * 1e6))
+    print('%-24s %8.2fx' % ('speedup', results['strptime'] / results['parse_registration_date']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Startup time of a worker with the full and the API-only settings.
+
+Every measurement runs in a new Python process, like a worker that is started to scale up: it reports
+the time to import Django and build the WSGI application, the latency of the first request, which
+connects to memcached and the durable store, and the mean latency of the next requests, which shows
+the cost of the middleware. The measurement fails if the import or the first request takes longer
+than the limits.
+
+Run it from the `backend` folder: `python -m benchmarks.startup [--max-import 1.5] [--max-first-request 0.1]`.
+Without `--memcached`, it starts the memcached stand-in.
+"""
+import time
+
+STARTED = time.perf_counter()
+
+import argparse  # noqa: E402
+import os  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+
+from json import dumps, loads  # noqa: E402
+
+SETTINGS_MODULES = ('backend.settings', 'backend.settings_api')
+MISSING_REGISTRATION = '/api/v1/registrations/00000000-0000-4000-8000-000000000000'
+
+
+def child(requests: int):
+    """
+    Measures the startup of this process and prints the results as JSON.
+    """
+    from backend.wsgi import application
+
+    imported = time.perf_counter() - STARTED
+
+    from benchmarks.api import get_host, wsgi_sender
+
+    send = wsgi_sender(application, get_host())
+    headers = {}
+    started = time.perf_counter()
+    status = send('GET', MISSING_REGISTRATION, b'', headers)
+    first_request = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(requests):
+        send('GET', MISSING_REGISTRATION, b'')
+    print(dumps({
+        'import': imported,
+        'first_request': first_request,
+        'request': (time.perf_counter() - started) / requests,
+        'status': status,
+        'headers': headers,
+        'modules': len(sys.modules),
+    }))
+
+
+def measure(settings_module: str, memcached: str, requests: int = 200) -> dict:
+    """
+    Starts a new process with the settings and returns its measurements.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE=settings_module,
+            CACHE_LOCATIONS=memcached,
+            REGISTRATIONS_STORE_PATH=os.path.join(directory, 'registrations.sqlite3'),
+            ALLOWED_HOSTS=os.environ.get('ALLOWED_HOSTS', 'localhost'),
+        )
+        environment.pop('REGISTRATIONS_ASYNC_VIEWS', None)
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.startup', '--child', '--requests', str(requests)],
+            env=environment, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            check=True, capture_output=True, text=True,
+        ).stdout
+    return loads(output.splitlines()[-1])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Startup time of a worker with the full and the API-only settings.')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--requests', type=int, default=200, help='Number of the requests after the first one.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of the started processes, the best is taken.')
+    parser.add_argument('--memcached', default='', help='host:port of memcached, the stand-in by default.')
+    parser.add_argument('--max-import', type=float, default=1.5, help='Limit of the import time in seconds.')
+    parser.add_argument('--max-first-request', type=float, default=0.1,
+                        help='Limit of the first request latency in seconds.')
+    options = parser.parse_args(argv)
+    if options.child:
+        child(options.requests)
+        return 0
+
+    server = None
+    if not options.memcached:
+        from testing.memcached import MemcachedServer
+
+        server = MemcachedServer().start()
+        options.memcached = server.address
+    failed = False
+    try:
+        print('%-22s %10s %15s %12s %8s' % ('settings', 'import s', 'first request ms', 'request ms', 'modules'))
+        for settings_module in SETTINGS_MODULES:
+            runs = [measure(settings_module, options.memcached, options.requests) for _ in range(options.repeat)]
+            best = {name: min(result[name] for result in runs) for name in ('import', 'first_request', 'request')}
+            print('%-22s %10.3f %15.2f %12.3f %8d' % (
+                settings_module, best['import'], best['first_request'] * 1e3, best['request'] * 1e3,
+                runs[0]['modules']))
+            if best['import'] > options.max_import or best['first_request'] > options.max_first_request:
+                print('REGRESSION %s starts slower than the limits: import %.3f s of %.3f s, '
+                      'first request %.3f s of %.3f s' % (settings_module, best['import'], options.max_import,
+                                                          best['first_request'], options.max_first_request))
+                failed = True
+    finally:
+        if server is not None:
+            server.stop()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Gunicorn configuration of the production server: `gunicorn -c gunicorn.conf.py` in the `backend` folder.
+
+`SERVER_INTERFACE=wsgi` (the default) serves `backend.wsgi` with threaded workers, `asgi` serves `backend.asgi`
+with uvicorn workers. The application is loaded once in the master and the workers are forked from it, so they
+share its memory and start at once; connections to memcached and the durable store are opened by every worker
+itself. A worker is replaced after `SERVER_MAX_REQUESTS` requests, and stopped ones get `SERVER_GRACEFUL_TIMEOUT`
+seconds to finish their requests on `SIGTERM` and `SIGHUP`.
+"""
+import os
+import shutil
+import tempfile
+
+from multiprocessing import cpu_count
+
+interface = os.getenv('SERVER_INTERFACE', 'wsgi')
+
+bind = os.getenv('SERVER_BIND', '0.0.0.0:8000')
+
+# Threaded WSGI workers wait for memcached with the GIL released, so a worker per core is not enough;
+# an event loop of an ASGI worker keeps its core busy by itself.
+workers = int(os.getenv('SERVER_WORKERS', '0')) or (cpu_count() * 2 + 1 if interface == 'wsgi' else cpu_count())
+if interface == 'asgi':
+    wsgi_app = 'backend.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'backend.wsgi:application'
+    worker_class = 'gthread'
+    threads = int(os.getenv('SERVER_THREADS', '4'))
+
+preload_app = True
+
+max_requests = int(os.getenv('SERVER_MAX_REQUESTS', '10000'))
+# Workers started together are not recycled all at once.
+max_requests_jitter = max_requests // 10
+timeout = int(os.getenv('SERVER_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('SERVER_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('SERVER_KEEPALIVE', '5'))
+
+# The workers write their metrics to a shared directory, so /metrics of any of them serves the sum of all.
+# Without `METRICS_DIRECTORY`, every run gets a new one; the settings are read after this file in the master.
+if not os.getenv('METRICS_DIRECTORY'):
+    os.environ['METRICS_DIRECTORY'] = tempfile.mkdtemp(prefix='gunicorn-metrics-')
+    temporary_metrics_directory = os.environ['METRICS_DIRECTORY']
+else:
+    temporary_metrics_directory = None
+
+accesslog = None
+errorlog = '-'
+
+
+def on_starting(server):
+    # The metrics files of the workers of the previous run would be summed with the new ones.
+    directory = os.getenv('METRICS_DIRECTORY')
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                os.remove(os.path.join(directory, name))
+
+
+def on_exit(server):
+    if temporary_metrics_directory:
+        shutil.rmtree(temporary_metrics_directory, ignore_errors=True)
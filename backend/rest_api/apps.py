@@ -1,5 +1,20 @@
 from django.apps import AppConfig
+from django.conf import settings
+
+DUMMY_DATABASE_ENGINE = 'django.db.backends.dummy'
 
 
 class RestApiConfig(AppConfig):
     name = 'rest_api'
+
+    def ready(self):
+        # There is no database. The handlers that reset the queries and close the old connections of every database
+        # on every request would only load the dummy backend on the first request and iterate it on every one.
+        if all(database.get('ENGINE', DUMMY_DATABASE_ENGINE) == DUMMY_DATABASE_ENGINE
+               for database in settings.DATABASES.values()):
+            from django.core.signals import request_finished, request_started
+            from django.db import close_old_connections, reset_queries
+
+            request_started.disconnect(reset_queries)
+            request_started.disconnect(close_old_connections)
+            request_finished.disconnect(close_old_connections)
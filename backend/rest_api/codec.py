@@ -0,0 +1,117 @@
+"""
+Compact binary record of a registration kept in the cache.
+
+A record is a header byte followed by the payload. The low 7 bits of the header are the version of the layout,
+the high bit tells that the payload is compressed with zlib. The payload of version 1 is the length-prefixed
+UTF-8 strings of `registrationDate`, `locale`, `firstName`, `lastName` and `email` in this order, and then
+the length-prefixed JSON of the other fields, if there are any: `[top-level fields, person fields]`.
+Lengths are unsigned LEB128 varints, so a string shorter than 128 bytes costs one byte of length.
+Version 2 puts the `ETAG_SIZE` bytes of the digest of the response body between the header and the payload,
+uncompressed, so the ETag is read without decoding the record. Records of version 1 are still decoded.
+
+A JSON body starts with `{` and never with a header byte, so both kinds of values can be told apart.
+"""
+import zlib
+
+from json import dumps, loads
+from typing import Union
+
+CODEC_VERSION = 2
+COMPRESSED = 0x80
+ETAG_SIZE = 8
+
+FIELDS = ('registrationDate', 'locale')
+PERSON_FIELDS = ('firstName', 'lastName', 'email')
+
+
+def is_record(value: bytes) -> bool:
+    return bool(value) and value[0] & ~COMPRESSED in (1, CODEC_VERSION)
+
+
+def record_etag(record: bytes) -> Union[bytes, None]:
+    """
+    Returns the digest stored in the record, `None` for records of version 1.
+    """
+    if record[0] & ~COMPRESSED == CODEC_VERSION:
+        return record[1:1 + ETAG_SIZE]
+    return None
+
+
+def ordered(data: dict) -> dict:
+    """
+    Returns the registration data with the fields in the order `decode_record` restores them.
+    """
+    person = data['person']
+    result = {name: data[name] for name in FIELDS}
+    result['person'] = {name: person[name] for name in PERSON_FIELDS}
+    result['person'].update((name, value) for name, value in person.items() if name not in PERSON_FIELDS)
+    result.update((name, value) for name, value in data.items() if name not in FIELDS and name != 'person')
+    return result
+
+
+def encode_varint(number: int) -> bytes:
+    encoded = bytearray()
+    while number >= 0x80:
+        encoded.append(number & 0x7f | 0x80)
+        number >>= 7
+    encoded.append(number)
+    return bytes(encoded)
+
+
+def encode_record(data: dict, etag: bytes, compress_min_bytes: int = 0) -> bytes:
+    """
+    Encodes the validated registration data with the `ETAG_SIZE` bytes of `etag`. The payload is compressed
+    if it is longer than `compress_min_bytes` and compression makes it shorter; 0 disables compression.
+    """
+    if len(etag) != ETAG_SIZE:
+        raise ValueError('The ETag digest must be %d bytes long' % ETAG_SIZE)
+    person = data['person']
+    parts = []
+    for value in [data[name] for name in FIELDS] + [person[name] for name in PERSON_FIELDS]:
+        encoded = value.encode()
+        parts.append(encode_varint(len(encoded)))
+        parts.append(encoded)
+    extra = {name: value for name, value in data.items() if name not in FIELDS and name != 'person'}
+    person_extra = {name: value for name, value in person.items() if name not in PERSON_FIELDS}
+    if extra or person_extra:
+        encoded = dumps([extra, person_extra], separators=(',', ':')).encode()
+        parts.append(encode_varint(len(encoded)))
+        parts.append(encoded)
+    payload = b''.join(parts)
+    if compress_min_bytes and len(payload) > compress_min_bytes:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            return bytes([CODEC_VERSION | COMPRESSED]) + etag + compressed
+    return bytes([CODEC_VERSION]) + etag + payload
+
+
+def decode_record(record: bytes) -> dict:
+    """
+    Restores the registration data encoded by `encode_record`.
+    """
+    header = record[0]
+    if not is_record(record):
+        raise ValueError('Unknown registration record version: %d' % (header & ~COMPRESSED))
+    start = 1 + ETAG_SIZE if header & ~COMPRESSED == CODEC_VERSION else 1
+    payload = zlib.decompress(record[start:]) if header & COMPRESSED else record
+    position = 0 if header & COMPRESSED else start
+    values = []
+    while position < len(payload):
+        length = 0
+        shift = 0
+        while True:
+            byte = payload[position]
+            position += 1
+            length |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        values.append(payload[position:position + length].decode())
+        position += length
+    data = dict(zip(FIELDS, values))
+    data['person'] = dict(zip(PERSON_FIELDS, values[len(FIELDS):]))
+    if len(values) > len(FIELDS) + len(PERSON_FIELDS):
+        extra, person_extra = loads(values[-1])
+        data.update(extra)
+        data['person'].update(person_extra)
+    return data
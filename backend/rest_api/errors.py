@@ -1,9 +1,11 @@
-from datetime import datetime
-from json import loads
-from re import match, IGNORECASE, UNICODE
+from datetime import datetime, timedelta, timezone
+from functools import cached_property, lru_cache
+from re import compile as re_compile, match, IGNORECASE, UNICODE
 from typing import Final, Union, TypedDict
 
-from django.http import JsonResponse
+from django.http import HttpResponse
+
+from backend.json_codec import dumps, loads
 
 
 def validate_registration_id(registrationId: str) -> bool:
@@ -16,16 +18,74 @@ def validate_registration_id(registrationId: str) -> bool:
     return False
 
 
+# The pattern `datetime.strptime` builds for `%Y-%m-%dT%H:%M:%S.%f%z`, without its locale and cache machinery.
+REGISTRATION_DATE_PATTERN: Final = re_compile(
+    r'(?P<Y>\d\d\d\d)-(?P<m>1[0-2]|0[1-9]|[1-9])-(?P<d>3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])'
+    r'T(?P<H>2[0-3]|[0-1]\d|\d):(?P<M>[0-5]\d|\d):(?P<S>6[0-1]|[0-5]\d|\d)\.(?P<f>[0-9]{1,6})'
+    r'(?P<z>[+-]\d\d:?[0-5]\d(:?[0-5]\d(\.\d{1,6})?)?|(?-i:Z))',
+    IGNORECASE
+)
+
+
+@lru_cache(maxsize=256)
+def get_timezone(z: str) -> Union[timezone, None]:
+    """
+    Returns the timezone for the `%z` offset of `datetime.strptime`, `None` for an invalid offset. \\
+    The timezones are cached for repeated offsets.
+    """
+    if z == 'Z':
+        return timezone.utc
+    if z[3] == ':':
+        z = z[:3] + z[4:]
+        if len(z) > 5:
+            if z[5] != ':':
+                return None
+            z = z[:5] + z[6:]
+    try:
+        offset = int(z[1:3]) * 3600 + int(z[3:5]) * 60 + int(z[5:7] or 0)
+        offset_fraction = int(z[8:].ljust(6, '0'))
+        if z[0] == '-':
+            offset, offset_fraction = -offset, -offset_fraction
+        if not offset and not offset_fraction:
+            return timezone.utc
+        return timezone(timedelta(seconds=offset, microseconds=offset_fraction))
+    except ValueError:
+        return None
+
+
+def parse_registration_date(registrationDate: str) -> Union[datetime, None]:
+    """
+    Parser for `registrationDate` field. \\
+    Required format: `%Y-%m-%dT%H:%M:%S.%f%z`, accepted exactly as `datetime.strptime` accepts it.
+    Returns the aware datetime converted to UTC (or with its own offset if UTC is out of the datetime range),
+    `None` for an invalid value.
+    """
+    found = REGISTRATION_DATE_PATTERN.match(registrationDate)
+    if not found or found.end() != len(registrationDate):
+        return None
+    year, month, day, hour, minute, second, fraction, z = found.groups()[:8]
+    tz = get_timezone(z)
+    if tz is None:
+        return None
+    try:
+        value = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                         int(fraction) * 10 ** (6 - len(fraction)), tz)
+    except ValueError:
+        return None
+    if tz is timezone.utc:
+        return value
+    try:
+        return value.astimezone(timezone.utc)
+    except OverflowError:
+        return value
+
+
 def validate_registration_date(registrationDate: str) -> bool:
     """
     Validation for `registrationDate` field. \\
     Required format: `%Y-%m-%dT%H:%M:%S.%f%z`.
     """
-    try:
-        datetime.strptime(registrationDate, '%Y-%m-%dT%H:%M:%S.%f%z')
-        return True
-    except ValueError:
-        return False
+    return parse_registration_date(registrationDate) is not None
 
 
 def validate_locale(locale: str) -> bool:
@@ -72,6 +132,17 @@ def validate_email(email: str) -> bool:
     return False
 
 
+def parse_content_length(value: Union[str, bytes, None]) -> Union[int, None]:
+    """
+    Returns the `Content-Length` of a request, 0 if it is missing, `None` if it is not a non-negative integer.
+    """
+    if not value:
+        return 0
+    if isinstance(value, bytes):
+        value = value.decode('latin-1')
+    return int(value) if value.isdigit() and value.isascii() else None
+
+
 class FieldError(TypedDict):
     """
     Typing for FieldError scheme.
@@ -84,18 +155,108 @@ class FieldError(TypedDict):
 FieldErrors = list[FieldError]
 
 
+# Encoded parts of the error bodies, precomputed at import for the static errors: the beginning of the body
+# up to the value of `fieldErrors` by the error code and message, and every field error by its field, code and message.
+# An error that is not here is encoded when its response is built.
+ENCODED_ERROR_HEADS: dict[tuple, bytes] = {}
+ENCODED_FIELD_ERRORS: dict[tuple, bytes] = {}
+
+
+# The separator of the items of an array in the output of the codec.
+ITEM_SEPARATOR: Final = dumps([0, 0])[2:-2]
+
+
+def encode_error_head(error_code: str, error_message: Union[str, None]) -> bytes:
+    body = dumps({'error': {'code': error_code, 'message': error_message}, 'fieldErrors': None})
+    return body[:-len(b'null}')]
+
+
+def precompute_error(error_code: str, error_message: Union[str, None] = None) -> Union[str, None]:
+    """
+    Encodes the beginning of the body of the error once. Returns the message.
+    """
+    ENCODED_ERROR_HEADS[(error_code, error_message)] = encode_error_head(error_code, error_message)
+    return error_message
+
+
+def precompute_field_error(field_error: FieldError) -> FieldError:
+    """
+    Encodes the field error once. Returns the field error.
+    """
+    ENCODED_FIELD_ERRORS[(field_error['field'], field_error['code'], field_error['message'])] = \
+        dumps(field_error)
+    return field_error
+
+
+def encode_error(error_code: str, error_message: Union[str, None], field_errors: Union[FieldErrors, None]) -> bytes:
+    """
+    Returns the JSON body of the error, joined from its precomputed parts when they exist.
+    """
+    head = ENCODED_ERROR_HEADS.get((error_code, error_message))
+    if head is None:
+        head = encode_error_head(error_code, error_message)
+    if field_errors is None:
+        return head + b'null}'
+    parts = []
+    for field_error in field_errors:
+        encoded = ENCODED_FIELD_ERRORS.get((field_error['field'], field_error['code'], field_error['message']))
+        parts.append(encoded if encoded is not None else dumps(field_error))
+    return head + b'[' + ITEM_SEPARATOR.join(parts) + b']}'
+
+
 class ApiException(Exception):
     """
-    Exception handler for REST API handlers.
+    Exception handler for REST API handlers. \\
+    The body and the response are built when they are used; the body of a static error is joined
+    from its parts encoded at import.
     """
     ERROR_VALIDATION_FAILED: Final = 'ValidationFailed'
     ERROR_INTERNAL_SERVER: Final = 'InternalServerError'
+    ERROR_IDEMPOTENCY_KEY_REUSED: Final = 'IdempotencyKeyReused'
+    ERROR_IDEMPOTENT_REQUEST_IN_PROGRESS: Final = 'IdempotentRequestInProgress'
+    ERROR_EMAIL_ALREADY_REGISTERED: Final = 'EmailAlreadyRegistered'
+    ERROR_TOO_MANY_REQUESTS: Final = 'TooManyRequests'
+    ERROR_SERVICE_OVERLOADED: Final = 'ServiceOverloaded'
+    ERROR_PAYLOAD_TOO_LARGE: Final = 'PayloadTooLarge'
+    ERROR_FORBIDDEN: Final = 'Forbidden'
 
     FIELD_ERROR_IS_REQUIRED_CODE: Final = 'IsRequired'
     FIELD_ERROR_INVALID_FORMAT_CODE: Final = 'InvalidFormat'
 
     FIELD_ERROR_IS_REQUIRED_MESSAGE: Final = 'The field is required'
 
+    ERROR_MESSAGE_INVALID_REGISTRATION_ID: Final = precompute_error(
+        ERROR_VALIDATION_FAILED,
+        'The UUID-v4 string in the format according to standard RFC 4122 is required for query string resource'
+    )
+    ERROR_MESSAGE_REGISTRATION_NOT_FOUND: Final = precompute_error(
+        ERROR_VALIDATION_FAILED, 'User with this registration ID is not present in the system'
+    )
+    ERROR_MESSAGE_EMPTY_BODY: Final = precompute_error(ERROR_VALIDATION_FAILED, 'The request body must not be empty')
+    ERROR_MESSAGE_NOT_ARRAY: Final = precompute_error(
+        ERROR_VALIDATION_FAILED, 'The request body must be a non-empty JSON array of registrations'
+    )
+    ERROR_MESSAGE_NOT_OBJECT: Final = precompute_error(
+        ERROR_VALIDATION_FAILED, 'The registration must be a JSON object'
+    )
+    ERROR_MESSAGE_IDEMPOTENCY_KEY_REUSED: Final = precompute_error(
+        ERROR_IDEMPOTENCY_KEY_REUSED, 'The idempotency key was already used for a request with another payload'
+    )
+    ERROR_MESSAGE_IDEMPOTENT_REQUEST_IN_PROGRESS: Final = precompute_error(
+        ERROR_IDEMPOTENT_REQUEST_IN_PROGRESS, 'A request with the idempotency key is in progress. Please retry later.'
+    )
+    ERROR_MESSAGE_TOO_MANY_REQUESTS: Final = precompute_error(
+        ERROR_TOO_MANY_REQUESTS, 'Too many requests. Please retry after the time in the Retry-After header.'
+    )
+    ERROR_MESSAGE_SERVICE_OVERLOADED: Final = precompute_error(
+        ERROR_SERVICE_OVERLOADED, 'The service is overloaded. Please retry after the time in the Retry-After header.'
+    )
+    ERROR_MESSAGE_FORBIDDEN: Final = precompute_error(
+        ERROR_FORBIDDEN, 'A valid bearer token is required in the Authorization header'
+    )
+    precompute_error(ERROR_VALIDATION_FAILED)
+    precompute_error(ERROR_EMAIL_ALREADY_REGISTERED)
+
     def __init__(self, http_code: int, request_id: str, error_code: str,
                  error_message: (str, None) = None,
                  field_errors: Union[FieldErrors, None] = None):
@@ -104,14 +265,20 @@ class ApiException(Exception):
         self.error_code = error_code
         self.error_message = error_message
         self.field_errors = field_errors
-        self.response = JsonResponse(
-            data={
-                'error': {
-                    'code': self.error_code,
-                    'message': self.error_message,
-                },
-                'fieldErrors': self.field_errors,
+
+    @cached_property
+    def body(self) -> dict:
+        return {
+            'error': {
+                'code': self.error_code,
+                'message': self.error_message,
             },
-            status=http_code
-        )
-        self.response['x-correlationid'] = self.request_id
+            'fieldErrors': self.field_errors,
+        }
+
+    @cached_property
+    def response(self) -> HttpResponse:
+        response = HttpResponse(encode_error(self.error_code, self.error_message, self.field_errors),
+                                content_type='application/json', status=self.http_code)
+        response['x-correlationid'] = self.request_id
+        return response
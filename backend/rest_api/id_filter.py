@@ -0,0 +1,226 @@
+"""
+Bloom filter of the issued registration IDs, shared by the workers of a host through a memory-mapped file.
+
+The file is a header of `HEADER` (magic, number of hash functions, number of bits, number of added IDs)
+followed by the bits. Bits are only ever set, under an exclusive `lockf` lock of the file, and read without it:
+an ID is added before the response that gives it to the client, so nobody asks for it earlier.
+`rebuild_id_filter` writes a new file with the bits of the old one and renames it over the old one under its lock;
+the workers see the new inode and map it instead.
+"""
+import fcntl
+import math
+import mmap
+import os
+import struct
+import threading
+
+from hashlib import blake2b
+from typing import Iterable, Union
+
+from django.conf import settings
+
+HEADER = struct.Struct('<4sIQQ')
+MAGIC = b'RIF1'
+
+
+def filter_size(capacity: int, false_positive_rate: float) -> tuple[int, int]:
+    """
+    Returns the number of bits and of hash functions of a filter of `capacity` IDs with the false positive rate.
+    """
+    bits = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+    return bits, max(1, round(bits / max(capacity, 1) * math.log(2)))
+
+
+def positions(registration_id: str, hashes: int, bits: int) -> list[int]:
+    digest = blake2b(registration_id.lower().encode(), digest_size=16).digest()
+    first = int.from_bytes(digest[:8], 'little')
+    second = int.from_bytes(digest[8:], 'little') | 1
+    return [(first + i * second) % bits for i in range(hashes)]
+
+
+def read_header(path: str) -> Union[tuple[int, int, int], None]:
+    """
+    Returns the number of hash functions, of bits and of added IDs of the filter file, `None` without a valid one.
+    """
+    try:
+        with open(path, 'rb') as file:
+            header = file.read(HEADER.size)
+    except FileNotFoundError:
+        return None
+    if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+        return None
+    return HEADER.unpack(header)[1:]
+
+
+def build_filter(path: str, registration_ids: Iterable[str], capacity: int, false_positive_rate: float) -> int:
+    """
+    Writes the filter of the IDs for `capacity` IDs to a new file and renames it to `path`. \\
+    A current file at least that large keeps its size, and its bits are merged in under its lock,
+    so the IDs the workers add to it while the new file is built are kept.
+    Returns the number of IDs in the filter.
+    """
+    bits, hashes = filter_size(capacity, false_positive_rate)
+    current = read_header(path)
+    if current is not None and current[1] >= bits:
+        hashes, bits, _ = current
+    data = bytearray(math.ceil(bits / 8))
+    count = 0
+    for registration_id in registration_ids:
+        added = False
+        for position in positions(registration_id, hashes, bits):
+            if not data[position >> 3] & 1 << (position & 7):
+                data[position >> 3] |= 1 << (position & 7)
+                added = True
+        # An ID that is listed twice sets no new bits the second time.
+        count += added
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    try:
+        old = open(path, 'r+b')
+    except FileNotFoundError:
+        old = None
+    try:
+        if old is not None:
+            # Workers add to the old file under this lock and check that it is still current, see `MappedFilter.add`.
+            fcntl.lockf(old, fcntl.LOCK_EX)
+            header = old.read(HEADER.size)
+            if len(header) == HEADER.size and HEADER.unpack(header)[:3] == (MAGIC, hashes, bits):
+                old_data = old.read(len(data))
+                if len(old_data) == len(data):
+                    merged = int.from_bytes(data, 'little') | int.from_bytes(old_data, 'little')
+                    data = merged.to_bytes(len(data), 'little')
+                    count = max(count, HEADER.unpack(header)[3])
+        with open(path + '.tmp', 'wb') as file:
+            file.write(HEADER.pack(MAGIC, hashes, bits, count))
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+    finally:
+        if old is not None:
+            fcntl.lockf(old, fcntl.LOCK_UN)
+            old.close()
+    return count
+
+
+class MappedFilter:
+    """
+    The filter file mapped by this process.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'r+b')
+        stat = os.fstat(self.file.fileno())
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.hashes, self.bits, _ = HEADER.unpack_from(self.map)
+        if magic != MAGIC or len(self.map) < HEADER.size + math.ceil(self.bits / 8):
+            self.close()
+            raise ValueError('%s is not a registration ID filter' % path)
+
+    @property
+    def count(self) -> int:
+        return HEADER.unpack_from(self.map)[3]
+
+    def contains(self, registration_id: str) -> bool:
+        data = self.map
+        for position in positions(registration_id, self.hashes, self.bits):
+            if not data[HEADER.size + (position >> 3)] & 1 << (position & 7):
+                return False
+        return True
+
+    def add(self, registration_ids: list[str]) -> bool:
+        """
+        Adds the IDs unless the file has been replaced, and returns whether it has not.
+        """
+        data = self.map
+        fcntl.lockf(self.file, fcntl.LOCK_EX)
+        try:
+            stat = os.stat(self.path)
+            if (stat.st_dev, stat.st_ino) != self.inode:
+                return False
+            for registration_id in registration_ids:
+                for position in positions(registration_id, self.hashes, self.bits):
+                    data[HEADER.size + (position >> 3)] |= 1 << (position & 7)
+            magic, hashes, bits, count = HEADER.unpack_from(data)
+            HEADER.pack_into(data, 0, magic, hashes, bits, count + len(registration_ids))
+        finally:
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
+        return True
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class IdFilter:
+    """
+    The registration ID filter in the file at `path`. \\
+    Until the file is built, every ID may be present, so lookups go to the cache as without the filter.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mapped = None
+        self.lock = threading.Lock()
+
+    def get_mapped(self) -> Union[MappedFilter, None]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        mapped = self.mapped
+        if mapped is None or mapped.inode != (stat.st_dev, stat.st_ino):
+            with self.lock:
+                if self.mapped is None or self.mapped.inode != (stat.st_dev, stat.st_ino):
+                    # The replaced map is left to the garbage collector, other threads may still read it.
+                    self.mapped = MappedFilter(self.path)
+                mapped = self.mapped
+        return mapped
+
+    def might_contain(self, registration_id: str) -> bool:
+        """
+        Returns `False` only for an ID that was never added.
+        """
+        mapped = self.get_mapped()
+        return mapped is None or mapped.contains(registration_id)
+
+    def add(self, registration_ids: list[str]):
+        mapped = self.get_mapped()
+        while mapped is not None and registration_ids:
+            with self.lock:
+                if mapped.add(registration_ids):
+                    return
+            # The file was replaced by `rebuild_id_filter` meanwhile, the IDs go to the new one.
+            mapped = self.get_mapped()
+
+    def stats(self) -> Union[dict, None]:
+        """
+        Returns the number of added IDs, the size of the file and the false positive rate expected
+        for that number, `None` until the file is built.
+        """
+        mapped = self.get_mapped()
+        if mapped is None:
+            return None
+        count = mapped.count
+        return {
+            'items': count,
+            'bytes': len(mapped.map),
+            'false_positive_rate': (1 - math.exp(-mapped.hashes * count / mapped.bits)) ** mapped.hashes,
+        }
+
+
+id_filters = {}
+
+
+def get_id_filter() -> Union[IdFilter, None]:
+    """
+    Returns the filter configured by `REGISTRATIONS_ID_FILTER`, `None` if it is disabled.
+    """
+    path = settings.REGISTRATIONS_ID_FILTER['PATH']
+    if not path:
+        return None
+    if path not in id_filters:
+        id_filters[path] = IdFilter(path)
+    return id_filters[path]
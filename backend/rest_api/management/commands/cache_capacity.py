@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.cache.capacity import OK, CapacityMonitor
+from backend.json_codec import dumps
+from rest_api.storage import check_cache_capacity
+
+
+def format_duration(seconds) -> str:
+    if seconds is None:
+        return 'never'
+    if seconds >= 2 * 24 * 60 * 60:
+        return '%.1f days' % (seconds / (24 * 60 * 60))
+    return '%.1f hours' % (seconds / (60 * 60))
+
+
+class Command(BaseCommand):
+    help = ('Reports how full the memcached nodes are, how fast they evict and fill up, and fails with warnings '
+            'before evictions start, e.g. in a periodic job.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=10,
+                            help='Seconds between the two polls the rates are computed from, '
+                                 '0 computes them since the nodes started.')
+        parser.add_argument('--json', action='store_true', help='Writes the report as JSON.')
+
+    def handle(self, *args, **options):
+        monitor = CapacityMonitor()
+        if options['interval'] > 0:
+            check_cache_capacity(monitor)
+            time.sleep(options['interval'])
+        report = check_cache_capacity(monitor)
+        if options['json']:
+            self.stdout.write(dumps(report).decode())
+        else:
+            for location, node in report['nodes'].items():
+                if 'fill_ratio' not in node:
+                    self.stdout.write('%s: %s' % (location, node['status']))
+                    continue
+                self.stdout.write(
+                    '%s: %s, %.1f%% of %d MB full, %d items of %.0f bytes on average, %.2f written and %.2f evicted '
+                    'a second, full in %s.' % (
+                        location, node['status'], node['fill_ratio'] * 100, node['limit_maxbytes'] // (1024 * 1024),
+                        node['items'], node['average_item_size'] or 0, node['write_rate'], node['eviction_rate'],
+                        format_duration(node['seconds_to_full']),
+                    )
+                )
+            if report['registration_item_size'] is not None:
+                self.stdout.write('Registrations take %.0f bytes on average.' % report['registration_item_size'])
+        warnings = ['%s: %s' % (location, warning)
+                    for location, node in report['nodes'].items() for warning in node['warnings']]
+        if report['status'] != OK:
+            raise CommandError('Cache capacity is %s: %s.' % (report['status'], '; '.join(warnings)))
@@ -0,0 +1,44 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from rest_api.storage import iter_registration_ids, iter_registrations, registration_body
+
+
+class Command(BaseCommand):
+    help = ('Exports the registrations of the ID index to an NDJSON file or stdout, one JSON object per line '
+            'with its registrationId, in the order they were written.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='NDJSON file, stdout by default.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of registrations read with one get_many call.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        started = time.monotonic()
+        exported = missing = 0
+        output = sys.stdout.buffer if path == '-' else open(path, 'wb')
+        try:
+            for registration_ids in iter_registration_ids(options['chunk_size']):
+                for chunk, found in iter_registrations(registration_ids, options['chunk_size']):
+                    lines = []
+                    for registration_id in chunk:
+                        if registration_id not in found:
+                            missing += 1
+                            continue
+                        body = registration_body(found[registration_id])
+                        separator = b', ' if body != b'{}' else b''
+                        lines.append(b'{"registrationId": "%s"%s%s\n' % (registration_id.encode(), separator, body[1:]))
+                    output.write(b''.join(lines))
+                    exported += len(lines)
+        finally:
+            if output is sys.stdout.buffer:
+                output.flush()
+            else:
+                output.close()
+        elapsed = time.monotonic() - started
+        self.stderr.write('Exported %d registrations in %.2f s (%.0f per second), %d indexed ones are missing.' % (
+            exported, elapsed, exported / elapsed if elapsed else 0, missing
+        ))
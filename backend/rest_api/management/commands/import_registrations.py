@@ -0,0 +1,147 @@
+import sys
+import time
+
+from json import dumps, loads
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from rest_api.errors import ApiException, validate_registration_id
+from rest_api.schema import check_registration
+from rest_api.storage import EmailAlreadyRegistered, create_registrations, store_registrations
+
+
+class Command(BaseCommand):
+    help = ('Imports registrations from an NDJSON file or stdin, one JSON object per line in the format '
+            'of the POST request or of export_registrations. Lines are read and written in chunks, '
+            'so the memory does not grow with the input.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='NDJSON file, stdin by default.')
+        parser.add_argument('--chunk-size', type=int, default=settings.REGISTRATIONS_BATCH_WRITE_CHUNK_SIZE,
+                            help='Number of registrations written with one pipelined call.')
+        parser.add_argument('--errors', default=None,
+                            help='NDJSON file of the rejected lines, <path>.errors by default.')
+        parser.add_argument('--progress-interval', type=float, default=5.0,
+                            help='Seconds between the progress reports.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        errors_path = options['errors'] or ('import_registrations.errors' if path == '-' else path + '.errors')
+        self.started = time.monotonic()
+        self.counters = dict.fromkeys(['imported', 'skipped', 'rejected'], 0)
+        reported = self.started
+        chunk = []
+        try:
+            source = sys.stdin if path == '-' else open(path, encoding='utf-8')
+        except OSError as e:
+            raise CommandError('Cannot read %s: %s' % (path, e))
+        try:
+            with open(errors_path, 'w', encoding='utf-8') as errors:
+                for line_number, line in enumerate(source, 1):
+                    if not line.strip():
+                        continue
+                    item = self.parse_line(line, line_number, errors)
+                    if item is not None:
+                        chunk.append((line_number, *item))
+                    if len(chunk) >= options['chunk_size']:
+                        self.write_chunk(chunk, errors)
+                        chunk = []
+                    if time.monotonic() - reported >= options['progress_interval']:
+                        reported = time.monotonic()
+                        self.report(line_number)
+                self.write_chunk(chunk, errors)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        self.report()
+        if self.counters['rejected']:
+            self.stderr.write('Rejected lines are written to %s.' % errors_path)
+
+    def parse_line(self, line: str, line_number: int, errors):
+        """
+        Validates the line. Returns `(registration ID or None, clean data)` or writes the line to the errors file
+        and returns `None`.
+        """
+        try:
+            data = loads(line)
+        except ValueError:
+            return self.reject(errors, line_number, line, 'The line must be a JSON object')
+        if not isinstance(data, dict):
+            return self.reject(errors, line_number, line, 'The line must be a JSON object')
+        registration_id = data.pop('registrationId', None)
+        if registration_id is not None:
+            if not isinstance(registration_id, str) or not validate_registration_id(registration_id):
+                return self.reject(errors, line_number, line, 'The registrationId must be a UUID-v4 string', [{
+                    'field': 'registrationId',
+                    'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
+                    'message': 'The UUID-v4 string in the format according to standard RFC 4122 is required',
+                }])
+            registration_id = registration_id.lower()
+        # Exported registrations have `person` as an object, the POST payload has it as a JSON string.
+        if isinstance(data.get('person'), dict):
+            data['person'] = dumps(data['person'])
+        field_errors = []
+        data = check_registration(data, field_errors)
+        if field_errors:
+            return self.reject(errors, line_number, line, None, field_errors)
+        return registration_id, data
+
+    def reject(self, errors, line_number: int, line: str, message, field_errors=None):
+        self.counters['rejected'] += 1
+        errors.write(dumps({
+            'line': line_number,
+            'error': {'code': ApiException.ERROR_VALIDATION_FAILED, 'message': message},
+            'fieldErrors': field_errors,
+            'input': line.rstrip('\n'),
+        }) + '\n')
+        return None
+
+    def write_chunk(self, chunk: list, errors):
+        if not chunk:
+            return
+        # Registrations with their own IDs keep them; the stored ones are skipped, so an import can be repeated.
+        # The others are added under new IDs, see `create_registrations`.
+        given_ids = [registration_id for _, registration_id, _ in chunk if registration_id is not None]
+        existing = cache.get_many(given_ids) if given_ids else {}
+        registrations = {}
+        line_numbers = {}
+        new_lines = []
+        for line_number, registration_id, data in chunk:
+            if registration_id is None:
+                new_lines.append((line_number, data))
+            elif registration_id in existing or registration_id in registrations:
+                self.counters['skipped'] += 1
+            else:
+                registrations[registration_id] = data
+                line_numbers[registration_id] = line_number
+        new_ids = create_registrations([data for _, data in new_lines])
+        failed = [item for item, registration_id in zip(new_lines, new_ids) if registration_id is None]
+        # Unless duplicate emails are allowed, the ones with a registered email are skipped like the stored IDs.
+        duplicates = sum(isinstance(registration_id, EmailAlreadyRegistered) for registration_id in new_ids)
+        self.counters['skipped'] += duplicates
+        failed.extend(
+            (line_numbers[registration_id], {'registrationId': registration_id, **registrations[registration_id]})
+            for registration_id in store_registrations(registrations)
+        )
+        for line_number, data in sorted(failed, key=lambda item: item[0]):
+            self.counters['rejected'] += 1
+            errors.write(dumps({
+                'line': line_number,
+                'error': {
+                    'code': ApiException.ERROR_INTERNAL_SERVER,
+                    'message': 'The registration could not be stored',
+                },
+                'fieldErrors': None,
+                'input': dumps(data),
+            }) + '\n')
+        self.counters['imported'] += len(registrations) + len(new_lines) - len(failed) - duplicates
+
+    def report(self, line_number=None):
+        elapsed = time.monotonic() - self.started
+        imported = self.counters['imported']
+        self.stdout.write('%sImported %d registrations in %.2f s (%.0f per second), %d skipped, %d rejected.' % (
+            'Line %d: ' % line_number if line_number else '', imported, elapsed, imported / elapsed if elapsed else 0,
+            self.counters['skipped'], self.counters['rejected'],
+        ))
@@ -0,0 +1,48 @@
+import time
+
+from itertools import chain
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rest_api.id_filter import build_filter, get_id_filter
+from rest_api.persistence import get_store
+from rest_api.storage import index_size, iter_registration_ids
+
+
+class Command(BaseCommand):
+    help = ('Builds the registration ID filter from the durable store, the ID index and the current filter, '
+            'e.g. at startup.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of registration IDs read at a time.')
+
+    def handle(self, *args, **options):
+        config = settings.REGISTRATIONS_ID_FILTER
+        if not config['PATH']:
+            # It runs on every start, so a disabled filter is not an error.
+            self.stdout.write('The ID filter is disabled, REGISTRATIONS_ID_FILTER["PATH"] is empty.')
+            return
+        started = time.monotonic()
+        chunk_size = options['chunk_size']
+        # The store is written behind memcached and the ID index may have lost entries with it, so IDs are taken
+        # from both; the bits of the current file are merged in by `build_filter`.
+        indexed = index_size()
+        sources = [iter_registration_ids(chunk_size)]
+        capacity = max(config['CAPACITY'], indexed * 2)
+        store = get_store()
+        if store is not None:
+            store.flush()
+            capacity = max(capacity, store.count() * 2)
+            sources.insert(0, ([registration_id for registration_id, _ in chunk]
+                               for chunk in store.iter_chunks(chunk_size)))
+        registration_ids = (registration_id for chunk in chain(*sources) for registration_id in chunk)
+        count = build_filter(config['PATH'], registration_ids, capacity, config['FALSE_POSITIVE_RATE'])
+        # A filter that has grown cannot take the bits of the old one: the IDs indexed since the start were added
+        # to the old file, so they are added to the new one.
+        for chunk in iter_registration_ids(chunk_size, after=indexed):
+            get_id_filter().add(chunk)
+        self.stdout.write('Built the ID filter of %d registrations for %d in %.2f s.' % (
+            count, capacity, time.monotonic() - started
+        ))
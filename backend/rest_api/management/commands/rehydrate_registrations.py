@@ -0,0 +1,62 @@
+import time
+
+from json import loads
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from rest_api.persistence import get_store
+from rest_api.storage import (
+    INDEX_SEQUENCE_KEY, decode_registration_body, email_key, index_emails, index_registrations,
+)
+
+
+class Command(BaseCommand):
+    help = 'Loads all registrations from the durable store to memcached, e.g. after memcached restarts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of registrations written with one set_many call.')
+
+    def handle(self, *args, **options):
+        # It runs on every start, where the store may be disabled and memcached may not be ready yet: registrations
+        # missing in memcached are restored from the store when they are read, so a failure here is only reported.
+        store = get_store()
+        if store is None:
+            self.stdout.write('The durable store is disabled, REGISTRATIONS_STORE["PATH"] is empty.')
+            return
+        started = time.monotonic()
+        try:
+            loaded, failed = self.rehydrate(store, options['chunk_size'])
+        except Exception as e:
+            self.stderr.write('Rehydration failed: %s' % e)
+            return
+        elapsed = time.monotonic() - started
+        self.stdout.write('Rehydrated %d registrations in %.2f s (%.0f per second), %d failed.' % (
+            loaded, elapsed, loaded / elapsed if elapsed else 0, failed
+        ))
+        if failed:
+            self.stderr.write('%d registrations could not be written to memcached.' % failed)
+
+    def rehydrate(self, store, chunk_size: int) -> tuple[int, int]:
+        loaded = failed = 0
+        # The ID and email indexes are rebuilt only if they were lost together with the data,
+        # so they do not get duplicates.
+        reindex = cache.get(INDEX_SEQUENCE_KEY) is None
+        for chunk in store.iter_chunks(chunk_size):
+            failed_keys = cache.set_many({
+                registration_id: decode_registration_body(body) for registration_id, body in chunk
+            }, None)
+            failed += len(failed_keys)
+            loaded += len(chunk) - len(failed_keys)
+            if reindex:
+                failed_keys = set(failed_keys)
+                emails = {registration_id: loads(body)['person']['email'] for registration_id, body in chunk
+                          if registration_id not in failed_keys}
+                index_registrations(list(emails))
+                index_emails(emails)
+                if settings.REGISTRATIONS_DUPLICATE_EMAILS != 'allow':
+                    for registration_id, email in emails.items():
+                        cache.add(email_key(email), registration_id, None)
+        return loaded, failed
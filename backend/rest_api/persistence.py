@@ -0,0 +1,218 @@
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from typing import Iterator, Union
+
+from django.conf import settings
+
+from backend.metrics import count_store_write_failures
+
+logger = logging.getLogger('django')
+
+SHUTDOWN_FLUSH_TIMEOUT = 30
+
+
+class StoreFull(Exception):
+    """
+    The write queue stayed full, the registrations with `registration_ids` were not queued.
+    """
+
+    def __init__(self, registration_ids: list[str]):
+        super().__init__('%d registrations were not queued' % len(registration_ids))
+        self.registration_ids = registration_ids
+
+
+class RegistrationStore:
+    """
+    Durable store of registration bodies in SQLite in WAL mode. \\
+    Writes are queued and committed by a background thread in batches of up to `batch_size` rows
+    or every `flush_interval` seconds, so a request does not wait for the commit and its fsync.
+    A failed commit is retried with a growing delay of up to `max_retry_delay` seconds until it succeeds,
+    so queued registrations are not dropped while the database is locked or the disk is full.
+    Meanwhile new rows wait in the queue of up to `max_queue_size` rows; a request waits `queue_timeout` seconds
+    for room in it, then `StoreFull` is raised, so the registration is not acknowledged.
+    Reads use a connection per thread and are not blocked by the writer.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500, flush_interval: float = 0.05,
+                 synchronous: str = 'NORMAL', max_queue_size: int = 100000, queue_timeout: float = 5.0,
+                 max_retry_delay: float = 5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout
+        self.max_retry_delay = max_retry_delay
+        self.queue = queue.Queue(max_queue_size)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.writer = None
+        self.pid = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS registrations ('
+                'id TEXT PRIMARY KEY, body BLOB NOT NULL, created_at REAL NOT NULL)'
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=' + self.synchronous)
+        return connection
+
+    def reader(self) -> sqlite3.Connection:
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = self.connect()
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def start_writer(self):
+        # The writer is started lazily and again in a forked worker, where the thread of the parent does not exist.
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(self.max_queue_size)
+                self.writer = threading.Thread(target=self.write_loop, name='registration-store-writer', daemon=True)
+                self.writer.start()
+                self.pid = os.getpid()
+                # A worker does not hang on exit while the commits fail.
+                atexit.register(self.flush, SHUTDOWN_FLUSH_TIMEOUT)
+
+    def put(self, registration_id: str, body: bytes, overwrite: bool = False):
+        self.put_many([(registration_id, body)], overwrite)
+
+    def put_many(self, items: list[tuple[str, bytes]], overwrite: bool = False):
+        """
+        Queues registrations for writing. It does not wait for them to be committed.
+        A stored registration keeps its body unless `overwrite` is set; it keeps its position in `iter_chunks` anyway.
+        Raises `StoreFull` with the ones that were not queued.
+        """
+        if self.pid != os.getpid():
+            self.start_writer()
+        now = time.time()
+        for i, (registration_id, body) in enumerate(items):
+            try:
+                self.queue.put((registration_id, body, now, overwrite), timeout=self.queue_timeout)
+            except queue.Full:
+                logger.error('Rejected %d registrations, the queue of the durable store is full', len(items) - i)
+                count_store_write_failures('rejected', len(items) - i)
+                raise StoreFull([registration_id for registration_id, _ in items[i:]])
+
+    def flush(self, timeout: Union[float, None] = None) -> bool:
+        """
+        Waits until everything queued so far is committed, at most `timeout` seconds. Returns whether it is.
+        """
+        if self.pid != os.getpid():
+            return True
+        done = threading.Event()
+        try:
+            self.queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def write_loop(self):
+        connection = self.connect()
+        while True:
+            rows = []
+            waiters = []
+            item = self.queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    rows.append(item)
+                if len(rows) >= self.batch_size or waiters:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if rows:
+                self.write(connection, rows)
+            for waiter in waiters:
+                waiter.set()
+
+    def write(self, connection: sqlite3.Connection, rows: list[tuple[str, bytes, float, bool]]):
+        delay = self.flush_interval or 0.05
+        while True:
+            try:
+                with connection:
+                    connection.executemany(
+                        'INSERT INTO registrations (id, body, created_at) VALUES (?, ?, ?) '
+                        'ON CONFLICT(id) DO UPDATE SET body = excluded.body WHERE ?', rows
+                    )
+                return
+            except sqlite3.Error as e:
+                logger.error('Failed to persist %d registrations, retrying in %.2f s: %s', len(rows), delay, e)
+                count_store_write_failures('error', len(rows))
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    def get(self, registration_id: str) -> Union[bytes, None]:
+        row = self.reader().execute('SELECT body FROM registrations WHERE id = ?', (registration_id,)).fetchone()
+        return row[0] if row else None
+
+    def get_many(self, registration_ids: list[str]) -> dict:
+        found = {}
+        connection = self.reader()
+        for start in range(0, len(registration_ids), 500):
+            chunk = registration_ids[start:start + 500]
+            found.update(connection.execute(
+                'SELECT id, body FROM registrations WHERE id IN (%s)' % ', '.join('?' * len(chunk)), chunk
+            ).fetchall())
+        return found
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[list[tuple[str, bytes]]]:
+        """
+        Yields all stored registrations in the order they were written, `chunk_size` rows at a time.
+        """
+        last_rowid = 0
+        connection = self.connect()
+        try:
+            while True:
+                rows = connection.execute(
+                    'SELECT rowid, id, body FROM registrations WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                    (last_rowid, chunk_size)
+                ).fetchall()
+                if not rows:
+                    return
+                last_rowid = rows[-1][0]
+                yield [(registration_id, body) for _, registration_id, body in rows]
+        finally:
+            connection.close()
+
+    def count(self) -> int:
+        return self.reader().execute('SELECT COUNT(*) FROM registrations').fetchone()[0]
+
+
+stores = {}
+
+
+def get_store() -> Union[RegistrationStore, None]:
+    """
+    Returns the store configured by `REGISTRATIONS_STORE`, `None` if persistence is disabled.
+    """
+    options = settings.REGISTRATIONS_STORE
+    path = str(options['PATH'] or '')
+    if not path:
+        return None
+    if path not in stores:
+        stores[path] = RegistrationStore(
+            path,
+            batch_size=options.get('BATCH_SIZE', 500),
+            flush_interval=options.get('FLUSH_INTERVAL', 0.05),
+            synchronous=options.get('SYNCHRONOUS', 'NORMAL'),
+            max_queue_size=options.get('MAX_QUEUE_SIZE', 100000),
+            queue_timeout=options.get('QUEUE_TIMEOUT', 5.0),
+        )
+    return stores[path]
@@ -0,0 +1,152 @@
+from typing import Callable, Union
+
+from backend.json_codec import loads
+from rest_api.errors import (
+    ApiException,
+    FieldError,
+    FieldErrors,
+    precompute_field_error,
+    validate_email,
+    validate_locale,
+    validate_name_part,
+    validate_registration_date,
+)
+
+
+class Field:
+    """
+    Declaration of a string field of the payload. \\
+    The value is checked with `validator`, converted with `parser` (which raises `ValueError` for an invalid value)
+    and then, if `fields` is given, validated as a nested schema.
+    """
+
+    def __init__(self, message: str,
+                 required_message: str = ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE,
+                 validator: Union[Callable[[str], bool], None] = None,
+                 parser: Union[Callable[[str], object], None] = None,
+                 fields: Union[dict, None] = None):
+        self.message = message
+        self.required_message = required_message
+        self.validator = validator
+        self.parser = parser
+        self.fields = fields
+
+
+def parse_json_object(value: str) -> dict:
+    """
+    Parser for a field holding a JSON object as a string.
+    """
+    value = loads(value)
+    if not isinstance(value, dict):
+        raise ValueError('JSON object is required')
+    return value
+
+
+NAME_PART_MESSAGE = 'Does not match format: at least 1 character string, 150 characters maximum'
+
+REGISTRATION_SCHEMA = {
+    'registrationDate': Field(
+        message='The datetime string in the format "%Y-%m-%dT%H:%M:%S.%f%z" is required',
+        validator=validate_registration_date,
+    ),
+    'locale': Field(
+        message='The string in the format according to standard ISO 639-1 is required',
+        validator=validate_locale,
+        parser=str.lower,
+    ),
+    'person': Field(
+        message='It must be the valid JSON string',
+        parser=parse_json_object,
+        fields={
+            'firstName': Field(
+                message=NAME_PART_MESSAGE,
+                required_message='The field "person" includes "firstName". '
+                                 + ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE,
+                validator=validate_name_part,
+            ),
+            'lastName': Field(
+                message=NAME_PART_MESSAGE,
+                required_message='The field "person" includes "lastName". '
+                                 + ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE,
+                validator=validate_name_part,
+            ),
+            'email': Field(
+                message='The string in the format according to standard RFC 2822 (or RFC 822) is required',
+                required_message='The field "person" includes "email". '
+                                 + ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE,
+                validator=validate_email,
+            ),
+        },
+    ),
+}
+
+
+def compile_schema(schema: dict) -> Callable[[object, FieldErrors], dict]:
+    """
+    Compiles the declarative schema into a single validation function. \\
+    The field errors are built and encoded here once and shared by every call. The function appends
+    the errors of all fields to the given list and returns the payload with parsed values.
+    """
+    steps = []
+    for name, field in schema.items():
+        required_error: FieldError = precompute_field_error({
+            'field': name,
+            'code': ApiException.FIELD_ERROR_IS_REQUIRED_CODE,
+            'message': field.required_message,
+        })
+        invalid_error: FieldError = precompute_field_error({
+            'field': name,
+            'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
+            'message': field.message,
+        })
+        nested = compile_schema(field.fields) if field.fields else None
+        steps.append((name, field.validator, field.parser, nested, required_error, invalid_error))
+    steps = tuple(steps)
+    missing_errors = tuple(step[4] for step in steps)
+
+    def validate(data, field_errors: FieldErrors) -> dict:
+        if not isinstance(data, dict):
+            field_errors.extend(missing_errors)
+            return data
+        clean = dict(data)
+        for name, validator, parser, nested, required_error, invalid_error in steps:
+            if name not in data:
+                field_errors.append(required_error)
+                continue
+            value = data[name]
+            if not isinstance(value, str) or validator is not None and not validator(value):
+                field_errors.append(invalid_error)
+                continue
+            if parser is not None:
+                try:
+                    value = parser(value)
+                except ValueError:
+                    field_errors.append(invalid_error)
+                    continue
+            if nested is not None:
+                value = nested(value, field_errors)
+            clean[name] = value
+        return clean
+
+    return validate
+
+
+check_registration = compile_schema(REGISTRATION_SCHEMA)
+
+
+def validate_registration(data: dict, request_id: str) -> dict:
+    """
+    Validation for the registration payload. \\
+    It raises `ApiException` with the errors of all invalid fields at once.
+    Returns the payload with normalized `locale` and parsed `person`.
+    """
+    field_errors = []
+    data = check_registration(data, field_errors)
+    if field_errors:
+        raise ApiException(
+            http_code=400,
+            request_id=request_id,
+            error_code=ApiException.ERROR_VALIDATION_FAILED,
+            field_errors=field_errors
+        )
+    return data
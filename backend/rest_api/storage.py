@@ -0,0 +1,856 @@
+import logging
+
+from hashlib import sha256
+from json import dumps, loads
+from typing import Iterator, Union
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+from backend.cache.aio import get_async_cache
+from backend.cache.capacity import CapacityMonitor
+from backend.cache.local import LocalCache
+from backend.cache.protocol import MemcachedError, encode_value
+from backend.metrics import (
+    ID_FILTER_FALSE_POSITIVE_RATE, ID_FILTER_ITEMS, ID_FILTER_SIZE, LOCAL_CACHE_ENTRIES, LOCAL_CACHE_REMOVALS,
+    LOCAL_CACHE_SIZE, count_id_allocation_retries, count_id_filter_check, count_lookup, count_secondary_write_failures,
+    registry, timed,
+)
+from rest_api.codec import ETAG_SIZE, decode_record, encode_record, is_record, ordered, record_etag
+from rest_api.id_filter import get_id_filter
+from rest_api.persistence import StoreFull, get_store
+
+logger = logging.getLogger('django')
+
+# Per-worker L1 cache of registration bodies in front of memcached. Misses are never cached, so a registration
+# written by another worker is visible at once; changed ones may be served stale by other workers for `TTL` seconds.
+local_cache = LocalCache(
+    max_entries=settings.REGISTRATIONS_L1_CACHE['MAX_ENTRIES'],
+    max_bytes=settings.REGISTRATIONS_L1_CACHE['MAX_BYTES'],
+    ttl=settings.REGISTRATIONS_L1_CACHE['TTL'],
+)
+
+
+def encode_registration(data: dict) -> Union[bytes, dict]:
+    """
+    Transforms registration data to the value stored in the cache according to `REGISTRATIONS_STORAGE_FORMAT`. \\
+    The `compact` format stores the binary record of `rest_api.codec`, the smallest one.
+    The `json` format stores the response body itself, so reads serve it without unpickling and encoding again.
+    The `python` format stores the dict, which the cache pickles.
+    """
+    storage_format = settings.REGISTRATIONS_STORAGE_FORMAT
+    if storage_format == 'compact':
+        data = ordered(data)
+        return encode_record(data, body_digest(dumps(data, cls=DjangoJSONEncoder).encode()),
+                             settings.REGISTRATIONS_COMPRESS_MIN_BYTES)
+    if storage_format == 'json':
+        return dumps(data, cls=DjangoJSONEncoder).encode()
+    return data
+
+
+def body_digest(body: bytes) -> bytes:
+    return sha256(body).digest()[:ETAG_SIZE]
+
+
+def registration_etag(value: Union[bytes, dict]) -> str:
+    """
+    Returns the strong ETag of the JSON body of a stored registration. \\
+    Compact records keep the digest of the body computed when they were written, so it is read without decoding
+    them; for the other values it is computed from the body, which gives the same ETag.
+    """
+    if isinstance(value, bytes) and is_record(value):
+        digest = record_etag(value)
+        if digest is not None:
+            return '"%s"' % digest.hex()
+    return '"%s"' % body_digest(registration_body(value)).hex()
+
+
+def registration_body(value: Union[bytes, dict]) -> bytes:
+    """
+    Returns the JSON body of a stored registration of any storage format, so values written
+    before a change of the format are still served.
+    """
+    if isinstance(value, bytes):
+        if not is_record(value):
+            return value
+        value = decode_record(value)
+    return dumps(value, cls=DjangoJSONEncoder).encode()
+
+
+def decode_registration_body(body: bytes) -> Union[bytes, dict]:
+    """
+    Transforms the JSON body of a registration to the value stored in the cache, the reverse of `registration_body`.
+    """
+    storage_format = settings.REGISTRATIONS_STORAGE_FORMAT
+    if storage_format == 'json':
+        return body
+    if storage_format == 'compact':
+        return encode_registration(loads(body))
+    return loads(body)
+
+
+def persist_registrations(items: dict, overwrite: bool = False):
+    """
+    Writes the registrations stored in the cache through to the durable store, if it is enabled.
+    Stored ones are overwritten only with `overwrite`.
+    """
+    store = get_store()
+    if store is not None:
+        store.put_many(
+            [(registration_id, registration_body(value)) for registration_id, value in items.items()], overwrite
+        )
+
+
+# The ID index makes stored registrations enumerable, which memcached cannot do on its own: every written ID
+# is appended under the next position of the sequence. Index entries are evicted like any other item,
+# the durable store is the complete list.
+INDEX_SEQUENCE_KEY = 'registrations:index:seq'
+
+
+def index_key(position: int) -> str:
+    return 'registrations:index:%d' % position
+
+
+def index_registrations(registration_ids: list[str]):
+    """
+    Appends the IDs to the ID index, if it is enabled by `REGISTRATIONS_ID_INDEX`. \\
+    Positions for all of them are reserved with a single `incr`.
+    """
+    if not settings.REGISTRATIONS_ID_INDEX or not registration_ids:
+        return
+    try:
+        last = cache.incr(INDEX_SEQUENCE_KEY, len(registration_ids))
+    except ValueError:
+        cache.add(INDEX_SEQUENCE_KEY, 0, None)
+        last = cache.incr(INDEX_SEQUENCE_KEY, len(registration_ids))
+    first = last - len(registration_ids) + 1
+    cache.set_many({index_key(first + i): registration_id for i, registration_id in enumerate(registration_ids)}, None)
+
+
+async def aindex_registration(registration_id: str):
+    """
+    Async version of `index_registrations` for a single ID.
+    """
+    if not settings.REGISTRATIONS_ID_INDEX:
+        return
+    async_cache = get_async_cache()
+    try:
+        position = await async_cache.incr(INDEX_SEQUENCE_KEY)
+    except ValueError:
+        await async_cache.add(INDEX_SEQUENCE_KEY, 0, None)
+        position = await async_cache.incr(INDEX_SEQUENCE_KEY)
+    await async_cache.set(index_key(position), registration_id, None)
+
+
+def index_size() -> int:
+    """
+    Returns the last position of the ID index.
+    """
+    return cache.get(INDEX_SEQUENCE_KEY) or 0
+
+
+def iter_registration_ids(chunk_size: int, after: int = 0) -> Iterator[list[str]]:
+    """
+    Yields the IDs indexed after the position `after` in the order they were written, up to `chunk_size` IDs
+    at a time. \\
+    Positions written after the iteration has started are not included.
+    """
+    last = index_size()
+    for start in range(after + 1, last + 1, chunk_size):
+        keys = [index_key(position) for position in range(start, min(start + chunk_size, last + 1))]
+        found = cache.get_many(keys)
+        chunk = [found[key] for key in keys if key in found]
+        if chunk:
+            yield chunk
+
+
+def sample_registration_size(sample_size: int) -> Union[float, None]:
+    """
+    Returns the average size of the key and the value stored in memcached of the last `sample_size` indexed
+    registrations, `None` without them.
+    """
+    last = cache.get(INDEX_SEQUENCE_KEY) or 0
+    positions = range(max(1, last - sample_size + 1), last + 1)
+    registration_ids = list(cache.get_many([index_key(position) for position in positions]).values())
+    values = cache.get_many(registration_ids)
+    if not values:
+        return None
+    min_compress_len = getattr(cache, 'min_compress_len', 0)
+    return sum(
+        len(cache.make_key(registration_id)) + len(encode_value(value, min_compress_len)[1])
+        for registration_id, value in values.items()
+    ) / len(values)
+
+
+def check_cache_capacity(monitor: CapacityMonitor) -> dict:
+    """
+    Checks the capacity of the memcached nodes with the `CACHE_CAPACITY` settings, see `CapacityMonitor.check`. \\
+    The report also has the average size of the stored registrations, if the ID index is enabled.
+    """
+    config = settings.CACHE_CAPACITY
+    report = monitor.check(cache, config['WARN_FILL_RATIO'], config['WARN_SECONDS_TO_FULL'])
+    report['registration_item_size'] = (
+        sample_registration_size(config['SAMPLE_SIZE']) if settings.REGISTRATIONS_ID_INDEX else None
+    )
+    return report
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def email_key(email: str) -> str:
+    """
+    Returns the cache key of the email. It holds the ID of the registration that claimed the email,
+    `<key>:n` counts the registrations with the email and `<key>:<n>` holds the ID of the n-th of them.
+    """
+    return 'registrations:email:' + sha256(normalize_email(email).encode()).hexdigest()
+
+
+def index_emails(emails: dict):
+    """
+    Appends the registrations, a dict of ID to email, to the email index. \\
+    The positions of all registrations with the same email are allocated with one `incr`,
+    and the IDs are written with a single `set_many`.
+    """
+    registration_ids = {}
+    for registration_id, email in emails.items():
+        registration_ids.setdefault(email_key(email), []).append(registration_id)
+    slots = {}
+    for key, ids in registration_ids.items():
+        try:
+            last = cache.incr(key + ':n', len(ids))
+        except ValueError:
+            cache.add(key + ':n', 0, None)
+            last = cache.incr(key + ':n', len(ids))
+        for position, registration_id in enumerate(ids, last - len(ids) + 1):
+            slots['%s:%d' % (key, position)] = registration_id
+    if slots:
+        cache.set_many(slots, None)
+
+
+async def aindex_email(registration_id: str, email: str):
+    """
+    Async version of `index_emails` for a single registration.
+    """
+    async_cache = get_async_cache()
+    key = email_key(email)
+    try:
+        position = await async_cache.incr(key + ':n')
+    except ValueError:
+        await async_cache.add(key + ':n', 0, None)
+        position = await async_cache.incr(key + ':n')
+    await async_cache.set('%s:%d' % (key, position), registration_id, None)
+
+
+def find_registration_ids(email: str) -> list[str]:
+    """
+    Returns the IDs of the registrations with the email, the latest `REGISTRATIONS_EMAIL_MATCHES_MAX` of them
+    in the order they were written. It takes two cache round trips whatever the number of registrations is.
+    """
+    key = email_key(email)
+    count = cache.get(key + ':n')
+    if not count:
+        return []
+    keys = ['%s:%d' % (key, position)
+            for position in range(max(count - settings.REGISTRATIONS_EMAIL_MATCHES_MAX, 0) + 1, count + 1)]
+    found = cache.get_many(keys)
+    return list(dict.fromkeys(found[key] for key in keys if key in found))
+
+
+class EmailAlreadyRegistered(Exception):
+    """
+    Another registration has claimed the email.
+    """
+
+    def __init__(self, registration_id: str):
+        super().__init__(registration_id)
+        self.registration_id = registration_id
+
+
+def claim_email(email: str, registration_id: str):
+    """
+    Claims the email for the registration with the atomic `add`, so only one of concurrent requests gets it. \\
+    An email registered while duplicate emails were allowed has not been claimed, so it is claimed for the first
+    registration in the email index. Raises `EmailAlreadyRegistered` with the ID of the registration that has it.
+    """
+    key = email_key(email)
+    found = cache.get_many([key, key + ':n'])
+    existing = found.get(key)
+    if existing is None and found.get(key + ':n'):
+        existing = cache.get(key + ':1')
+        if existing is not None and not cache.add(key, existing, None):
+            existing = cache.get(key)
+    if existing is None:
+        if cache.add(key, registration_id, None):
+            return
+        existing = cache.get(key)
+        if existing is None:
+            raise StorageError('The email could not be claimed')
+    raise EmailAlreadyRegistered(existing)
+
+
+async def aclaim_email(email: str, registration_id: str):
+    """
+    Async version of `claim_email`.
+    """
+    async_cache = get_async_cache()
+    key = email_key(email)
+    found = await async_cache.get_many([key, key + ':n'])
+    existing = found.get(key)
+    if existing is None and found.get(key + ':n'):
+        existing = await async_cache.get(key + ':1')
+        if existing is not None and not await async_cache.add(key, existing, None):
+            existing = await async_cache.get(key)
+    if existing is None:
+        if await async_cache.add(key, registration_id, None):
+            return
+        existing = await async_cache.get(key)
+        if existing is None:
+            raise StorageError('The email could not be claimed')
+    raise EmailAlreadyRegistered(existing)
+
+
+def claim_emails(emails: dict) -> dict:
+    """
+    Claims the emails of several registrations, a dict of ID to email, with pipelined commands, see `claim_email`. \\
+    Of the registrations with the same email only the first one claims it.
+    Returns the IDs of the registrations that did not get their email with the ID of the registration that has it,
+    `None` if the email could not be claimed.
+    """
+    claimants = {}
+    duplicates = {}
+    for registration_id, email in emails.items():
+        key = email_key(email)
+        if key in claimants:
+            duplicates[registration_id] = claimants[key]
+        else:
+            claimants[key] = registration_id
+    found = cache.get_many(list(claimants) + [key + ':n' for key in claimants])
+    indexed = [key for key in claimants if key not in found and found.get(key + ':n')]
+    not_claimed = []
+    if indexed:
+        first = cache.get_many([key + ':1' for key in indexed])
+        claims = {key: first[key + ':1'] for key in indexed if key + ':1' in first}
+        found.update(claims)
+        not_claimed.extend(add_new(claims))
+    not_claimed.extend(add_new({
+        key: registration_id for key, registration_id in claimants.items() if key not in found
+    }))
+    if not_claimed:
+        claimed = cache.get_many(not_claimed)
+        found.update((key, claimed.get(key)) for key in not_claimed)
+    conflicts = {claimants[key]: found[key] for key in claimants if key in found}
+    for registration_id, claimant in duplicates.items():
+        conflicts[registration_id] = conflicts.get(claimant, claimant)
+    return conflicts
+
+
+def restore_registration(registration_id: str) -> Union[bytes, None]:
+    """
+    Gets the registration missing in the cache from the durable store and puts it back to the cache.
+    """
+    store = get_store()
+    if store is None:
+        return None
+    body = store.get(registration_id)
+    count_lookup('store', body is not None)
+    if body is not None:
+        cache.add(registration_id, decode_registration_body(body), None)
+    return body
+
+
+def restore_registrations(registration_ids: list[str]) -> dict:
+    """
+    Gets the registrations missing in the cache from the durable store and puts them back to the cache.
+    """
+    store = get_store()
+    if store is None or not registration_ids:
+        return {}
+    found = store.get_many(registration_ids)
+    if found:
+        cache.set_many({
+            registration_id: decode_registration_body(body) for registration_id, body in found.items()
+        }, None)
+    return found
+
+
+def get_registration(registration_id: str):
+    """
+    Gets the stored registration by its ID, see `registration_body` for getting its JSON. \\
+    Returns `None` if the registration is not present in the system.
+    """
+    value = local_cache.get(registration_id)
+    count_lookup('local', value is not None)
+    if value is None:
+        if not might_exist(registration_id):
+            return None
+        with timed('cache_get'):
+            value = cache.get(registration_id)
+        count_lookup('memcached', value is not None)
+        if value is None:
+            value = restore_registration(registration_id)
+        if value is not None:
+            value = remember_registration(registration_id, value)
+        elif id_filter_enabled():
+            count_id_filter_check('false_positive')
+    return value
+
+
+def id_filter_enabled() -> bool:
+    return bool(settings.REGISTRATIONS_ID_FILTER['PATH'])
+
+
+def might_exist(registration_id: str) -> bool:
+    """
+    Checks the registration ID in the ID filter, see `rest_api.id_filter`. \\
+    Returns `False` only for an ID that was never issued, which then is not looked up in memcached and the store.
+    """
+    id_filter = get_id_filter()
+    if id_filter is None:
+        return True
+    present = id_filter.might_contain(registration_id)
+    count_id_filter_check('present' if present else 'absent')
+    return present
+
+
+def remember_issued(registration_ids: list[str]):
+    """
+    Adds the stored registration IDs to the ID filter.
+    """
+    id_filter = get_id_filter()
+    if id_filter is not None:
+        id_filter.add(registration_ids)
+
+
+def id_filter_gauges() -> dict:
+    id_filter = get_id_filter()
+    stats = id_filter.stats() if id_filter is not None else None
+    if stats is None:
+        return {}
+    return {
+        (ID_FILTER_ITEMS, ()): stats['items'],
+        (ID_FILTER_SIZE, ()): stats['bytes'],
+        (ID_FILTER_FALSE_POSITIVE_RATE, ()): stats['false_positive_rate'],
+    }
+
+
+registry.add_gauges(id_filter_gauges)
+
+
+def local_cache_metrics() -> dict:
+    stats = local_cache.stats()
+    return {
+        'counters': {
+            (LOCAL_CACHE_REMOVALS, (('reason', 'eviction'),)): stats['evictions'],
+            (LOCAL_CACHE_REMOVALS, (('reason', 'expiration'),)): stats['expirations'],
+        },
+        'gauges': {(LOCAL_CACHE_ENTRIES, ()): stats['entries'], (LOCAL_CACHE_SIZE, ()): stats['bytes']},
+    }
+
+
+registry.add_collector(local_cache_metrics)
+
+
+def remember_registration(registration_id: str, value: Union[bytes, dict]) -> Union[bytes, dict]:
+    """
+    Puts the registration found in memcached to the L1 cache. Returns the value to serve.
+    """
+    if local_cache.enabled:
+        value = registration_body(value)
+        local_cache.set(registration_id, value, len(value))
+    return value
+
+
+def iter_registrations(registration_ids: list[str], chunk_size: int):
+    """
+    Gets registrations by their IDs with a single `get_many` call per chunk of `chunk_size` IDs. \\
+    Yields the IDs of every chunk together with the found part of it as a dict.
+    """
+    for start in range(0, len(registration_ids), chunk_size):
+        chunk = registration_ids[start:start + chunk_size]
+        found = {}
+        for registration_id in chunk:
+            value = local_cache.get(registration_id)
+            if value is not None:
+                found[registration_id] = value
+        missing = [
+            registration_id for registration_id in chunk
+            if registration_id not in found and might_exist(registration_id)
+        ]
+        if missing:
+            remote = cache.get_many(missing)
+            if len(remote) < len(missing):
+                remote.update(restore_registrations([
+                    registration_id for registration_id in missing if registration_id not in remote
+                ]))
+            for registration_id, value in remote.items():
+                found[registration_id] = remember_registration(registration_id, value)
+        yield chunk, found
+
+
+class StorageError(Exception):
+    """
+    The registration could not be stored.
+    """
+
+
+class StorageUnavailable(StorageError):
+    """
+    The durable store cannot take the registration now, a retry may succeed later.
+    """
+
+
+class IdempotencyKeyReused(Exception):
+    """
+    The idempotency key was already used for a request with another payload.
+    """
+
+
+class IdempotentRequestInProgress(Exception):
+    """
+    The request with the idempotency key has not stored its registration yet.
+    """
+
+
+def idempotency_cache_key(idempotency_key: str) -> str:
+    return 'idempotency:' + sha256(idempotency_key.encode()).hexdigest()
+
+
+def registration_fingerprint(data: dict) -> str:
+    return sha256(dumps(data, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+
+
+def replay_idempotent(record: dict, fingerprint: str) -> str:
+    """
+    Returns the registration ID remembered for the idempotency key. \\
+    Only completed records are replayed, a pending one raises `IdempotentRequestInProgress`.
+    Records written without the `completed` flag are completed ones.
+    """
+    if record['fingerprint'] != fingerprint:
+        raise IdempotencyKeyReused()
+    if not record.get('completed', True):
+        raise IdempotentRequestInProgress()
+    return record['registrationId']
+
+
+def secondary_write_failed(step: str, registration_ids: list[str], e: Exception):
+    """
+    Logs and counts a failed write that follows the stored registrations. \\
+    The registrations are stored already, so the request does not fail; the `rebuild_id_filter`
+    and `rehydrate_registrations` commands rebuild the ID filter and the indexes from the durable store.
+    """
+    logger.error('The %s write of %d stored registrations failed: %s', step, len(registration_ids), e)
+    count_secondary_write_failures(step, len(registration_ids))
+
+
+def index_stored(emails: dict):
+    """
+    Adds the stored registrations, a dict of ID to email, to the ID filter, the ID index and the email index.
+    """
+    registration_ids = list(emails)
+    for step, write, argument in (('id_filter', remember_issued, registration_ids),
+                                  ('id_index', index_registrations, registration_ids),
+                                  ('email_index', index_emails, emails)):
+        try:
+            write(argument)
+        except Exception as e:
+            secondary_write_failed(step, registration_ids, e)
+
+
+async def aindex_stored(registration_id: str, email: str):
+    """
+    Async version of `index_stored` for a single registration.
+    """
+    try:
+        remember_issued([registration_id])
+    except Exception as e:
+        secondary_write_failed('id_filter', [registration_id], e)
+    try:
+        await aindex_registration(registration_id)
+    except Exception as e:
+        secondary_write_failed('id_index', [registration_id], e)
+    try:
+        await aindex_email(registration_id, email)
+    except Exception as e:
+        secondary_write_failed('email_index', [registration_id], e)
+
+
+def create_registration(data: dict, idempotency_key: Union[str, None] = None) -> tuple[str, bool]:
+    """
+    Stores registration data under a newly allocated ID. \\
+    The ID is allocated with the atomic `add`, so a write takes one round trip without a check-then-set race.
+    With an idempotency key, a repeated call with the same data returns the ID of the first one once it is stored,
+    and `IdempotentRequestInProgress` is raised before; the key is released if the registration fails.
+    Unless `REGISTRATIONS_DUPLICATE_EMAILS` is `allow`, the email is claimed first and `EmailAlreadyRegistered`
+    is raised if another registration has it. `StorageUnavailable` is raised if the durable store cannot take it.
+    Returns the ID and whether the registration was created by this call.
+    """
+    value = encode_registration(data)
+    new_uuid = str(uuid4())
+    if idempotency_key is not None:
+        fingerprint = registration_fingerprint(data)
+        # The record stays pending until the registration is stored, so a retry never replays an ID that is not.
+        record = {'registrationId': new_uuid, 'fingerprint': fingerprint, 'completed': False}
+        key = idempotency_cache_key(idempotency_key)
+        if not cache.add(key, record, settings.REGISTRATIONS_IDEMPOTENCY_TTL):
+            existing = cache.get(key)
+            if existing is None:
+                raise StorageError('The idempotency key could not be stored')
+            return replay_idempotent(existing, fingerprint), False
+    email = data['person']['email']
+    unique_email = settings.REGISTRATIONS_DUPLICATE_EMAILS != 'allow'
+    claimed = False
+    try:
+        if unique_email:
+            claim_email(email, new_uuid)
+            claimed = True
+        for _ in range(settings.REGISTRATIONS_ID_ALLOCATION_ATTEMPTS):
+            with timed('cache_set'):
+                added = cache.add(new_uuid, value, None)
+            if added:
+                break
+            count_id_allocation_retries()
+            new_uuid = str(uuid4())
+            if unique_email:
+                cache.set(email_key(email), new_uuid, None)
+        else:
+            raise StorageError('The registration could not be stored')
+        try:
+            persist_registrations({new_uuid: value})
+        except StoreFull:
+            # The registration is not acknowledged, so it does not stay in the cache either.
+            cache.delete(new_uuid)
+            raise StorageUnavailable('The durable store cannot take the registration')
+        except Exception as e:
+            secondary_write_failed('persist', [new_uuid], e)
+        if idempotency_key is not None:
+            record.update(registrationId=new_uuid, completed=True)
+            cache.set(key, record, settings.REGISTRATIONS_IDEMPOTENCY_TTL)
+    except BaseException:
+        # A failed request must not leave its key behind, or its retries would wait for it until the key expires,
+        # nor its email claim, or the email would belong to a registration that does not exist.
+        if idempotency_key is not None:
+            cache.delete(key)
+        if claimed and cache.get(email_key(email)) == new_uuid:
+            cache.delete(email_key(email))
+        raise
+    local_cache.delete(new_uuid)
+    index_stored({new_uuid: email})
+    return new_uuid, True
+
+
+async def aget_registration(registration_id: str):
+    """
+    Async version of `get_registration` that does not block the event loop.
+    """
+    value = local_cache.get(registration_id)
+    count_lookup('local', value is not None)
+    if value is None:
+        if not might_exist(registration_id):
+            return None
+        with timed('cache_get'):
+            try:
+                value = await get_async_cache().get(registration_id)
+            except MemcachedError as e:
+                # Like the synchronous backend, a failed read is a miss served from the durable store.
+                logger.warning('Cache get of %s failed: %s', registration_id, e)
+                value = None
+        count_lookup('memcached', value is not None)
+        if value is None:
+            value = await sync_to_async(restore_registration, thread_sensitive=False)(registration_id)
+        if value is not None:
+            value = remember_registration(registration_id, value)
+        elif id_filter_enabled():
+            count_id_filter_check('false_positive')
+    return value
+
+
+async def acreate_registration(data: dict, idempotency_key: Union[str, None] = None) -> tuple[str, bool]:
+    """
+    Async version of `create_registration` that does not block the event loop.
+    """
+    async_cache = get_async_cache()
+    value = encode_registration(data)
+    new_uuid = str(uuid4())
+    if idempotency_key is not None:
+        fingerprint = registration_fingerprint(data)
+        # The record stays pending until the registration is stored, so a retry never replays an ID that is not.
+        record = {'registrationId': new_uuid, 'fingerprint': fingerprint, 'completed': False}
+        key = idempotency_cache_key(idempotency_key)
+        if not await async_cache.add(key, record, settings.REGISTRATIONS_IDEMPOTENCY_TTL):
+            existing = await async_cache.get(key)
+            if existing is None:
+                raise StorageError('The idempotency key could not be stored')
+            return replay_idempotent(existing, fingerprint), False
+    email = data['person']['email']
+    unique_email = settings.REGISTRATIONS_DUPLICATE_EMAILS != 'allow'
+    claimed = False
+    try:
+        if unique_email:
+            await aclaim_email(email, new_uuid)
+            claimed = True
+        for _ in range(settings.REGISTRATIONS_ID_ALLOCATION_ATTEMPTS):
+            with timed('cache_set'):
+                added = await async_cache.add(new_uuid, value, None)
+            if added:
+                break
+            count_id_allocation_retries()
+            new_uuid = str(uuid4())
+            if unique_email:
+                await async_cache.set(email_key(email), new_uuid, None)
+        else:
+            raise StorageError('The registration could not be stored')
+        try:
+            # A full write queue blocks for up to `QUEUE_TIMEOUT` seconds, off the event loop.
+            await sync_to_async(persist_registrations, thread_sensitive=False)({new_uuid: value})
+        except StoreFull:
+            # The registration is not acknowledged, so it does not stay in the cache either.
+            await async_cache.delete(new_uuid)
+            raise StorageUnavailable('The durable store cannot take the registration')
+        except Exception as e:
+            secondary_write_failed('persist', [new_uuid], e)
+        if idempotency_key is not None:
+            record.update(registrationId=new_uuid, completed=True)
+            await async_cache.set(key, record, settings.REGISTRATIONS_IDEMPOTENCY_TTL)
+    except BaseException:
+        # A failed request must not leave its key behind, or its retries would wait for it until the key expires,
+        # nor its email claim, or the email would belong to a registration that does not exist.
+        if idempotency_key is not None:
+            await async_cache.delete(key)
+        if claimed and await async_cache.get(email_key(email)) == new_uuid:
+            await async_cache.delete(email_key(email))
+        raise
+    local_cache.delete(new_uuid)
+    await aindex_stored(new_uuid, email)
+    return new_uuid, True
+
+
+def add_new(items: dict) -> list[str]:
+    """
+    Adds the items whose keys are not stored yet with a pipelined `add`. Returns the keys that were not added.
+    """
+    add_many = getattr(cache, 'add_many', None)
+    if add_many is not None:
+        return add_many(items, None)
+    return [key for key, value in items.items() if not cache.add(key, value, None)]
+
+
+def registrations_stored(values: dict, emails: dict, overwrite: bool = False) -> list[str]:
+    """
+    Persists and indexes the stored registrations, a dict of ID to the stored value, and their emails;
+    the durable store overwrites the ones it has only with `overwrite`. \\
+    The ones the durable store cannot take are deleted from the cache and returned; other failures are logged
+    and counted, see `secondary_write_failed`.
+    """
+    for registration_id in values:
+        local_cache.delete(registration_id)
+    try:
+        persist_registrations(values, overwrite)
+        rejected = []
+    except StoreFull as e:
+        rejected = e.registration_ids
+        cache.delete_many(rejected)
+        values = {
+            registration_id: value for registration_id, value in values.items() if registration_id not in rejected
+        }
+    except Exception as e:
+        rejected = []
+        secondary_write_failed('persist', list(values), e)
+    index_stored({registration_id: email for registration_id, email in emails.items() if registration_id in values})
+    return rejected
+
+
+def store_registrations(registrations: dict) -> list[str]:
+    """
+    Writes registration data under the given IDs, overwriting the stored ones. \\
+    The data is written with `set_many` in chunks of `REGISTRATIONS_BATCH_WRITE_CHUNK_SIZE` items,
+    the written IDs are persisted and indexed chunk by chunk. The email index gets the new registrations,
+    but duplicate emails are not checked here. Returns the IDs that failed to be stored.
+    """
+    items = list(registrations.items())
+    chunk_size = settings.REGISTRATIONS_BATCH_WRITE_CHUNK_SIZE
+    failed = []
+    for start in range(0, len(items), chunk_size):
+        chunk = {
+            registration_id: encode_registration(data) for registration_id, data in items[start:start + chunk_size]
+        }
+        chunk_failed = set(cache.set_many(chunk, None))
+        stored = {
+            registration_id: value for registration_id, value in chunk.items() if registration_id not in chunk_failed
+        }
+        failed.extend(chunk_failed)
+        failed.extend(registrations_stored(stored, {
+            registration_id: registrations[registration_id]['person']['email'] for registration_id in stored
+        }, overwrite=True))
+    return failed
+
+
+def create_registrations(registrations: list[dict]) -> list[Union[str, EmailAlreadyRegistered, None]]:
+    """
+    Stores several registrations at once under newly allocated IDs. \\
+    The registrations are written in chunks of `REGISTRATIONS_BATCH_WRITE_CHUNK_SIZE` items with a pipelined `add`,
+    so an ID is never overwritten; the ones that were not added get new IDs and are added again,
+    up to `REGISTRATIONS_ID_ALLOCATION_ATTEMPTS` times. Unless `REGISTRATIONS_DUPLICATE_EMAILS` is `allow`,
+    the emails are claimed first, see `claim_emails`.
+    Returns the allocated IDs in the order of `registrations`, `EmailAlreadyRegistered` for the ones with an email
+    that another registration has and `None` for the ones that failed to be stored.
+    """
+    chunk_size = settings.REGISTRATIONS_BATCH_WRITE_CHUNK_SIZE
+    unique_email = settings.REGISTRATIONS_DUPLICATE_EMAILS != 'allow'
+    results = [None] * len(registrations)
+    for start in range(0, len(registrations), chunk_size):
+        candidates = {str(uuid4()): index for index in range(start, min(start + chunk_size, len(registrations)))}
+        indexes = dict(candidates)
+        conflicts = {}
+        if unique_email:
+            conflicts = claim_emails({
+                registration_id: registrations[index]['person']['email'] for registration_id, index in indexes.items()
+            })
+            candidates = {
+                registration_id: index for registration_id, index in indexes.items() if registration_id not in conflicts
+            }
+        values = {index: encode_registration(registrations[index]) for index in candidates.values()}
+        for attempt in range(settings.REGISTRATIONS_ID_ALLOCATION_ATTEMPTS):
+            if attempt:
+                count_id_allocation_retries(len(candidates))
+                candidates = {str(uuid4()): index for index in candidates.values()}
+                if unique_email:
+                    cache.set_many({
+                        email_key(registrations[index]['person']['email']): registration_id
+                        for registration_id, index in candidates.items()
+                    }, None)
+            not_added = set(add_new({
+                registration_id: values[index] for registration_id, index in candidates.items()
+            }))
+            stored = {
+                registration_id: values[index]
+                for registration_id, index in candidates.items() if registration_id not in not_added
+            }
+            rejected = set(registrations_stored(stored, {
+                registration_id: registrations[candidates[registration_id]]['person']['email']
+                for registration_id in stored
+            }))
+            for registration_id in stored:
+                if registration_id not in rejected:
+                    results[candidates[registration_id]] = registration_id
+            if unique_email and rejected:
+                cache.delete_many([
+                    email_key(registrations[candidates[registration_id]]['person']['email'])
+                    for registration_id in rejected
+                ])
+            candidates = {registration_id: candidates[registration_id] for registration_id in not_added}
+            if not candidates:
+                break
+        if unique_email and candidates:
+            cache.delete_many([email_key(registrations[index]['person']['email']) for index in candidates.values()])
+        for registration_id, existing in conflicts.items():
+            if existing in indexes:
+                # A duplicate of an earlier registration in the chunk gets the ID it was stored under.
+                existing = results[indexes[existing]]
+            if existing is not None:
+                results[indexes[registration_id]] = EmailAlreadyRegistered(existing)
+    return results
@@ -1,9 +1,38 @@
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 
-from json import dumps
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import sha256
+from io import StringIO
+from json import dumps, loads
+from unittest import mock
 
+from asgiref.sync import async_to_sync
 from django.core.cache import cache
-from django.test import Client
+from django.core.management import call_command
+from django.test import AsyncRequestFactory, Client, override_settings
+
+from backend import json_codec
+from backend.cache.aio import AsyncMemcachedCache
+from backend.cache.protocol import MemcachedError
+from backend.metrics import registry
+from rest_api.errors import ApiException, parse_registration_date, validate_registration_date
+from rest_api.id_filter import IdFilter, build_filter, filter_size, get_id_filter
+from rest_api.persistence import RegistrationStore, StoreFull, get_store
+from rest_api.schema import validate_registration
+from rest_api.codec import ETAG_SIZE, decode_record, encode_record, is_record, ordered, record_etag
+from rest_api.storage import (
+    email_key, encode_registration, find_registration_ids, idempotency_cache_key, index_registrations, local_cache,
+    registration_body, registration_fingerprint,
+)
+from rest_api.views import aget_registrations, apost_registrations
 
 
 class RegistrationTest(unittest.TestCase):
@@ -137,10 +166,17 @@ class RegistrationTest(unittest.TestCase):
         ]
 
     def setUp(self):
-        pass
+        self.store_directory = tempfile.TemporaryDirectory()
+        self.store_settings = override_settings(REGISTRATIONS_STORE={
+            'PATH': os.path.join(self.store_directory.name, 'registrations.sqlite3'),
+        })
+        self.store_settings.enable()
 
     def tearDown(self):
+        self.store_settings.disable()
+        self.store_directory.cleanup()
         cache.clear()
+        local_cache.clear()
 
     def test_registration_post_201(self):
         for data in self.registration_post_data_201:
@@ -171,3 +207,835 @@ class RegistrationTest(unittest.TestCase):
         for data in self.registration_get_data_404:
             response = self.client.get('/api/v1/registrations/' + data)
             self.assertEqual(response.status_code, 404)
+
+    def test_registration_batch_post_200(self):
+        data = self.registration_post_data_201 + self.registration_post_data_400
+        response = self.client.post('/api/v1/registrations:batch', dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['index'] for result in results], list(range(len(data))))
+        for result in results[:len(self.registration_post_data_201)]:
+            self.assertEqual(self.client.get('/api/v1/registrations/' + result['registrationId']).status_code, 200)
+        for result in results[len(self.registration_post_data_201):]:
+            self.assertNotIn('registrationId', result)
+            self.assertEqual(result['error']['code'], 'ValidationFailed')
+
+    def test_registration_batch_post_400(self):
+        for data in ['', dumps([]), dumps({}), dumps(self.registration_post_data_201 * 1000)]:
+            response = self.client.post('/api/v1/registrations:batch', data, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_registration_lookup_200(self):
+        body = {
+            'registrationDate': '2020-01-01T00:00:00.000000+01:00',
+            'locale': 'en',
+            'person': {"firstName": "First", "lastName": "Last", "email": "test@test.com"},
+        }
+        for data in self.registration_get_data_200[:2]:
+            cache.set(data, body, None)
+        lookup = {'registrationIds': [data.upper() for data in self.registration_get_data_200]}
+        for threshold in [1000, 1]:
+            with override_settings(REGISTRATIONS_LOOKUP_STREAM_THRESHOLD=threshold,
+                                   REGISTRATIONS_LOOKUP_CHUNK_SIZE=2):
+                response = self.client.post('/api/v1/registrations:lookup', dumps(lookup),
+                                            content_type='application/json')
+                self.assertEqual(response.status_code, 200)
+                content = b''.join(response.streaming_content) if response.streaming else response.content
+                self.assertEqual(loads(content), {
+                    'registrations': {data: body for data in self.registration_get_data_200[:2]},
+                    'missing': self.registration_get_data_200[2:],
+                })
+
+    def test_registration_lookup_400(self):
+        for data in [{}, {'registrationIds': []}, {'registrationIds': self.registration_get_data_404},
+                     {'registrationIds': self.registration_get_data_200 * 5000}]:
+            response = self.client.post('/api/v1/registrations:lookup', dumps(data), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_registration_async_post_201(self):
+        store = get_store()
+        put_many = store.put_many
+        on_event_loop = []
+
+        def record_thread(items, overwrite=False):
+            try:
+                on_event_loop.append(asyncio.get_running_loop() is not None)
+            except RuntimeError:
+                on_event_loop.append(False)
+            put_many(items, overwrite)
+
+        for data in self.registration_post_data_201:
+            request = AsyncRequestFactory().post('/api/v1/registrations', dumps(data), content_type='application/json')
+            request.META['x-correlationid'] = 'test'
+            with mock.patch.object(store, 'put_many', side_effect=record_thread):
+                response = async_to_sync(apost_registrations)(request)
+            self.assertEqual(response.status_code, 201)
+            registration_id = loads(response.content)['registrationId']
+            self.assertEqual(loads(registration_body(cache.get(registration_id)))['locale'], data['locale'].lower())
+        # The write queue can block, so the store is not written on the event loop.
+        self.assertEqual(on_event_loop, [False] * len(self.registration_post_data_201))
+
+    def test_registration_async_post_400(self):
+        for data in self.registration_post_data_400:
+            request = AsyncRequestFactory().post('/api/v1/registrations', dumps(data), content_type='application/json')
+            request.META['x-correlationid'] = 'test'
+            self.assertEqual(async_to_sync(apost_registrations)(request).status_code, 400)
+
+    def test_registration_async_get(self):
+        body = {
+            'registrationDate': '2020-01-01T00:00:00.000000+01:00',
+            'locale': 'en',
+            'person': {"firstName": "First", "lastName": "Last", "email": "test@test.com"},
+        }
+        cache.set(self.registration_get_data_200[0], body, None)
+        for data, status_code in [(self.registration_get_data_200[0], 200)] + \
+                                 [(data, 404) for data in self.registration_get_data_404]:
+            request = AsyncRequestFactory().get('/api/v1/registrations/' + data)
+            request.META['x-correlationid'] = 'test'
+            response = async_to_sync(aget_registrations)(request, data)
+            self.assertEqual(response.status_code, status_code)
+        self.assertEqual(loads(async_to_sync(aget_registrations)(request, self.registration_get_data_200[0]).content),
+                         body)
+        request = AsyncRequestFactory().delete('/api/v1/registrations/' + self.registration_get_data_200[0])
+        self.assertEqual(async_to_sync(aget_registrations)(request, self.registration_get_data_200[0]).status_code, 405)
+
+        # A failed cache read falls back to the durable store like the synchronous one.
+        response = self.client.post('/api/v1/registrations', dumps(self.registration_post_data_201[0]),
+                                    content_type='application/json')
+        registration_id = response.json()['registrationId']
+        get_store().flush()
+        local_cache.clear()
+        request = AsyncRequestFactory().get('/api/v1/registrations/' + registration_id)
+        request.META['x-correlationid'] = 'test'
+        with mock.patch.object(AsyncMemcachedCache, 'get_keys', side_effect=MemcachedError('Connection closed')):
+            response = async_to_sync(aget_registrations)(request, registration_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(loads(response.content),
+                         loads(self.client.get('/api/v1/registrations/' + registration_id).content))
+
+    def test_registration_post_400_reports_all_fields(self):
+        data = {
+            'registrationDate': '2020-01-01',
+            'locale': 'english',
+            'person': dumps({"firstName": "", "email": "failed test"}),
+        }
+        response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([(error['field'], error['code']) for error in response.json()['fieldErrors']], [
+            ('registrationDate', 'InvalidFormat'),
+            ('locale', 'InvalidFormat'),
+            ('firstName', 'InvalidFormat'),
+            ('lastName', 'IsRequired'),
+            ('email', 'InvalidFormat'),
+        ])
+
+    def test_registration_storage_formats(self):
+        data = self.registration_post_data_201[0]
+        registration_ids = []
+        for storage_format, stored_type in [('compact', bytes), ('json', bytes), ('python', dict)]:
+            with override_settings(REGISTRATIONS_STORAGE_FORMAT=storage_format):
+                response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json')
+                registration_id = response.json()['registrationId']
+                registration_ids.append(registration_id)
+                value = cache.get(registration_id)
+                self.assertIsInstance(value, stored_type)
+                self.assertEqual(isinstance(value, bytes) and is_record(value), storage_format == 'compact')
+        # Values written in any format are read after the format is changed.
+        local_cache.clear()
+        for registration_id in registration_ids:
+            response = self.client.get('/api/v1/registrations/' + registration_id)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            self.assertEqual(response.json(), {**data, 'person': loads(data['person'])})
+
+    def test_registration_get_200_from_local_cache(self):
+        response = self.client.post('/api/v1/registrations', dumps(self.registration_post_data_201[0]),
+                                    content_type='application/json')
+        registration_id = response.json()['registrationId']
+        self.assertEqual(self.client.get('/api/v1/registrations/' + registration_id).status_code, 200)
+        hits = local_cache.stats()['hits']
+        cache.set(registration_id, b'{}', None)
+        response = self.client.get('/api/v1/registrations/' + registration_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['locale'], 'en')
+        self.assertEqual(local_cache.stats()['hits'], hits + 1)
+        gauges = registry.collect()['gauges']
+        self.assertEqual(gauges[('registrations_local_cache_entries', ())], local_cache.stats()['entries'])
+        self.assertEqual(gauges[('registrations_local_cache_size_bytes', ())], local_cache.stats()['bytes'])
+
+    def test_registration_get_304(self):
+        # The fields in another order than the compact record restores them.
+        data = dict(reversed(self.registration_post_data_201[0].items()))
+        for storage_format in ['json', 'python', 'compact']:
+            with override_settings(REGISTRATIONS_STORAGE_FORMAT=storage_format):
+                response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json')
+            path = '/api/v1/registrations/' + response.json()['registrationId']
+            response = self.client.get(path)
+            etag = response['ETag']
+            self.assertEqual(etag, '"%s"' % sha256(response.content).hexdigest()[:ETAG_SIZE * 2])
+            self.assertEqual(response['Cache-Control'], 'private, max-age=86400, immutable')
+            self.assertFalse(response.has_header('Vary'))
+            # The local cache and memcached give the same ETag.
+            self.assertEqual(self.client.get(path)['ETag'], etag)
+            local_cache.clear()
+            for if_none_match in [etag, 'W/' + etag, '"other", ' + etag, '*']:
+                response = self.client.get(path, HTTP_IF_NONE_MATCH=if_none_match)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b'')
+                self.assertEqual(response['ETag'], etag)
+                self.assertEqual(response['Cache-Control'], 'private, max-age=86400, immutable')
+            self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+        # A compact record is not decoded for 304.
+        with mock.patch.object(local_cache, 'max_entries', 0), \
+                mock.patch('rest_api.views.registration_body', side_effect=AssertionError):
+            self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            request = AsyncRequestFactory().get(path)
+            request.META.update({'x-correlationid': 'test', 'HTTP_IF_NONE_MATCH': etag})
+            self.assertEqual(async_to_sync(aget_registrations)(request, path.rsplit('/', 1)[1]).status_code, 304)
+        with override_settings(REGISTRATIONS_CACHE_CONTROL=''):
+            self.assertFalse(self.client.get(path).has_header('Cache-Control'))
+        with override_settings(REGISTRATIONS_CACHE_CONTROL='public, max-age=60'):
+            response = self.client.get(path)
+            self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+            self.assertEqual(response['Vary'], 'Authorization')
+        self.assertFalse(self.client.get('/api/v1/registrations/' + self.registration_get_data_404[0]).has_header('ETag'))
+
+    def test_registration_post_413(self):
+        data = dumps([self.registration_post_data_201[0]] * 3)
+        with override_settings(REGISTRATIONS_MAX_BODY_SIZE={'REGISTRATION': 100, 'BATCH': len(data) - 1,
+                                                           'LOOKUP': 10}):
+            for path, body in [('/api/v1/registrations', dumps(self.registration_post_data_201[0])),
+                               ('/api/v1/registrations:batch', data),
+                               ('/api/v1/registrations:lookup', dumps({'registrationIds': []}))]:
+                response = self.client.post(path, body, content_type='application/json')
+                self.assertEqual(response.status_code, 413)
+                self.assertEqual(response.json()['error']['code'], 'PayloadTooLarge')
+            response = self.client.post('/api/v1/registrations', '', content_type='application/json',
+                                        CONTENT_LENGTH='abc')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['fieldErrors'][0]['field'], 'Content-Length')
+            request = AsyncRequestFactory().post('/api/v1/registrations', dumps(self.registration_post_data_201[0]),
+                                                 content_type='application/json')
+            request.META['x-correlationid'] = 'test'
+            with mock.patch.object(type(request), 'body', new_callable=mock.PropertyMock) as body:
+                self.assertEqual(async_to_sync(apost_registrations)(request).status_code, 413)
+            body.assert_not_called()
+
+    def test_registration_post_201_idempotency_key(self):
+        data, other = self.registration_post_data_201[:2]
+        responses = [
+            self.client.post('/api/v1/registrations', dumps(data), content_type='application/json',
+                             HTTP_IDEMPOTENCY_KEY='key-1')
+            for _ in range(2)
+        ]
+        self.assertEqual([response.status_code for response in responses], [201, 201])
+        self.assertEqual(responses[0].json(), responses[1].json())
+        self.assertFalse(responses[0].has_header('Idempotent-Replayed'))
+        self.assertEqual(responses[1]['Idempotent-Replayed'], 'true')
+        response = self.client.post('/api/v1/registrations', dumps(other), content_type='application/json',
+                                    HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.json()['error']['code'], 'IdempotencyKeyReused')
+        request = AsyncRequestFactory().post('/api/v1/registrations', dumps(data), content_type='application/json')
+        request.META.update({'HTTP_IDEMPOTENCY_KEY': 'key-1', 'x-correlationid': 'test'})
+        self.assertEqual(loads(async_to_sync(apost_registrations)(request).content), responses[0].json())
+        response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json',
+                                    HTTP_IDEMPOTENCY_KEY='')
+        self.assertEqual(response.status_code, 400)
+
+    def test_registration_post_201_id_collision(self):
+        taken, free = self.registration_get_data_200[:2]
+        cache.set(taken, b'{}', None)
+        with mock.patch('rest_api.storage.uuid4', side_effect=[taken, free]):
+            response = self.client.post('/api/v1/registrations', dumps(self.registration_post_data_201[0]),
+                                        content_type='application/json')
+        self.assertEqual(response.json(), {'registrationId': free})
+        self.assertEqual(cache.get(taken), b'{}')
+        cache.delete(free)
+        data = self.registration_post_data_201[:2]
+        with mock.patch('rest_api.storage.uuid4', side_effect=[taken, free] + [taken] * 4):
+            response = self.client.post('/api/v1/registrations:batch', dumps(data), content_type='application/json')
+        results = response.json()['results']
+        self.assertEqual(results[0]['error']['code'], 'InternalServerError')
+        self.assertEqual(results[1], {'index': 1, 'registrationId': free})
+        self.assertEqual(cache.get(taken), b'{}')
+
+    def test_registration_post_idempotency_key_pending(self):
+        data = self.registration_post_data_201[2]
+        taken = self.registration_get_data_200[0]
+        cache.set(taken, b'{}', None)
+        with mock.patch('rest_api.storage.uuid4', return_value=taken):
+            response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json',
+                                        HTTP_IDEMPOTENCY_KEY='key-2')
+        self.assertEqual(response.status_code, 500)
+        self.assertIsNone(cache.get(idempotency_cache_key('key-2')))
+        response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json',
+                                    HTTP_IDEMPOTENCY_KEY='key-2')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotEqual(response.json()['registrationId'], taken)
+        self.assertFalse(response.has_header('Idempotent-Replayed'))
+        fingerprint = registration_fingerprint(validate_registration(dict(data), 'test'))
+        cache.set(idempotency_cache_key('key-3'), {
+            'registrationId': taken, 'fingerprint': fingerprint, 'completed': False,
+        }, 60)
+        response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json',
+                                    HTTP_IDEMPOTENCY_KEY='key-3')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['error']['code'], 'IdempotentRequestInProgress')
+        request = AsyncRequestFactory().post('/api/v1/registrations', dumps(data), content_type='application/json')
+        request.META.update({'HTTP_IDEMPOTENCY_KEY': 'key-3', 'x-correlationid': 'test'})
+        self.assertEqual(async_to_sync(apost_registrations)(request).status_code, 409)
+
+    def test_registration_persistence(self):
+        data = self.registration_post_data_201 + self.registration_post_data_201
+        registration_ids = [
+            self.client.post('/api/v1/registrations', dumps(item), content_type='application/json')
+                .json()['registrationId']
+            for item in data[:3]
+        ]
+        response = self.client.post('/api/v1/registrations:batch', dumps(data[3:]), content_type='application/json')
+        registration_ids += [result['registrationId'] for result in response.json()['results']]
+        get_store().flush()
+        self.assertEqual(get_store().count(), 6)
+        bodies = [self.client.get('/api/v1/registrations/' + registration_id).content
+                  for registration_id in registration_ids]
+
+        cache.clear()
+        local_cache.clear()
+        for registration_id, body in zip(registration_ids[:2], bodies):
+            response = self.client.get('/api/v1/registrations/' + registration_id)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, body)
+            self.assertEqual(registration_body(cache.get(registration_id)), body)
+        response = self.client.post('/api/v1/registrations:lookup', dumps({'registrationIds': registration_ids}),
+                                    content_type='application/json')
+        self.assertEqual(response.json()['missing'], [])
+
+        cache.clear()
+        local_cache.clear()
+        call_command('rehydrate_registrations', stdout=StringIO())
+        self.assertEqual({registration_id: registration_body(value)
+                          for registration_id, value in cache.get_many(registration_ids).items()},
+                         dict(zip(registration_ids, bodies)))
+
+        # It runs on every start, so neither a disabled store nor unreachable memcached stops the start.
+        stdout = StringIO()
+        with override_settings(REGISTRATIONS_STORE={'PATH': ''}):
+            call_command('rehydrate_registrations', stdout=stdout)
+        self.assertIn('disabled', stdout.getvalue())
+        stderr = StringIO()
+        with mock.patch('rest_api.management.commands.rehydrate_registrations.cache') as unreachable:
+            unreachable.get.return_value = None
+            unreachable.set_many.side_effect = lambda data, timeout: list(data)
+            unreachable.incr.side_effect = ValueError('Key not found')
+            call_command('rehydrate_registrations', stdout=StringIO(), stderr=stderr)
+        self.assertIn('6 registrations could not be written', stderr.getvalue())
+
+    def test_registration_store_retries_and_bounds_queue(self):
+        store = RegistrationStore(os.path.join(self.store_directory.name, 'failing.sqlite3'), flush_interval=0.01,
+                                  max_queue_size=2, queue_timeout=0.01)
+        connect = store.connect
+        failures = [sqlite3.OperationalError('database is locked')] * 2
+        committing = threading.Event()
+
+        class FailingConnection:
+            def __init__(self):
+                self.connection = connect()
+
+            def __enter__(self):
+                return self.connection.__enter__()
+
+            def __exit__(self, *exc_info):
+                return self.connection.__exit__(*exc_info)
+
+            def executemany(self, *args):
+                committing.wait()
+                if failures:
+                    raise failures.pop()
+                return self.connection.executemany(*args)
+
+        store.connect = FailingConnection
+        registry.reset()
+        with self.assertLogs('django', 'ERROR'):
+            store.put_many([('a', b'{}')])
+            time.sleep(0.05)
+            # The writer holds the first row, the queue takes two more and rejects the rest.
+            with self.assertRaises(StoreFull) as raised:
+                store.put_many([('b', b'{}'), ('c', b'{}'), ('d', b'{}'), ('e', b'{}')])
+            self.assertEqual(raised.exception.registration_ids, ['d', 'e'])
+            committing.set()
+            self.assertTrue(store.flush(5))
+        store.connect = connect
+        self.assertEqual([store.get(registration_id) for registration_id in 'abcde'],
+                         [b'{}', b'{}', b'{}', None, None])
+        counters = registry.collect()['counters']
+        self.assertEqual(counters[('registrations_store_write_failures_total', (('reason', 'error'),))], 2)
+        self.assertEqual(counters[('registrations_store_write_failures_total', (('reason', 'rejected'),))], 2)
+
+        # A registration the store cannot take is not acknowledged and leaves nothing behind.
+        def reject(items, overwrite=False):
+            raise StoreFull([registration_id for registration_id, _ in items])
+
+        data = self.registration_post_data_201[0]
+        with mock.patch.object(get_store(), 'put_many', side_effect=reject), \
+                override_settings(REGISTRATIONS_DUPLICATE_EMAILS='reject'):
+            response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json',
+                                        HTTP_IDEMPOTENCY_KEY='key-4')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+            response = self.client.post('/api/v1/registrations:batch', dumps([data]), content_type='application/json')
+            self.assertIsNone(response.json()['results'][0].get('registrationId'))
+        self.assertIsNone(cache.get(idempotency_cache_key('key-4')))
+        self.assertIsNone(cache.get(email_key('test1@test.com')))
+        self.assertEqual(find_registration_ids('test1@test.com'), [])
+        response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json',
+                                    HTTP_IDEMPOTENCY_KEY='key-4')
+        self.assertEqual(response.status_code, 201)
+
+    def test_registration_secondary_write_failures(self):
+        # A stored registration is acknowledged even if the writes after it fail.
+        failure = MemcachedError('down')
+        data = self.registration_post_data_201
+        registry.reset()
+        with mock.patch('rest_api.storage.index_registrations', side_effect=failure), \
+                mock.patch('rest_api.storage.index_emails', side_effect=failure), \
+                mock.patch('rest_api.storage.aindex_email', side_effect=failure), \
+                mock.patch.object(get_store(), 'put_many', side_effect=sqlite3.OperationalError('disk I/O error')), \
+                self.assertLogs('django', 'ERROR'):
+            response = self.client.post('/api/v1/registrations', dumps(data[0]), content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+            registration_ids = [response.json()['registrationId']]
+            response = self.client.post('/api/v1/registrations:batch', dumps(data[1:2]),
+                                        content_type='application/json')
+            registration_ids.extend(result['registrationId'] for result in response.json()['results'])
+            request = AsyncRequestFactory().post('/api/v1/registrations', dumps(data[2]),
+                                                 content_type='application/json')
+            request.META['x-correlationid'] = 'test'
+            response = async_to_sync(apost_registrations)(request)
+            self.assertEqual(response.status_code, 201)
+            registration_ids.append(loads(response.content)['registrationId'])
+        for registration_id in registration_ids:
+            self.assertEqual(self.client.get('/api/v1/registrations/' + registration_id).status_code, 200)
+        counters = registry.collect()['counters']
+        for step, count in [('persist', 3), ('id_index', 2), ('email_index', 3)]:
+            self.assertEqual(counters[('registrations_secondary_write_failures_total', (('step', step),))], count)
+
+    def test_registration_import_export(self):
+        data = self.registration_post_data_201
+        response = self.client.post('/api/v1/registrations', dumps(data[0]), content_type='application/json')
+        posted_id = response.json()['registrationId']
+        given_id = self.registration_get_data_200[0]
+        source = os.path.join(self.store_directory.name, 'registrations.ndjson')
+        with open(source, 'w') as file:
+            file.write('\n'.join([
+                dumps(data[1]),
+                'not json',
+                dumps({**data[2], 'locale': 'english'}),
+                '',
+                dumps({'registrationId': given_id.upper(), **data[2], 'person': loads(data[2]['person'])}),
+                dumps({'registrationId': given_id, **data[2]}),
+            ]) + '\n')
+        stdout = StringIO()
+        call_command('import_registrations', source, '--chunk-size', '2', stdout=stdout, stderr=StringIO())
+        self.assertIn('Imported 2 registrations', stdout.getvalue())
+        self.assertIn('1 skipped, 2 rejected', stdout.getvalue())
+        with open(source + '.errors') as file:
+            rejects = [loads(line) for line in file]
+        self.assertEqual([reject['line'] for reject in rejects], [2, 3])
+        self.assertEqual(rejects[1]['fieldErrors'][0]['field'], 'locale')
+        self.assertEqual(loads(self.client.get('/api/v1/registrations/' + given_id).content)['locale'],
+                         data[2]['locale'].lower())
+
+        target = os.path.join(self.store_directory.name, 'export.ndjson')
+        call_command('export_registrations', target, '--chunk-size', '2', stderr=StringIO())
+        with open(target) as file:
+            exported = [loads(line) for line in file]
+        self.assertEqual(len(exported), 3)
+        self.assertEqual(exported[0]['registrationId'], posted_id)
+        self.assertEqual(exported[2], {
+            'registrationId': given_id, **loads(self.client.get('/api/v1/registrations/' + given_id).content)
+        })
+
+        stdout = StringIO()
+        call_command('import_registrations', target, stdout=stdout, stderr=StringIO())
+        self.assertIn('Imported 0 registrations', stdout.getvalue())
+        self.assertIn('3 skipped, 0 rejected', stdout.getvalue())
+
+        # A registration imported again after memcached lost it replaces the stored one, also after rehydration.
+        cache.delete(given_id)
+        local_cache.clear()
+        with open(source, 'w') as file:
+            file.write(dumps({**exported[2], 'locale': 'DE'}) + '\n')
+        call_command('import_registrations', source, stdout=StringIO(), stderr=StringIO())
+        self.assertTrue(get_store().flush(5))
+        cache.clear()
+        local_cache.clear()
+        call_command('rehydrate_registrations', stdout=StringIO(), stderr=StringIO())
+        self.assertIsNotNone(cache.get(given_id))
+        self.assertEqual(loads(self.client.get('/api/v1/registrations/' + given_id).content)['locale'], 'de')
+        self.assertEqual(get_store().count(), 3)
+
+    def test_registration_find_by_email(self):
+        data = self.registration_post_data_201[0]
+        registration_ids = [
+            self.client.post('/api/v1/registrations', dumps(data), content_type='application/json')
+                .json()['registrationId']
+            for _ in range(2)
+        ]
+        other = {**data, 'person': dumps({**loads(data['person']), 'email': 'TEST1@Test.com'})}
+        # The positions of the same email in a batch are allocated with one `incr`.
+        with mock.patch.object(cache, 'incr', wraps=cache.incr) as incr:
+            response = self.client.post('/api/v1/registrations:batch',
+                                        dumps([other, self.registration_post_data_201[1], other]),
+                                        content_type='application/json')
+        key = email_key('test1@test.com') + ':n'
+        self.assertEqual([call.args for call in incr.call_args_list if call.args[0] == key], [(key, 2)])
+        registration_ids += [response.json()['results'][index]['registrationId'] for index in [0, 2]]
+        response = self.client.get('/api/v1/registrations', {'email': 'Test1@TEST.com'})
+        self.assertEqual(response.status_code, 200)
+        found = response.json()['registrations']
+        self.assertEqual([registration['registrationId'] for registration in found], registration_ids)
+        self.assertEqual(found[0], {
+            'registrationId': registration_ids[0],
+            **loads(self.client.get('/api/v1/registrations/' + registration_ids[0]).content),
+        })
+        self.assertEqual(self.client.get('/api/v1/registrations', {'email': 'nobody@test.com'}).json(),
+                         {'registrations': []})
+        for query in [{}, {'email': ''}, {'email': 'not an email'}]:
+            response = self.client.get('/api/v1/registrations', query)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['fieldErrors'][0]['field'], 'email')
+        self.assertEqual(self.client.put('/api/v1/registrations').status_code, 405)
+
+    def test_registration_duplicate_emails(self):
+        data = self.registration_post_data_201[0]
+        duplicate = {**data, 'person': dumps({**loads(data['person']), 'email': 'Test1@test.com'})}
+        with override_settings(REGISTRATIONS_DUPLICATE_EMAILS='reject'):
+            response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json',
+                                        HTTP_IDEMPOTENCY_KEY='key-1')
+            registration_id = response.json()['registrationId']
+            response = self.client.post('/api/v1/registrations', dumps(duplicate), content_type='application/json',
+                                        HTTP_IDEMPOTENCY_KEY='key-2')
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.json()['error']['code'], 'EmailAlreadyRegistered')
+            self.assertEqual(response.json()['fieldErrors'][0]['field'], 'email')
+            response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json',
+                                        HTTP_IDEMPOTENCY_KEY='key-1')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response['Idempotent-Replayed'], 'true')
+        with override_settings(REGISTRATIONS_DUPLICATE_EMAILS='merge'):
+            request = AsyncRequestFactory().post('/api/v1/registrations', dumps(duplicate),
+                                                 content_type='application/json')
+            request.META.update({'HTTP_IDEMPOTENCY_KEY': 'key-2', 'x-correlationid': 'test'})
+            response = async_to_sync(apost_registrations)(request)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(loads(response.content), {'registrationId': registration_id})
+            self.assertEqual(response['Registration-Merged'], 'true')
+        response = self.client.get('/api/v1/registrations', {'email': 'test1@test.com'})
+        self.assertEqual([registration['registrationId'] for registration in response.json()['registrations']],
+                         [registration_id])
+
+        other, new = self.registration_post_data_201[1:3]
+        with override_settings(REGISTRATIONS_DUPLICATE_EMAILS='reject'):
+            response = self.client.post('/api/v1/registrations:batch', dumps([duplicate, new, new]),
+                                        content_type='application/json')
+            results = response.json()['results']
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([result.get('error', {}).get('code') for result in results],
+                             ['EmailAlreadyRegistered', None, 'EmailAlreadyRegistered'])
+            self.assertEqual(results[0]['fieldErrors'][0]['field'], 'email')
+            new_id = results[1]['registrationId']
+        with override_settings(REGISTRATIONS_DUPLICATE_EMAILS='merge'):
+            response = self.client.post('/api/v1/registrations:batch', dumps([new, duplicate]),
+                                        content_type='application/json')
+            self.assertEqual(response.json()['results'], [
+                {'index': 0, 'registrationId': new_id, 'merged': True},
+                {'index': 1, 'registrationId': registration_id, 'merged': True},
+            ])
+
+        # Emails registered while duplicates were allowed have not been claimed, the first registration gets them.
+        first_id, _ = [
+            self.client.post('/api/v1/registrations', dumps(other), content_type='application/json')
+                .json()['registrationId']
+            for _ in range(2)
+        ]
+        with override_settings(REGISTRATIONS_DUPLICATE_EMAILS='reject'):
+            response = self.client.post('/api/v1/registrations', dumps(other), content_type='application/json')
+            self.assertEqual(response.status_code, 409)
+            response = self.client.post('/api/v1/registrations:batch', dumps([other]), content_type='application/json')
+            self.assertEqual(response.json()['results'][0]['error']['code'], 'EmailAlreadyRegistered')
+        with override_settings(REGISTRATIONS_DUPLICATE_EMAILS='merge'):
+            request = AsyncRequestFactory().post('/api/v1/registrations', dumps(other), content_type='application/json')
+            request.META['x-correlationid'] = 'test'
+            self.assertEqual(loads(async_to_sync(apost_registrations)(request).content), {'registrationId': first_id})
+        response = self.client.get('/api/v1/registrations', {'email': 'test2@test.com'})
+        self.assertEqual(len(response.json()['registrations']), 2)
+
+    def test_registration_duplicate_emails_concurrent(self):
+        data = self.registration_post_data_201[1]
+
+        def post(_):
+            return Client().post('/api/v1/registrations', dumps(data), content_type='application/json').status_code
+
+        with override_settings(REGISTRATIONS_DUPLICATE_EMAILS='reject'):
+            with ThreadPoolExecutor(8) as executor:
+                statuses = list(executor.map(post, range(16)))
+        self.assertEqual(sorted(statuses), [201] + [409] * 15)
+        response = self.client.get('/api/v1/registrations', {'email': 'test2@test.com'})
+        self.assertEqual(len(response.json()['registrations']), 1)
+
+
+    def test_registration_duplicate_emails_failed_write(self):
+        data = self.registration_post_data_201[2]
+        key = email_key('test3@test.com')
+        add, aadd = cache.add, AsyncMemcachedCache.add
+
+        def failing_add(cache_key, *args, **kwargs):
+            if cache_key.startswith('registrations:email:'):
+                return add(cache_key, *args, **kwargs)
+            raise MemcachedError('Connection closed')
+
+        async def afailing_add(self, cache_key, *args, **kwargs):
+            if cache_key.startswith('registrations:email:'):
+                return await aadd(self, cache_key, *args, **kwargs)
+            raise MemcachedError('Connection closed')
+
+        # The claim of a registration that failed to be written after it is released.
+        with override_settings(REGISTRATIONS_DUPLICATE_EMAILS='reject'):
+            with mock.patch.object(cache, 'add', side_effect=failing_add):
+                response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json')
+            self.assertEqual(response.status_code, 500)
+            self.assertIsNone(cache.get(key))
+            request = AsyncRequestFactory().post('/api/v1/registrations', dumps(data), content_type='application/json')
+            request.META['x-correlationid'] = 'test'
+            with mock.patch.object(AsyncMemcachedCache, 'add', afailing_add):
+                self.assertEqual(async_to_sync(apost_registrations)(request).status_code, 500)
+            self.assertIsNone(cache.get(key))
+            response = self.client.post('/api/v1/registrations', dumps(data), content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(cache.get(key), response.json()['registrationId'])
+
+
+class RegistrationCodecTest(unittest.TestCase):
+    """Compact registration record unit tests."""
+
+    data = {
+        'registrationDate': '2010-01-01T00:00:00.000000+01:00',
+        'locale': 'en',
+        'person': {'firstName': 'Fírst', 'lastName': 'Last', 'email': 'test@test.com'},
+    }
+    etag = bytes(range(ETAG_SIZE))
+
+    def test_round_trip(self):
+        record = encode_record(self.data, self.etag)
+        self.assertTrue(is_record(record))
+        self.assertEqual(decode_record(record), self.data)
+        self.assertLess(len(record), len(dumps(self.data).encode()) // 2)
+        self.assertFalse(is_record(dumps(self.data).encode()))
+
+    def test_extra_fields_and_long_values(self):
+        data = {**self.data, 'source': {'app': 'web'}, 'person': {**self.data['person'], 'lastName': 'L' * 300,
+                                                                  'phone': None}}
+        self.assertEqual(decode_record(encode_record(data, self.etag)), data)
+
+    def test_compression(self):
+        data = {**self.data, 'person': {**self.data['person'], 'lastName': 'Last' * 100}}
+        record = encode_record(data, self.etag, compress_min_bytes=256)
+        self.assertEqual(record[0], 0x82)
+        self.assertLess(len(record), 100)
+        self.assertEqual(decode_record(record), data)
+        self.assertEqual(encode_record(self.data, self.etag, compress_min_bytes=256)[0], 0x02)
+
+    def test_etag(self):
+        record = encode_record(self.data, self.etag, compress_min_bytes=1)
+        self.assertEqual(record_etag(record), self.etag)
+        reversed_data = {'extra': 1, **dict(reversed(self.data.items()))}
+        self.assertEqual(list(ordered(reversed_data)), ['registrationDate', 'locale', 'person', 'extra'])
+        self.assertEqual(ordered(reversed_data), decode_record(encode_record(reversed_data, self.etag)))
+        with self.assertRaises(ValueError):
+            encode_record(self.data, b'')
+
+    def test_version_1(self):
+        record = b'\x01' + encode_record(self.data, self.etag)[1 + ETAG_SIZE:]
+        self.assertTrue(is_record(record))
+        self.assertIsNone(record_etag(record))
+        self.assertEqual(decode_record(record), self.data)
+
+    def test_unknown_version(self):
+        with self.assertRaises(ValueError):
+            decode_record(b'\x03' + encode_record(self.data, self.etag)[1:])
+
+
+class RegistrationIdFilterTest(unittest.TestCase):
+    """Registration ID filter tests."""
+
+    registration = {
+        'registrationDate': '2010-01-01T00:00:00.000000+01:00',
+        'locale': 'en',
+        'person': dumps({'firstName': 'First', 'lastName': 'Last', 'email': 'test@test.com'}),
+    }
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'ids.filter')
+        self.filter_settings = override_settings(
+            REGISTRATIONS_ID_FILTER={'PATH': self.path, 'CAPACITY': 1000, 'FALSE_POSITIVE_RATE': 0.01},
+            REGISTRATIONS_STORE={'PATH': os.path.join(self.directory.name, 'registrations.sqlite3')},
+        )
+        self.filter_settings.enable()
+        registry.reset()
+
+    def tearDown(self):
+        self.filter_settings.disable()
+        self.directory.cleanup()
+        cache.clear()
+        local_cache.clear()
+
+    def test_filter(self):
+        added = ['%08x-0000-4000-8000-000000000000' % i for i in range(1000)]
+        self.assertEqual(build_filter(self.path, added[:500], 1000, 0.01), 500)
+        id_filter = IdFilter(self.path)
+        id_filter.add(added[500:])
+        self.assertTrue(all(id_filter.might_contain(registration_id.upper()) for registration_id in added))
+        others = ['%08x-0000-4000-8000-000000000001' % i for i in range(10000)]
+        false_positives = sum(id_filter.might_contain(registration_id) for registration_id in others)
+        self.assertLess(false_positives, 300)
+        stats = id_filter.stats()
+        self.assertEqual(stats['items'], 1000)
+        self.assertAlmostEqual(stats['false_positive_rate'], 0.01, delta=0.005)
+        self.assertEqual(stats['bytes'], os.path.getsize(self.path))
+        self.assertEqual(filter_size(1000, 0.01), (9586, 7))
+
+        # A rebuild keeps the IDs of the current file, and a worker holding its map adds to the new one.
+        stale = id_filter.get_mapped()
+        self.assertEqual(build_filter(self.path, added[:10], 1000, 0.01), 1000)
+        self.assertTrue(all(id_filter.might_contain(registration_id) for registration_id in added))
+        self.assertFalse(stale.add(others[:1]))
+        id_filter.mapped = stale
+        id_filter.add(others[:1])
+        self.assertTrue(IdFilter(self.path).might_contain(others[0]))
+        # A larger filter cannot take the bits of the current one, a smaller one keeps its size.
+        build_filter(self.path, added[:10], 2000, 0.01)
+        self.assertEqual(id_filter.stats()['items'], 10)
+        self.assertFalse(all(id_filter.might_contain(registration_id) for registration_id in added))
+        build_filter(self.path, [], 1000, 0.01)
+        self.assertEqual(id_filter.get_mapped().bits, filter_size(2000, 0.01)[0])
+        os.remove(self.path)
+        build_filter(self.path, [], 1000, 0.01)
+        self.assertFalse(id_filter.might_contain(added[0]))
+        self.assertEqual(id_filter.stats()['items'], 0)
+        self.assertTrue(IdFilter(self.path + '.missing').might_contain(added[0]))
+
+    def test_registration_get(self):
+        call_command('rebuild_id_filter', stdout=StringIO())
+        with mock.patch('rest_api.storage.cache') as storage_cache:
+            response = Client().get('/api/v1/registrations/461bb3e0-a02d-493c-8c2e-544a9f776d43')
+            self.assertEqual(response.status_code, 404)
+            storage_cache.get.assert_not_called()
+
+        response = Client().post('/api/v1/registrations', dumps(self.registration), content_type='application/json')
+        registration_id = response.json()['registrationId']
+        local_cache.clear()
+        self.assertEqual(Client().get('/api/v1/registrations/' + registration_id).status_code, 200)
+        response = Client().post('/api/v1/registrations:lookup', dumps({'registrationIds': [
+            registration_id, '461bb3e0-a02d-493c-8c2e-544a9f776d43',
+        ]}), content_type='application/json')
+        self.assertEqual(response.json()['missing'], ['461bb3e0-a02d-493c-8c2e-544a9f776d43'])
+
+        # A registration that is in memcached and the ID index but not in the store, and one that was only added
+        # to the current file, are kept by a rebuild.
+        lost_id, added_id = '461bb3e0-a02d-493c-8c2e-544a9f776d44', '461bb3e0-a02d-493c-8c2e-544a9f776d45'
+        cache.set(lost_id, encode_registration(validate_registration(dict(self.registration), 'test')), None)
+        index_registrations([lost_id])
+        os.remove(self.path)
+        call_command('rebuild_id_filter', stdout=StringIO())
+        get_id_filter().add([added_id])
+        call_command('rebuild_id_filter', stdout=StringIO())
+        local_cache.clear()
+        self.assertEqual(Client().get('/api/v1/registrations/' + registration_id).status_code, 200)
+        self.assertEqual(Client().get('/api/v1/registrations/' + lost_id).status_code, 200)
+        self.assertTrue(get_id_filter().might_contain(added_id))
+        collected = registry.collect()
+        self.assertEqual(collected['counters'][('registrations_id_filter_checks_total', (('result', 'absent'),))], 2)
+        self.assertEqual(collected['counters'][('registrations_id_filter_checks_total', (('result', 'present'),))],
+                         3)
+        self.assertEqual(collected['gauges'][('registrations_id_filter_items', ())], 3)
+        self.assertEqual(collected['gauges'][('registrations_id_filter_size_bytes', ())],
+                         os.path.getsize(self.path))
+
+
+class ApiExceptionTest(unittest.TestCase):
+    """Error response unit tests."""
+
+    def assert_response(self, exception: ApiException):
+        response = exception.response
+        self.assertEqual(response.status_code, exception.http_code)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response['x-correlationid'], 'test')
+        self.assertEqual(response.content, json_codec.dumps(exception.body))
+
+    def test_static_errors_are_not_encoded(self):
+        with mock.patch('rest_api.errors.dumps', side_effect=AssertionError):
+            self.assert_response(ApiException(404, 'test', ApiException.ERROR_VALIDATION_FAILED,
+                                              ApiException.ERROR_MESSAGE_REGISTRATION_NOT_FOUND))
+            with self.assertRaises(ApiException) as raised:
+                validate_registration({'locale': 'english', 'person': '{}'}, 'test')
+            self.assertEqual(len(raised.exception.field_errors), 5)
+            self.assert_response(raised.exception)
+
+    def test_dynamic_errors(self):
+        self.assert_response(ApiException(400, 'test', ApiException.ERROR_VALIDATION_FAILED, 'Message %d' % 1))
+        self.assert_response(ApiException(400, 'test', 'Code', field_errors=[
+            {'field': 'registrationIds[1]', 'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE, 'message': 'é'},
+            {'field': 'locale', 'code': ApiException.FIELD_ERROR_IS_REQUIRED_CODE,
+             'message': 'The field "locale". ' + ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE},
+        ]))
+        self.assert_response(ApiException(400, 'test', ApiException.ERROR_VALIDATION_FAILED, field_errors=[]))
+
+
+class RegistrationDateTest(unittest.TestCase):
+    """Differential tests of the `registrationDate` parser against `datetime.strptime`."""
+
+    parts = [
+        ['2020', '0000', '0001', '9999', '202', '20201', '\u0662\u0660\u0662\u0660', '2024'],
+        ['-'],
+        ['01', '1', '12', '13', '00', '02', ' 1'],
+        ['-'],
+        ['01', '1', ' 1', '29', '30', '31', '32', '00'],
+        ['T', 't', ' '],
+        ['00', '0', '23', '24'],
+        [':'],
+        ['00', '0', '59', '60'],
+        [':'],
+        ['00', '59', '60', '61'],
+        ['.', ''],
+        ['0', '000000', '123456', '1234567', ''],
+        ['+01:00', '-01:00', '+0100', 'Z', 'z', '+01:00:30', '+01:00:30.5', '+0100:30', '+01:0030', '+0100:00.5',
+         '+23:59', '+24:00', '+1:00', '+01:60', '-00:00:00.000001', ''],
+        ['', ' ', '0'],
+    ]
+
+    def assertSameAsStrptime(self, value):
+        try:
+            expected = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f%z')
+        except ValueError:
+            expected = None
+        self.assertEqual(parse_registration_date(value), expected, value)
+        self.assertEqual(validate_registration_date(value), expected is not None, value)
+
+    def test_parse_registration_date_fixed(self):
+        for value in [
+            '2010-01-01T00:00:00.000000+01:00',
+            '2020-02-29T23:59:59.999999-12:30',
+            '2021-02-29T00:00:00.000000+01:00',
+            '0001-01-01T00:00:00.000000+01:00',
+            '9999-12-31T23:59:59.999999-01:00',
+            '2020-01-01T00:00:00.000000+01:00:00.123456',
+        ]:
+            self.assertSameAsStrptime(value)
+        self.assertEqual(parse_registration_date('2010-01-01T00:00:00.000000+01:00').utcoffset().total_seconds(), 0)
+
+    def test_parse_registration_date_random(self):
+        generator = random.Random(0)
+        for _ in range(20000):
+            self.assertSameAsStrptime(''.join(generator.choice(choices) for choices in self.parts))
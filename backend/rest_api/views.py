@@ -1,25 +1,225 @@
 import logging
 
-from json import loads
-from uuid import uuid4
+from functools import wraps
+from hmac import compare_digest
 
-from django.core.cache import cache
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import (
+    HttpResponse,
+    HttpResponseNotAllowed,
+    HttpResponseNotModified,
+    StreamingHttpResponse,
+)
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from django.utils.log import log_response
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
+from backend.admission import retry_after
+from backend.cache.capacity import CapacityMonitor
+from backend.json_codec import dumps, json_response, loads
+from backend.logging import log_payload
+from backend.metrics import timed
 from rest_api.errors import (
-    ApiException,
-    validate_registration_id,
-    validate_registration_date,
-    validate_locale,
-    validate_person,
-    validate_name_part,
-    validate_email,
+    ApiException, parse_content_length, precompute_field_error, validate_email, validate_registration_id,
+)
+from rest_api.schema import validate_registration
+from rest_api.storage import (
+    EmailAlreadyRegistered,
+    IdempotencyKeyReused,
+    IdempotentRequestInProgress,
+    StorageUnavailable,
+    acreate_registration,
+    aget_registration,
+    check_cache_capacity,
+    create_registration,
+    create_registrations,
+    find_registration_ids,
+    get_registration,
+    iter_registrations,
+    registration_body,
+    registration_etag,
 )
 
 logger = logging.getLogger('django.request')
 
+capacity_monitor = CapacityMonitor()
+
+INVALID_IDEMPOTENCY_KEY_ERROR = precompute_field_error({
+    'field': 'Idempotency-Key',
+    'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
+    'message': 'The string of 1 to 255 characters is required',
+})
+EMAIL_ALREADY_REGISTERED_ERROR = precompute_field_error({
+    'field': 'email',
+    'code': ApiException.ERROR_EMAIL_ALREADY_REGISTERED,
+    'message': 'The email is already registered',
+})
+REGISTRATION_IDS_REQUIRED_ERROR = precompute_field_error({
+    'field': 'registrationIds',
+    'code': ApiException.FIELD_ERROR_IS_REQUIRED_CODE,
+    'message': ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE,
+})
+EMAIL_INVALID_ERROR = precompute_field_error({
+    'field': 'email',
+    'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
+    'message': 'The email in the format according to RFC 2822 is required',
+})
+EMAIL_REQUIRED_ERROR = precompute_field_error({
+    **EMAIL_INVALID_ERROR,
+    'code': ApiException.FIELD_ERROR_IS_REQUIRED_CODE,
+})
+CONTENT_LENGTH_INVALID_ERROR = precompute_field_error({
+    'field': 'Content-Length',
+    'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
+    'message': 'The non-negative integer is required',
+})
+
+
+def get_idempotency_key(request):
+    """
+    Gets the `Idempotency-Key` header of the request, `None` if it is not sent.
+    """
+    idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= 255:
+        raise ApiException(
+            http_code=400,
+            request_id=request.META['x-correlationid'],
+            error_code=ApiException.ERROR_VALIDATION_FAILED,
+            field_errors=[INVALID_IDEMPOTENCY_KEY_ERROR]
+        )
+    return idempotency_key
+
+
+def check_body_size(request, max_size: int):
+    """
+    Rejects the request with 413 if its `Content-Length` is over `max_size` bytes, before the body is read. \\
+    A malformed `Content-Length`, which Django fails to read the body with, is rejected with 400.
+    """
+    content_length = parse_content_length(request.META.get('CONTENT_LENGTH'))
+    if content_length is None:
+        raise ApiException(
+            http_code=400,
+            request_id=request.META['x-correlationid'],
+            error_code=ApiException.ERROR_VALIDATION_FAILED,
+            field_errors=[CONTENT_LENGTH_INVALID_ERROR]
+        )
+    if content_length > max_size:
+        raise ApiException(
+            http_code=413,
+            request_id=request.META['x-correlationid'],
+            error_code=ApiException.ERROR_PAYLOAD_TOO_LARGE,
+            error_message='The request body must not be longer than %d bytes' % max_size
+        )
+
+
+def idempotency_key_reused(request) -> ApiException:
+    return ApiException(
+        http_code=422,
+        request_id=request.META['x-correlationid'],
+        error_code=ApiException.ERROR_IDEMPOTENCY_KEY_REUSED,
+        error_message=ApiException.ERROR_MESSAGE_IDEMPOTENCY_KEY_REUSED
+    )
+
+
+def idempotent_request_in_progress(request) -> ApiException:
+    return ApiException(
+        http_code=409,
+        request_id=request.META['x-correlationid'],
+        error_code=ApiException.ERROR_IDEMPOTENT_REQUEST_IN_PROGRESS,
+        error_message=ApiException.ERROR_MESSAGE_IDEMPOTENT_REQUEST_IN_PROGRESS
+    )
+
+
+def storage_unavailable(request) -> HttpResponse:
+    """
+    Builds the 503 response of a registration the durable store cannot take now, with `Retry-After`.
+    """
+    response = ApiException(
+        http_code=503,
+        request_id=request.META['x-correlationid'],
+        error_code=ApiException.ERROR_SERVICE_OVERLOADED,
+        error_message=ApiException.ERROR_MESSAGE_SERVICE_OVERLOADED
+    ).response
+    response['Retry-After'] = retry_after(settings.ADMISSION_CONTROL['RETRY_AFTER'])
+    return response
+
+
+def email_already_registered_error(request) -> ApiException:
+    return ApiException(
+        http_code=409,
+        request_id=request.META['x-correlationid'],
+        error_code=ApiException.ERROR_EMAIL_ALREADY_REGISTERED,
+        field_errors=[EMAIL_ALREADY_REGISTERED_ERROR]
+    )
+
+
+def email_already_registered(request, registration_id: str):
+    """
+    Builds the response of a registration with an email that is already registered: 409 if duplicate emails
+    are rejected, otherwise 200 with the ID of the registration that has the email and the `Registration-Merged`
+    header.
+    """
+    if settings.REGISTRATIONS_DUPLICATE_EMAILS == 'reject':
+        raise email_already_registered_error(request)
+    logger.info('The user with this email is already registered with ID: %s', registration_id)
+    response = json_response(status=200, data={'registrationId': registration_id})
+    response['x-correlationid'] = request.META['x-correlationid']
+    response['Registration-Merged'] = 'true'
+    return response
+
+
+def registration_created(request, new_uuid: str, created: bool):
+    """
+    Builds the response of a registration. A replayed one gets the `Idempotent-Replayed` header.
+    """
+    if created:
+        logger.info('The new user is registered with ID: %s', new_uuid)
+    else:
+        logger.info('The user was already registered for the idempotency key with ID: %s', new_uuid)
+    with timed('serialize'):
+        response = json_response(status=201, data={'registrationId': new_uuid})
+    response['x-correlationid'] = request.META['x-correlationid']
+    if not created:
+        response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Tells whether `If-None-Match` lists the ETag, compared weakly as RFC 7232 requires for this header.
+    """
+    etags = parse_etags(if_none_match)
+    return '*' in etags or etag in etags or 'W/' + etag in etags
+
+
+def registration_response(request, existing_user) -> HttpResponse:
+    """
+    Returns the stored registration with its ETag and `REGISTRATIONS_CACHE_CONTROL`. \\
+    Registrations never change, so when `If-None-Match` has the ETag the client already has the body,
+    and `304 Not Modified` is returned without decoding the record.
+    """
+    with timed('serialize'):
+        etag = registration_etag(existing_user)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and etag_matches(if_none_match, etag):
+            response = HttpResponseNotModified()
+            body = None
+        else:
+            body = registration_body(existing_user)
+            response = HttpResponse(body, content_type='application/json')
+    if body is not None:
+        log_payload(logger, 'Requested user data: %s', body)
+    response['ETag'] = etag
+    if settings.REGISTRATIONS_CACHE_CONTROL:
+        response['Cache-Control'] = settings.REGISTRATIONS_CACHE_CONTROL
+        if 'private' not in settings.REGISTRATIONS_CACHE_CONTROL:
+            # A shared cache must not serve the registration read by one client of an authenticating proxy to another.
+            patch_vary_headers(response, ['Authorization'])
+    return response
+
 
 @csrf_exempt
 @require_http_methods(['GET'])
@@ -30,35 +230,33 @@ def get_registrations(request, registrationId):
     """
     try:
         existing_user = None
-        logger.info('Requested user ID: ' + registrationId)
+        logger.info('Requested user ID: %s', registrationId)
         try:
             if not registrationId or not validate_registration_id(registrationId):
                 raise ApiException(
                     http_code=404,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    error_message='The UUID-v4 string in the format according to standard RFC 4122 is required ' +
-                                  'for query string resource'
+                    error_message=ApiException.ERROR_MESSAGE_INVALID_REGISTRATION_ID
                 )
-            existing_user = cache.get(registrationId.lower())
+            existing_user = get_registration(registrationId.lower())
             if not existing_user:
                 raise ApiException(
                     http_code=404,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    error_message='User with this registration ID is not present in the system'
+                    error_message=ApiException.ERROR_MESSAGE_REGISTRATION_NOT_FOUND
                 )
         except ApiException as e:
             logger.error(e.error_message)
             return e.response
-        logger.info('Requested user data: ' + str(existing_user))
-        response = JsonResponse(data=existing_user)
+        response = registration_response(request, existing_user)
         response['x-correlationid'] = request.META['x-correlationid']
         return response
     except Exception as e:
         logger.error(type(e))
         logger.error(e)
-        response = JsonResponse(
+        response = json_response(
             status=500,
             data={
                 'error': {
@@ -81,171 +279,458 @@ def post_registrations(request):
     try:
         data = None
         try:
+            check_body_size(request, settings.REGISTRATIONS_MAX_BODY_SIZE['REGISTRATION'])
             if request.body == b'':
                 raise ApiException(
                     http_code=400,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    error_message='The request body must not be empty'
+                    error_message=ApiException.ERROR_MESSAGE_EMPTY_BODY
                 )
-            data = loads(request.body)
-            logger.info('Requested data for registration: ' + str(data))
-            if 'registrationDate' not in data:
+            idempotency_key = get_idempotency_key(request)
+            with timed('parse'):
+                data = loads(request.body)
+            log_payload(logger, 'Requested data for registration: %s', data)
+            with timed('validate'):
+                data = validate_registration(data, request.META['x-correlationid'])
+            try:
+                new_uuid, created = create_registration(data, idempotency_key)
+            except IdempotencyKeyReused:
+                raise idempotency_key_reused(request)
+            except IdempotentRequestInProgress:
+                raise idempotent_request_in_progress(request)
+            except EmailAlreadyRegistered as e:
+                return email_already_registered(request, e.registration_id)
+            except StorageUnavailable as e:
+                logger.error(e)
+                return storage_unavailable(request)
+        except ApiException as e:
+            logger.error(e.field_errors or e.error_message)
+            return e.response
+        return registration_created(request, new_uuid, created)
+    except Exception as e:
+        logger.error(type(e))
+        logger.error(e)
+        response = json_response(
+            status=500,
+            data={
+                'error': {
+                    'code': ApiException.ERROR_INTERNAL_SERVER,
+                    'message': 'An unexpected error occurred. Please try again later.',
+                },
+                'fieldErrors': None,
+            }
+        )
+        response['x-correlationid'] = request.META['x-correlationid']
+        return response
+
+
+@csrf_exempt
+@require_http_methods(['POST'])
+def post_registrations_batch(request):
+    """
+    Handler for POST method of REST API batch resource. \\
+    It registers an array of users at once. Every item is validated on its own,
+    and the results are returned per item in the order of the request.
+    An item with a registered email gets the error of a single POST or the ID it is merged with.
+    """
+    try:
+        data = None
+        try:
+            check_body_size(request, settings.REGISTRATIONS_MAX_BODY_SIZE['BATCH'])
+            if request.body == b'':
                 raise ApiException(
                     http_code=400,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    field_errors=[{
-                        'field': 'registrationDate',
-                        'code': ApiException.FIELD_ERROR_IS_REQUIRED_CODE,
-                        'message': ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE,
-                    }]
+                    error_message=ApiException.ERROR_MESSAGE_EMPTY_BODY
                 )
-            if not isinstance(data['registrationDate'], str) \
-               or not validate_registration_date(data['registrationDate']):
+            data = loads(request.body)
+            if not isinstance(data, list) or not data:
                 raise ApiException(
                     http_code=400,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    field_errors=[{
-                        'field': 'registrationDate',
-                        'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
-                        'message': 'The datetime string in the format "%Y-%m-%dT%H:%M:%S.%f%z" is required',
-                    }]
+                    error_message=ApiException.ERROR_MESSAGE_NOT_ARRAY
                 )
-            if 'locale' not in data:
+            if len(data) > settings.REGISTRATIONS_BATCH_MAX_SIZE:
                 raise ApiException(
                     http_code=400,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    field_errors=[{
-                        'field': 'locale',
-                        'code': ApiException.FIELD_ERROR_IS_REQUIRED_CODE,
-                        'message': ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE,
-                    }]
+                    error_message='The batch must not contain more than %d registrations'
+                                  % settings.REGISTRATIONS_BATCH_MAX_SIZE
                 )
-            if not isinstance(data['locale'], str) or not validate_locale(data['locale']):
+        except ApiException as e:
+            logger.error(e.error_message)
+            return e.response
+        logger.info('Requested batch of %d registrations', len(data))
+        results = [None] * len(data)
+        valid_indexes = []
+        valid_items = []
+        for index, item in enumerate(data):
+            try:
+                if not isinstance(item, dict):
+                    raise ApiException(
+                        http_code=400,
+                        request_id=request.META['x-correlationid'],
+                        error_code=ApiException.ERROR_VALIDATION_FAILED,
+                        error_message=ApiException.ERROR_MESSAGE_NOT_OBJECT
+                    )
+                valid_items.append(validate_registration(item, request.META['x-correlationid']))
+                valid_indexes.append(index)
+            except ApiException as e:
+                results[index] = {'index': index, **e.body}
+        created = 0
+        for index, new_uuid in zip(valid_indexes, create_registrations(valid_items)):
+            if isinstance(new_uuid, EmailAlreadyRegistered):
+                if settings.REGISTRATIONS_DUPLICATE_EMAILS == 'reject':
+                    results[index] = {'index': index, **email_already_registered_error(request).body}
+                else:
+                    results[index] = {'index': index, 'registrationId': new_uuid.registration_id, 'merged': True}
+            elif new_uuid is None:
+                results[index] = {
+                    'index': index,
+                    'error': {
+                        'code': ApiException.ERROR_INTERNAL_SERVER,
+                        'message': 'An unexpected error occurred. Please try again later.',
+                    },
+                    'fieldErrors': None,
+                }
+            else:
+                results[index] = {'index': index, 'registrationId': new_uuid}
+                created += 1
+        logger.info('Registered %d of %d users in batch', created, len(data))
+        response = json_response(data={'results': results})
+        response['x-correlationid'] = request.META['x-correlationid']
+        return response
+    except Exception as e:
+        logger.error(type(e))
+        logger.error(e)
+        response = json_response(
+            status=500,
+            data={
+                'error': {
+                    'code': ApiException.ERROR_INTERNAL_SERVER,
+                    'message': 'An unexpected error occurred. Please try again later.',
+                },
+                'fieldErrors': None,
+            }
+        )
+        response['x-correlationid'] = request.META['x-correlationid']
+        return response
+
+
+def stream_registrations(registration_ids: list[str]):
+    """
+    Generator of the lookup response body. \\
+    Found registrations are encoded chunk by chunk, the missing IDs are collected and sent at the end.
+    """
+    missing = []
+    separator = b''
+    yield b'{"registrations": {'
+    for chunk, found in iter_registrations(registration_ids, settings.REGISTRATIONS_LOOKUP_CHUNK_SIZE):
+        for registration_id in chunk:
+            if registration_id in found:
+                yield separator + dumps(registration_id) + b': ' + registration_body(found[registration_id])
+                separator = b', '
+            else:
+                missing.append(registration_id)
+    yield b'}, "missing": ' + dumps(missing) + b'}'
+
+
+@csrf_exempt
+@require_http_methods(['POST'])
+def lookup_registrations(request):
+    """
+    Handler for POST method of REST API lookup resource. \\
+    It gets registration data of several users by their IDs.
+    Large lookups are streamed to the client chunk by chunk.
+    """
+    try:
+        registration_ids = None
+        try:
+            check_body_size(request, settings.REGISTRATIONS_MAX_BODY_SIZE['LOOKUP'])
+            if request.body == b'':
                 raise ApiException(
                     http_code=400,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    field_errors=[{
-                        'field': 'locale',
-                        'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
-                        'message': 'The string in the format according to standard ISO 639-1 is required',
-                    }]
+                    error_message=ApiException.ERROR_MESSAGE_EMPTY_BODY
                 )
-            data['locale'] = data['locale'].lower()
-            if 'person' not in data:
+            data = loads(request.body)
+            if not isinstance(data, dict) or 'registrationIds' not in data:
                 raise ApiException(
                     http_code=400,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    field_errors=[{
-                        'field': 'person',
-                        'code': ApiException.FIELD_ERROR_IS_REQUIRED_CODE,
-                        'message': ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE,
-                    }]
+                    field_errors=[REGISTRATION_IDS_REQUIRED_ERROR]
                 )
-            if not isinstance(data['person'], str) or not validate_person(data['person']):
+            registration_ids = data['registrationIds']
+            if not isinstance(registration_ids, list) or not registration_ids \
+               or len(registration_ids) > settings.REGISTRATIONS_LOOKUP_MAX_SIZE:
                 raise ApiException(
                     http_code=400,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
                     field_errors=[{
-                        'field': 'person',
+                        'field': 'registrationIds',
                         'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
-                        'message': 'It must be the valid JSON string',
-                    }]
-                )
-            data['person'] = loads(data['person'])
-            if 'firstName' not in data['person']:
-                raise ApiException(
-                    http_code=400,
-                    request_id=request.META['x-correlationid'],
-                    error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    field_errors=[{
-                        'field': 'firstName',
-                        'code': ApiException.FIELD_ERROR_IS_REQUIRED_CODE,
-                        'message': 'The field "person" includes "firstName". '
-                                   + ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE,
+                        'message': 'The array of 1 to %d registration IDs is required'
+                                   % settings.REGISTRATIONS_LOOKUP_MAX_SIZE,
                     }]
                 )
-            if not isinstance(data['person']['firstName'], str) or not validate_name_part(data['person']['firstName']):
+            field_errors = [
+                {
+                    'field': 'registrationIds[%d]' % index,
+                    'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
+                    'message': 'The UUID-v4 string in the format according to standard RFC 4122 is required',
+                }
+                for index, registration_id in enumerate(registration_ids)
+                if not isinstance(registration_id, str) or not validate_registration_id(registration_id)
+            ]
+            if field_errors:
                 raise ApiException(
                     http_code=400,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    field_errors=[{
-                        'field': 'firstName',
-                        'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
-                        'message': 'Does not match format: at least 1 character string, 150 characters maximum',
-                    }]
+                    field_errors=field_errors
                 )
-            if 'lastName' not in data['person']:
+        except ApiException as e:
+            logger.error(e.error_message or e.field_errors)
+            return e.response
+        registration_ids = list(dict.fromkeys(registration_id.lower() for registration_id in registration_ids))
+        logger.info('Requested lookup of %d user IDs', len(registration_ids))
+        if len(registration_ids) > settings.REGISTRATIONS_LOOKUP_STREAM_THRESHOLD:
+            response = StreamingHttpResponse(stream_registrations(registration_ids), content_type='application/json')
+        else:
+            response = HttpResponse(b''.join(stream_registrations(registration_ids)), content_type='application/json')
+        response['x-correlationid'] = request.META['x-correlationid']
+        return response
+    except Exception as e:
+        logger.error(type(e))
+        logger.error(e)
+        response = json_response(
+            status=500,
+            data={
+                'error': {
+                    'code': ApiException.ERROR_INTERNAL_SERVER,
+                    'message': 'An unexpected error occurred. Please try again later.',
+                },
+                'fieldErrors': None,
+            }
+        )
+        response['x-correlationid'] = request.META['x-correlationid']
+        return response
+
+
+@csrf_exempt
+@require_http_methods(['GET'])
+def find_registrations(request):
+    """
+    Handler for GET method of REST API registrations resource. \\
+    It gets registration data of users by their email, looked up in the email index with two cache round trips.
+    """
+    try:
+        email = request.GET.get('email')
+        try:
+            if not email or not validate_email(email.strip()):
                 raise ApiException(
                     http_code=400,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    field_errors=[{
-                        'field': 'lastName',
-                        'code': ApiException.FIELD_ERROR_IS_REQUIRED_CODE,
-                        'message': 'The field "person" includes "lastName". '
-                                   + ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE,
-                    }]
+                    field_errors=[EMAIL_INVALID_ERROR if email else EMAIL_REQUIRED_ERROR]
                 )
-            if not isinstance(data['person']['lastName'], str) or not validate_name_part(data['person']['lastName']):
+        except ApiException as e:
+            logger.error(e.field_errors)
+            return e.response
+        registration_ids = find_registration_ids(email)
+        logger.info('Found %d users by email', len(registration_ids))
+        registrations = []
+        for chunk, found in iter_registrations(registration_ids, settings.REGISTRATIONS_LOOKUP_CHUNK_SIZE):
+            for registration_id in chunk:
+                if registration_id in found:
+                    body = registration_body(found[registration_id])
+                    registrations.append(b'{"registrationId": %s%s%s' % (
+                        dumps(registration_id), b', ' if body != b'{}' else b'', body[1:]))
+        response = HttpResponse(b'{"registrations": [' + b', '.join(registrations) + b']}',
+                                content_type='application/json')
+        response['x-correlationid'] = request.META['x-correlationid']
+        return response
+    except Exception as e:
+        logger.error(type(e))
+        logger.error(e)
+        response = json_response(
+            status=500,
+            data={
+                'error': {
+                    'code': ApiException.ERROR_INTERNAL_SERVER,
+                    'message': 'An unexpected error occurred. Please try again later.',
+                },
+                'fieldErrors': None,
+            }
+        )
+        response['x-correlationid'] = request.META['x-correlationid']
+        return response
+
+
+@require_http_methods(['GET'])
+def cache_capacity(request):
+    """
+    Internal handler of the capacity report of the memcached nodes, see `check_cache_capacity`. \\
+    Rates are computed since the previous request served by the same worker. The report shows the addresses
+    and the memory of the nodes, so it is served only with the `ENDPOINT_TOKEN` of `CACHE_CAPACITY` as a bearer token.
+    """
+    try:
+        token = settings.CACHE_CAPACITY.get('ENDPOINT_TOKEN', '')
+        authorization = request.headers.get('Authorization', '')
+        if not token or not compare_digest(authorization.encode(), b'Bearer ' + token.encode()):
+            logger.warning('Forbidden: %s', request.path)
+            return ApiException(
+                http_code=403,
+                request_id=request.META['x-correlationid'],
+                error_code=ApiException.ERROR_FORBIDDEN,
+                error_message=ApiException.ERROR_MESSAGE_FORBIDDEN
+            ).response
+        response = json_response(check_cache_capacity(capacity_monitor))
+        response['x-correlationid'] = request.META['x-correlationid']
+        return response
+    except Exception as e:
+        logger.error(type(e))
+        logger.error(e)
+        response = json_response(
+            status=500,
+            data={
+                'error': {
+                    'code': ApiException.ERROR_INTERNAL_SERVER,
+                    'message': 'An unexpected error occurred. Please try again later.',
+                },
+                'fieldErrors': None,
+            }
+        )
+        response['x-correlationid'] = request.META['x-correlationid']
+        return response
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+def registrations(request):
+    """
+    Handler of REST API registrations resource: GET finds registrations by email, POST registers a user.
+    """
+    if request.method == 'GET':
+        return find_registrations(request)
+    return post_registrations(request)
+
+
+def async_endpoint(request_method_list: list[str]):
+    """
+    Counterpart of `csrf_exempt` and `require_http_methods` for coroutine views. \\
+    The decorators of Django do not keep a view a coroutine function.
+    """
+    def decorator(view):
+        @wraps(view)
+        async def inner(request, *args, **kwargs):
+            if request.method not in request_method_list:
+                response = HttpResponseNotAllowed(request_method_list)
+                log_response('Method Not Allowed (%s): %s', request.method, request.path,
+                             response=response, request=request)
+                return response
+            return await view(request, *args, **kwargs)
+        inner.csrf_exempt = True
+        return inner
+    return decorator
+
+
+@async_endpoint(['GET'])
+async def aget_registrations(request, registrationId):
+    """
+    Async handler for GET method of REST API \\
+    It gets registration data of user by his ID without blocking the event loop.
+    """
+    try:
+        existing_user = None
+        logger.info('Requested user ID: %s', registrationId)
+        try:
+            if not registrationId or not validate_registration_id(registrationId):
                 raise ApiException(
-                    http_code=400,
+                    http_code=404,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    field_errors=[{
-                        'field': 'lastName',
-                        'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
-                        'message': 'Does not match format: at least 1 character string, 150 characters maximum',
-                    }]
+                    error_message=ApiException.ERROR_MESSAGE_INVALID_REGISTRATION_ID
                 )
-            if 'email' not in data['person']:
+            existing_user = await aget_registration(registrationId.lower())
+            if not existing_user:
                 raise ApiException(
-                    http_code=400,
+                    http_code=404,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    field_errors=[{
-                        'field': 'email',
-                        'code': ApiException.FIELD_ERROR_IS_REQUIRED_CODE,
-                        'message': 'The field "person" includes "email". '
-                                   + ApiException.FIELD_ERROR_IS_REQUIRED_MESSAGE,
-                    }]
+                    error_message=ApiException.ERROR_MESSAGE_REGISTRATION_NOT_FOUND
                 )
-            if not isinstance(data['person']['email'], str) or not validate_email(data['person']['email']):
+        except ApiException as e:
+            logger.error(e.error_message)
+            return e.response
+        response = registration_response(request, existing_user)
+        response['x-correlationid'] = request.META['x-correlationid']
+        return response
+    except Exception as e:
+        logger.error(type(e))
+        logger.error(e)
+        response = json_response(
+            status=500,
+            data={
+                'error': {
+                    'code': ApiException.ERROR_INTERNAL_SERVER,
+                    'message': 'An unexpected error occurred. Please try again later.',
+                },
+                'fieldErrors': None,
+            }
+        )
+        response['x-correlationid'] = request.META['x-correlationid']
+        return response
+
+
+@async_endpoint(['POST'])
+async def apost_registrations(request):
+    """
+    Async handler for POST method of REST API. It registers a user without blocking the event loop.
+    """
+    try:
+        data = None
+        try:
+            check_body_size(request, settings.REGISTRATIONS_MAX_BODY_SIZE['REGISTRATION'])
+            if request.body == b'':
                 raise ApiException(
                     http_code=400,
                     request_id=request.META['x-correlationid'],
                     error_code=ApiException.ERROR_VALIDATION_FAILED,
-                    field_errors=[{
-                        'field': 'email',
-                        'code': ApiException.FIELD_ERROR_INVALID_FORMAT_CODE,
-                        'message': 'The string in the format according to standard RFC 2822 (or RFC 822) is required',
-                    }]
+                    error_message=ApiException.ERROR_MESSAGE_EMPTY_BODY
                 )
+            idempotency_key = get_idempotency_key(request)
+            with timed('parse'):
+                data = loads(request.body)
+            log_payload(logger, 'Requested data for registration: %s', data)
+            with timed('validate'):
+                data = validate_registration(data, request.META['x-correlationid'])
+            try:
+                new_uuid, created = await acreate_registration(data, idempotency_key)
+            except IdempotencyKeyReused:
+                raise idempotency_key_reused(request)
+            except IdempotentRequestInProgress:
+                raise idempotent_request_in_progress(request)
+            except EmailAlreadyRegistered as e:
+                return email_already_registered(request, e.registration_id)
+            except StorageUnavailable as e:
+                logger.error(e)
+                return storage_unavailable(request)
         except ApiException as e:
-            logger.error(e.field_errors)
+            logger.error(e.field_errors or e.error_message)
             return e.response
-        new_uuid = None
-        while(True):
-            new_uuid = str(uuid4())
-            existing_user = cache.get(new_uuid)
-            if not existing_user:
-                break
-        logger.info('The new user is registered with ID: ' + new_uuid)
-        cache.set(new_uuid, data, None)
-        response = JsonResponse(status=201, data={'registrationId': new_uuid})
-        response['x-correlationid'] = request.META['x-correlationid']
-        return response
+        return registration_created(request, new_uuid, created)
     except Exception as e:
         logger.error(type(e))
         logger.error(e)
-        response = JsonResponse(
+        response = json_response(
             status=500,
             data={
                 'error': {
@@ -257,3 +742,13 @@ def post_registrations(request):
         )
         response['x-correlationid'] = request.META['x-correlationid']
         return response
+
+
+@async_endpoint(['GET', 'POST'])
+async def aregistrations(request):
+    """
+    Async handler of REST API registrations resource, see `registrations`.
+    """
+    if request.method == 'GET':
+        return await sync_to_async(find_registrations, thread_sensitive=False)(request)
+    return await apost_registrations(request)
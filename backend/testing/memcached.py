@@ -0,0 +1,226 @@
+"""
+A small pure-Python server of the memcached text protocol. \\
+It stands in for memcached in tests and benchmarks, the application does not use it: it keeps items in memory
+with LRU eviction bounded by `limit_maxbytes`, reports `stats` and `stats slabs`, and can delay its responses
+or close the connections after them.
+"""
+import socketserver
+import threading
+import time
+
+from collections import OrderedDict
+
+# Approximate per-item overhead of memcached, so that the fill and eviction numbers look like the real ones.
+ITEM_OVERHEAD = 56
+
+
+class MemcachedHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server.standin
+        while True:
+            try:
+                line = self.rfile.readline()
+            except OSError:
+                return
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            if server.delay:
+                time.sleep(server.delay)
+            command = parts[0].decode(errors='replace')
+            noreply = parts[-1] == b'noreply'
+            if command in ('set', 'add', 'replace', 'append', 'prepend', 'cas'):
+                data = self.rfile.read(int(parts[4]) + 2)[:-2]
+                response = server.store(command, parts, data)
+            else:
+                response = server.execute(command, parts)
+            if not noreply:
+                try:
+                    self.wfile.write(response)
+                except OSError:
+                    return
+            if server.close_connections:
+                return
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class MemcachedServer:
+    """
+    In-process memcached stand-in listening on `host:port`, a random free port by default.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, limit_maxbytes: int = 64 * 1024 * 1024):
+        self.limit_maxbytes = limit_maxbytes
+        self.delay = 0
+        # Closes every connection after a response, like a server that drops idle connections.
+        self.close_connections = False
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.bytes = 0
+        self.cas_unique = 0
+        self.counters = dict.fromkeys([
+            'cmd_get', 'cmd_set', 'get_hits', 'get_misses', 'evictions', 'total_items',
+            'delete_hits', 'delete_misses', 'incr_hits', 'incr_misses',
+        ], 0)
+        self.tcp_server = ThreadingServer((host, port), MemcachedHandler, bind_and_activate=True)
+        self.tcp_server.standin = self
+        self.thread = None
+
+    @property
+    def address(self) -> str:
+        host, port = self.tcp_server.server_address[:2]
+        return '%s:%d' % (host, port)
+
+    def start(self) -> 'MemcachedServer':
+        self.thread = threading.Thread(target=self.tcp_server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.tcp_server.shutdown()
+        self.tcp_server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def get_item(self, key: bytes):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        if item[2] and item[2] <= time.time():
+            self.remove(key)
+            return None
+        self.items.move_to_end(key)
+        return item
+
+    def remove(self, key: bytes):
+        item = self.items.pop(key)
+        self.bytes -= len(key) + len(item[0]) + ITEM_OVERHEAD
+
+    def put(self, key: bytes, data: bytes, flags: int, exptime: int):
+        if 0 < exptime <= 60 * 60 * 24 * 30:
+            exptime += time.time()
+        elif exptime < 0:
+            exptime = time.time()
+        self.put_absolute(key, data, flags, exptime)
+
+    def put_absolute(self, key: bytes, data: bytes, flags: int, exptime: float):
+        if key in self.items:
+            self.remove(key)
+        self.cas_unique += 1
+        self.items[key] = (data, flags, exptime, self.cas_unique)
+        self.bytes += len(key) + len(data) + ITEM_OVERHEAD
+        self.counters['total_items'] += 1
+        while self.bytes > self.limit_maxbytes and self.items:
+            self.remove(next(iter(self.items)))
+            self.counters['evictions'] += 1
+
+    def store(self, command: str, parts: list, data: bytes) -> bytes:
+        key, flags, exptime = parts[1], int(parts[2]), int(parts[3])
+        with self.lock:
+            self.counters['cmd_set'] += 1
+            item = self.get_item(key)
+            if command == 'add' and item is not None or command in ('replace', 'append', 'prepend') and item is None:
+                return b'NOT_STORED\r\n'
+            if command == 'cas':
+                if item is None:
+                    return b'NOT_FOUND\r\n'
+                if item[3] != int(parts[5]):
+                    return b'EXISTS\r\n'
+            if command in ('append', 'prepend'):
+                data = item[0] + data if command == 'append' else data + item[0]
+                self.put_absolute(key, data, item[1], item[2])
+            else:
+                self.put(key, data, flags, exptime)
+        return b'STORED\r\n'
+
+    def execute(self, command: str, parts: list) -> bytes:
+        with self.lock:
+            if command in ('get', 'gets'):
+                response = []
+                for key in parts[1:]:
+                    self.counters['cmd_get'] += 1
+                    item = self.get_item(key)
+                    if item is None:
+                        self.counters['get_misses'] += 1
+                        continue
+                    self.counters['get_hits'] += 1
+                    if command == 'gets':
+                        response.append(b'VALUE %s %d %d %d\r\n%s\r\n' % (key, item[1], len(item[0]), item[3], item[0]))
+                    else:
+                        response.append(b'VALUE %s %d %d\r\n%s\r\n' % (key, item[1], len(item[0]), item[0]))
+                response.append(b'END\r\n')
+                return b''.join(response)
+            if command == 'delete':
+                if self.get_item(parts[1]) is None:
+                    self.counters['delete_misses'] += 1
+                    return b'NOT_FOUND\r\n'
+                self.remove(parts[1])
+                self.counters['delete_hits'] += 1
+                return b'DELETED\r\n'
+            if command in ('incr', 'decr'):
+                item = self.get_item(parts[1])
+                if item is None:
+                    self.counters['incr_misses'] += 1
+                    return b'NOT_FOUND\r\n'
+                if not item[0].isdigit():
+                    return b'CLIENT_ERROR cannot increment or decrement non-numeric value\r\n'
+                delta = int(parts[2])
+                value = int(item[0]) + delta if command == 'incr' else max(int(item[0]) - delta, 0)
+                value %= 2 ** 64
+                self.put_absolute(parts[1], b'%d' % value, item[1], item[2])
+                self.counters['incr_hits'] += 1
+                return b'%d\r\n' % value
+            if command == 'touch':
+                item = self.get_item(parts[1])
+                if item is None:
+                    return b'NOT_FOUND\r\n'
+                self.put(parts[1], item[0], item[1], int(parts[2]))
+                return b'TOUCHED\r\n'
+            if command == 'flush_all':
+                self.items.clear()
+                self.bytes = 0
+                return b'OK\r\n'
+            if command == 'version':
+                return b'VERSION 1.6.0-standin\r\n'
+            if command == 'stats':
+                stats = self.stats_slabs() if parts[1:2] == [b'slabs'] else self.stats()
+                return b''.join(b'STAT %s %s\r\n' % (name.encode(), str(value).encode())
+                                for name, value in stats.items()) + b'END\r\n'
+        return b'ERROR\r\n'
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            'pid': 0,
+            'uptime': int(now - self.started),
+            'time': int(now),
+            'version': '1.6.0-standin',
+            'curr_items': len(self.items),
+            'bytes': self.bytes,
+            'limit_maxbytes': self.limit_maxbytes,
+            **self.counters,
+        }
+
+    def stats_slabs(self) -> dict:
+        used_chunks = len(self.items)
+        chunk_size = self.bytes // used_chunks if used_chunks else 0
+        return {
+            '1:chunk_size': chunk_size,
+            '1:used_chunks': used_chunks,
+            '1:total_chunks': used_chunks,
+            '1:mem_requested': self.bytes,
+            'active_slabs': 1 if used_chunks else 0,
+            'total_malloced': self.bytes,
+        }